@@ -157,10 +157,13 @@ class CiSvnDeliveryChannel(object):
     This algorithm requires that corresponding tag was successfully created
     """
 
-    def __init__(self, svn_channel, build_job, jenkins_client):
+    def __init__(self, svn_channel, build_job, jenkins_client, prefetch_publisher=None):
+        """ :param prefetch_publisher: optional PgQPrefetchPublisher to let build workers load delivery content
+        before the build starts """
         self.svn_channel = svn_channel
         self.jenkins_client = jenkins_client
         self.build_job = build_job
+        self.prefetch_publisher = prefetch_publisher
 
     def read_delivery_params(self, country, client, gav):
         logging.info("Starting read_delivery_params in CiSvnDeliveryChannel")
@@ -171,6 +174,8 @@ class CiSvnDeliveryChannel(object):
     def save_delivery_params(self, delivery_params, local_fs):
         logging.info("Starting save_delivery_params in CiSvnDeliveryChannel")
         self.svn_channel.save_delivery_params(delivery_params, local_fs)
+        if self.prefetch_publisher:
+            self.prefetch_publisher.publish(delivery_params)
         tag_url = delivery_params["mf_tag_svn"]
         client_code = delivery_params["groupid"].split(".")[-1]
         try:
@@ -187,12 +192,17 @@ class AmqpDeliveryChannel(object):
     This channel sends a message with build parameters to the Rabbit's dlbuild queue
     """
 
-    def __init__(self, svn_channel):
+    def __init__(self, svn_channel, prefetch_publisher=None):
+        """ :param prefetch_publisher: optional PgQPrefetchPublisher to let build workers load delivery content
+        before the build starts """
         self.svn_channel = svn_channel
+        self.prefetch_publisher = prefetch_publisher
 
     def build_delivery_from_tag(self, delivery_params, local_fs, amqp_client):
         logging.info("Starting build_delivery_from_tag")
         self.svn_channel.save_delivery_params(delivery_params, local_fs)
+        if self.prefetch_publisher:
+            self.prefetch_publisher.publish(delivery_params)
         tag_url = delivery_params["mf_tag_svn"]
         try:
             amqp_client.build_delivery(tag_url)
@@ -0,0 +1,534 @@
+import hashlib
+import logging
+import posixpath
+import shutil
+import struct
+import subprocess
+import tarfile
+import tempfile
+import threading
+import time
+import zipfile
+import zlib
+from collections import namedtuple
+from contextlib import ExitStack
+
+from .cancellation import CancellableReader
+from .wrapper import get_available_cores
+
+FILE_MODE = 0o644
+DIR_MODE = 0o755
+ZIP_EPOCH = 315532800  # 1980-01-01 00:00:00 UTC, the earliest time zip supports
+_CHUNK_SIZE = 1 * 1024 * 1024
+
+
+# file added to archive, as computed while it was written
+ArchiveEntry = namedtuple("ArchiveEntry", ("path", "size", "md5"))
+
+
+class ArchiveFormatError(Exception):
+    pass
+
+
+class _ArchiveWriter(object):
+    """ Base of archive format backends. Used as context manager; directories of added files are added implicitly """
+
+    extension = None
+
+    def __init__(self, target_file, mtime, cancellation=None):
+        """ :param target_file: binary file object to write archive to. Needs not be seekable
+        :param mtime: epoch time to set to all entries
+        :param cancellation: optional CancellationToken checked while data is written """
+        self._target_file = target_file
+        self._mtime = mtime
+        self._cancellation = cancellation
+        self._written_dirs = set()
+        self.reused = []
+        self.entries = []
+
+    def add_file(self, path, content, size, md5=None):
+        """ :param path: path in archive. Path, size and MD5 of added file are appended to entries
+        :param content: binary file object to read file data from
+        :param size: size of content, None if it is unknown
+        :param md5: MD5 of content if it is already known """
+        for dir_path in sorted(get_parent_dirs([path])):
+            if dir_path not in self._written_dirs:
+                self._written_dirs.add(dir_path)
+                self._add_dir(dir_path)
+        self._check_cancelled()
+        digest_reader = DigestReader(content)
+        if self._add_file(path, digest_reader, size, md5) and md5 is not None:
+            # copied by known digest, content was not read
+            self.entries.append(ArchiveEntry(path, size, md5))
+            return
+        md5 = digest_reader.hexdigest()
+        self.entries.append(ArchiveEntry(path, digest_reader.size, md5))
+
+    def _check_cancelled(self):
+        if self._cancellation:
+            self._cancellation.check()
+
+    def _readable(self, content):
+        return CancellableReader(content, self._cancellation) if self._cancellation else content
+
+    def _add_dir(self, path):
+        raise NotImplementedError()
+
+    def _add_file(self, path, content, size, md5):
+        """ :return: True if file data is taken from elsewhere than content """
+        raise NotImplementedError()
+
+
+class ZipWriter(_ArchiveWriter):
+    """ Writes zip archive. Zip64 extensions are used for files of unknown or 4 GB+ size and for archives of more than
+    65535 entries. Archive is written sequentially, sizes and CRC of each file follow its data in data descriptor """
+
+    extension = "zip"
+
+    def __init__(self, target_file, mtime, cancellation=None, base_archive=None, utc=False):
+        """ :param base_archive: optional local path to previous delivery archive. Its compressed data is copied as is
+        for files with the same path, size and MD5, so only new and changed files are compressed
+        :param utc: store entries time in UTC instead of local time, so archive does not depend on build host """
+        super(ZipWriter, self).__init__(target_file, mtime, cancellation)
+        self._base_archive = base_archive
+        self._date_time = (time.gmtime if utc else time.localtime)(max(mtime, ZIP_EPOCH))[0:6]
+        self._stack = None
+        self._base = None
+        self._stream = None
+
+    def __enter__(self):
+        with ExitStack() as stack:
+            if self._base_archive:
+                self._base = stack.enter_context(_BaseArchive(self._base_archive))
+            self._stream = _ZipStream(self._target_file)
+            self._stack = stack.pop_all()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        with self._stack:
+            if exc_type is None:
+                self._stream.close()
+        return False
+
+    def _add_dir(self, path):
+        self._stream.add_dir(path + "/", self._date_time, DIR_MODE)
+
+    def _add_file(self, path, content, size, md5):
+        if self._base and self._copy_from_base(path, content, size, md5):
+            self.reused.append(path)
+            return True
+        self._stream.add_file(path, self._date_time, FILE_MODE, self._readable(content), size)
+        return False
+
+    def _copy_from_base(self, path, content, size, md5):
+        """ Copies compressed data of base archive entry if it has the same content
+        :return: True if entry is copied, False if file is to be compressed """
+        base_info = self._base.get_entry(path)
+        if not base_info or size is None or base_info.file_size != size:
+            return False
+        position = None
+        if md5 is None:
+            if not getattr(content, "seekable", lambda: False)():
+                return False
+            position = content.tell()
+            md5 = _get_md5(self._readable(content))
+        if md5 != self._base.get_md5(base_info):
+            if position is not None:
+                content.seek(position)  # changed content is compressed from the start
+            return False
+        self._stream.copy_file(path, self._date_time, FILE_MODE, base_info.compress_type, base_info.CRC,
+                               base_info.file_size, base_info.compress_size,
+                               self._base.iter_compressed(base_info, self._check_cancelled))
+        return True
+
+
+class TarZstWriter(_ArchiveWriter):
+    """ Writes tar archive compressed by zstd process using several threads. Tar stream is piped to zstd,
+    and compressed data is copied to target file by separate thread as it is produced """
+
+    extension = "tar.zst"
+
+    def __init__(self, target_file, mtime, cancellation=None, level=3, threads=None):
+        """ :param level: zstd compression level, 1-22
+        :param threads: number of compression threads; number of available cores if None """
+        super(TarZstWriter, self).__init__(target_file, mtime, cancellation)
+        self._level = level
+        self._threads = threads or get_available_cores()
+        self._process = None
+        self._copier = None
+        self._copy_error = None
+        self._cancel_handle = None
+        self._tar = None
+
+    def __enter__(self):
+        command = ["zstd", "-q", "-c", "-%d" % self._level, "-T%d" % self._threads]
+        if self._level > 19:
+            command.append("--ultra")
+        logging.debug("Starting %s" % " ".join(command))
+        self._process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self._copier = threading.Thread(target=self._copy_output, name="zstd-output", daemon=True)
+        self._copier.start()
+        if self._cancellation:
+            self._cancel_handle = self._cancellation.on_cancel(self._process.kill)
+        self._tar = tarfile.open(fileobj=self._process.stdin, mode="w|", format=tarfile.PAX_FORMAT,
+                                 bufsize=_CHUNK_SIZE)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                try:
+                    self._tar.close()
+                finally:
+                    self._process.stdin.close()
+        except BaseException:
+            self._process.kill()
+            raise
+        finally:
+            self._stop(kill=exc_type is not None)
+        if exc_type is None and self._process.returncode != 0:
+            raise ArchiveFormatError("zstd exited with code %d" % self._process.returncode)
+        return False
+
+    def _copy_output(self):
+        """ Runs in separate thread. On failure zstd is killed, so writes to its input fail instead of blocking """
+        try:
+            shutil.copyfileobj(self._process.stdout, self._target_file, _CHUNK_SIZE)
+        except Exception as err:
+            self._copy_error = err
+            self._process.kill()
+
+    def _stop(self, kill):
+        """ Waits for zstd and output copier. Failure of copier is raised as the cause of anything else failed """
+        try:
+            if kill:
+                self._process.kill()
+                try:
+                    self._process.stdin.close()
+                except OSError:
+                    pass  # buffered data can not be flushed to killed process
+            self._process.wait()
+            self._copier.join()
+            self._process.stdout.close()
+        finally:
+            if self._cancel_handle:
+                self._cancellation.remove_callback(self._cancel_handle)
+        if self._copy_error:
+            raise ArchiveFormatError("Failed to write compressed archive: %s" % self._copy_error) from self._copy_error
+
+    def _get_tarinfo(self, path, entry_type, mode, size=0):
+        tar_info = tarfile.TarInfo(path)
+        tar_info.type = entry_type
+        tar_info.mode = mode
+        tar_info.size = size
+        tar_info.mtime = int(self._mtime)
+        tar_info.uid = tar_info.gid = 0
+        tar_info.uname = tar_info.gname = ""
+        return tar_info
+
+    def _add_dir(self, path):
+        self._tar.addfile(self._get_tarinfo(path, tarfile.DIRTYPE, DIR_MODE))
+
+    def _add_file(self, path, content, size, md5):
+        if size is not None:
+            self._tar.addfile(self._get_tarinfo(path, tarfile.REGTYPE, FILE_MODE, size), self._readable(content))
+            return
+        # tar header needs size before data
+        with tempfile.SpooledTemporaryFile(max_size=_CHUNK_SIZE) as spooled:
+            shutil.copyfileobj(self._readable(content), spooled, _CHUNK_SIZE)
+            size = spooled.tell()
+            spooled.seek(0)
+            self._tar.addfile(self._get_tarinfo(path, tarfile.REGTYPE, FILE_MODE, size), spooled)
+        return False
+
+
+# archive format backends by name; name is also used as packaging of delivery GAV
+ARCHIVE_FORMATS = {ZipWriter.extension: ZipWriter,
+                   TarZstWriter.extension: TarZstWriter}
+
+
+def get_archive_packaging(archive_path):
+    """ :param archive_path: path to archive built by DeliveryArchiver
+    :return: name of archive format, to be used as GAV packaging """
+    for extension in ARCHIVE_FORMATS:
+        if archive_path.endswith("." + extension):
+            return extension
+    return ZipWriter.extension
+
+
+def get_parent_dirs(paths):
+    parent_dirs = set()
+    for path in paths:
+        parent_dir = posixpath.dirname(path)
+        while parent_dir and parent_dir not in parent_dirs:
+            parent_dirs.add(parent_dir)
+            parent_dir = posixpath.dirname(parent_dir)
+    return parent_dirs
+
+
+def _get_md5(content):
+    md5 = hashlib.md5()
+    for chunk in iter(lambda: content.read(_CHUNK_SIZE), b""):
+        md5.update(chunk)
+    return md5.hexdigest()
+
+
+class DigestReader(object):
+    """ Computes MD5 and size of content as archive backend reads it """
+
+    def __init__(self, source_file):
+        self._source_file = source_file
+        self._start = source_file.tell() if getattr(source_file, "seekable", lambda: False)() else None
+        self._md5 = hashlib.md5()
+        self.size = 0
+
+    def read(self, *args):
+        chunk = self._source_file.read(*args)
+        if self._md5 is not None:
+            self._md5.update(chunk)
+        self.size += len(chunk)
+        return chunk
+
+    def seekable(self):
+        return self._start is not None
+
+    def tell(self):
+        return self._source_file.tell()
+
+    def seek(self, *args):
+        self._source_file.seek(*args)
+        position = self._source_file.tell()
+        # content rewound (e.g. after MD5 check) is hashed from the start again, other positions are rehashed at end
+        self._md5 = hashlib.md5() if position == self._start else None
+        self.size = 0
+        return position
+
+    def hexdigest(self):
+        """ Reads the rest of content the backend did not need (e.g. copied from base archive), so digest covers
+        all of it """
+        if self._md5 is None:
+            self.seek(self._start)
+        for _ in iter(lambda: self.read(_CHUNK_SIZE), b""):
+            pass
+        return self._md5.hexdigest()
+
+
+class DigestWriter(object):
+    """ Computes MD5 and size of archive as it is written to target file. It is not seekable, so backends write
+    archive sequentially """
+
+    def __init__(self, target_file):
+        self._target_file = target_file
+        self._md5 = hashlib.md5()
+        self.size = 0
+
+    def write(self, data):
+        self._md5.update(data)
+        self.size += len(data)
+        return self._target_file.write(data)
+
+    def flush(self):
+        self._target_file.flush()
+
+    def hexdigest(self):
+        return self._md5.hexdigest()
+
+
+# zip record layouts, see APPNOTE.TXT of PKWARE
+_LOCAL_HEADER = struct.Struct("<4s2B4HL2L2H")
+_DATA_DESCRIPTOR = struct.Struct("<4sLLL")
+_ZIP64_DATA_DESCRIPTOR = struct.Struct("<4sLQQ")
+_CENTRAL_HEADER = struct.Struct("<4s4B4HL2L5H2L")
+_ZIP64_END = struct.Struct("<4sQ2H2L4Q")
+_ZIP64_LOCATOR = struct.Struct("<4sLQL")
+_END = struct.Struct("<4s4H2LH")
+_ZIP_VERSION = 20
+_ZIP64_VERSION = 45
+_UNIX_SYSTEM = 3
+_DESCRIPTOR_FLAG = 0x08
+_UTF8_FLAG = 0x800
+_ZIP64_LIMIT = 0xFFFFFFFF
+_ZIP_COUNT_LIMIT = 0xFFFF
+
+# entry of central directory
+_ZipRecord = namedtuple("_ZipRecord", ("name", "flags", "compress_type", "date_time", "crc", "compress_size",
+                                       "file_size", "external_attr", "header_offset", "version"))
+
+
+class _ZipStream(object):
+    """ Writes zip archive record by record without seeking back. Every file, either compressed here or copied
+    from another archive, gets data descriptor and the same headers, so the same content always gives the same bytes """
+
+    def __init__(self, target_file):
+        self._target_file = target_file
+        self._offset = 0
+        self._records = []
+
+    def add_dir(self, name, date_time, mode):
+        """ :param name: directory path ending with slash """
+        record = self._start_record(name, 0, zipfile.ZIP_STORED, date_time, (mode << 16) | 0x10, False)
+        self._records.append(record)
+
+    def add_file(self, name, date_time, mode, content, size):
+        """ Compresses content to new entry
+        :param content: binary file object to read data from
+        :param size: expected size of content, None if it is unknown """
+        zip64 = _needs_zip64(size)
+        record = self._start_record(name, _DESCRIPTOR_FLAG, zipfile.ZIP_DEFLATED, date_time, mode << 16, zip64)
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        crc, file_size, compress_size = 0, 0, 0
+        for chunk in iter(lambda: content.read(_CHUNK_SIZE), b""):
+            crc = zlib.crc32(chunk, crc)
+            file_size += len(chunk)
+            compress_size += self._write(compressor.compress(chunk))
+        compress_size += self._write(compressor.flush())
+        self._finish_record(record, crc, compress_size, file_size, zip64)
+
+    def copy_file(self, name, date_time, mode, compress_type, crc, file_size, compress_size, chunks):
+        """ Adds entry of already compressed data
+        :param chunks: iterable of compressed data """
+        zip64 = _needs_zip64(file_size)
+        record = self._start_record(name, _DESCRIPTOR_FLAG, compress_type, date_time, mode << 16, zip64)
+        written = sum(self._write(chunk) for chunk in chunks)
+        if written != compress_size:
+            raise ArchiveFormatError("%d bytes of %s copied, %d expected" % (written, name, compress_size))
+        self._finish_record(record, crc, compress_size, file_size, zip64)
+
+    def close(self):
+        """ Writes central directory. Target file is not closed """
+        directory_offset = self._offset
+        for record in self._records:
+            self._write_central_header(record)
+        directory_size = self._offset - directory_offset
+        count = len(self._records)
+        if count >= _ZIP_COUNT_LIMIT or directory_offset >= _ZIP64_LIMIT or directory_size >= _ZIP64_LIMIT:
+            zip64_end_offset = self._offset
+            self._write(_ZIP64_END.pack(b"PK\x06\x06", _ZIP64_END.size - 12, _ZIP64_VERSION, _ZIP64_VERSION, 0, 0,
+                                        count, count, directory_size, directory_offset))
+            self._write(_ZIP64_LOCATOR.pack(b"PK\x06\x07", 0, zip64_end_offset, 1))
+        self._write(_END.pack(b"PK\x05\x06", 0, 0, min(count, _ZIP_COUNT_LIMIT), min(count, _ZIP_COUNT_LIMIT),
+                              min(directory_size, _ZIP64_LIMIT), min(directory_offset, _ZIP64_LIMIT), 0))
+        self._target_file.flush()
+
+    def _write(self, data):
+        self._target_file.write(data)
+        self._offset += len(data)
+        return len(data)
+
+    def _start_record(self, name, flags, compress_type, date_time, external_attr, zip64):
+        """ Writes local header. CRC and sizes are left zero: they follow data in data descriptor
+        :return: _ZipRecord to be completed once data is written """
+        try:
+            encoded_name = name.encode("ascii")
+        except UnicodeEncodeError:
+            encoded_name = name.encode("utf-8")
+            flags |= _UTF8_FLAG
+        version = _ZIP64_VERSION if zip64 else _ZIP_VERSION
+        # sizes of Zip64 entry are in extra field, so reader knows descriptor has 8-byte sizes
+        extra = struct.pack("<2H2Q", 1, 16, 0, 0) if zip64 else b""
+        sizes = _ZIP64_LIMIT if zip64 else 0
+        record = _ZipRecord(encoded_name, flags, compress_type, date_time, 0, 0, 0, external_attr, self._offset,
+                            version)
+        dos_time, dos_date = _get_dos_date_time(date_time)
+        self._write(_LOCAL_HEADER.pack(b"PK\x03\x04", version, 0, flags, compress_type, dos_time, dos_date, 0,
+                                       sizes, sizes, len(encoded_name), len(extra)))
+        self._write(encoded_name + extra)
+        return record
+
+    def _finish_record(self, record, crc, compress_size, file_size, zip64):
+        if zip64:
+            self._write(_ZIP64_DATA_DESCRIPTOR.pack(b"PK\x07\x08", crc, compress_size, file_size))
+        elif max(compress_size, file_size) >= _ZIP64_LIMIT:
+            raise ArchiveFormatError("%s is too large for zip entry of expected size"
+                                     % record.name.decode("utf-8"))
+        else:
+            self._write(_DATA_DESCRIPTOR.pack(b"PK\x07\x08", crc, compress_size, file_size))
+        self._records.append(record._replace(crc=crc, compress_size=compress_size, file_size=file_size))
+
+    def _write_central_header(self, record):
+        zip64_values = [value for value in (record.file_size, record.compress_size, record.header_offset)
+                        if value >= _ZIP64_LIMIT]
+        extra = struct.pack("<2H%dQ" % len(zip64_values), 1, 8 * len(zip64_values), *zip64_values) \
+            if zip64_values else b""
+        version = _ZIP64_VERSION if zip64_values else record.version
+        dos_time, dos_date = _get_dos_date_time(record.date_time)
+        self._write(_CENTRAL_HEADER.pack(b"PK\x01\x02", version, _UNIX_SYSTEM, version, 0, record.flags,
+                                         record.compress_type, dos_time, dos_date, record.crc,
+                                         min(record.compress_size, _ZIP64_LIMIT), min(record.file_size, _ZIP64_LIMIT),
+                                         len(record.name), len(extra), 0, 0, 0, record.external_attr,
+                                         min(record.header_offset, _ZIP64_LIMIT)))
+        self._write(record.name + extra)
+
+
+def _needs_zip64(size):
+    """ :return: True if entry of given uncompressed size may not fit 4 GB. Incompressible data grows a little
+    when deflated, so there is a margin """
+    return size is None or size * 1.05 >= _ZIP64_LIMIT
+
+
+def _get_dos_date_time(date_time):
+    year, month, day, hour, minute, second = date_time
+    return (hour << 11) | (minute << 5) | (second // 2), ((year - 1980) << 9) | (month << 5) | day
+
+
+class _BaseArchive(object):
+    """ Zip archive to take compressed entries from. Used as context manager """
+
+    def __init__(self, path):
+        self._path = path
+        self._file = None
+        self._zip = None
+        self._md5s = dict()
+
+    def __enter__(self):
+        self._file = open(self._path, "rb")
+        try:
+            self._zip = zipfile.ZipFile(self._file)
+        except zipfile.BadZipFile as err:
+            logging.warning("Base archive %s is not used: %s" % (self._path, err))
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._zip:
+            self._zip.close()
+        self._file.close()
+        return False
+
+    def get_entry(self, name):
+        """ :return: ZipInfo of not encrypted deflated file with given name, None if there is no one.
+        Stored entries are not taken: they would differ from freshly compressed ones """
+        if not self._zip:
+            return None
+        try:
+            info = self._zip.getinfo(name)
+        except KeyError:
+            return None
+        if info.is_dir() or info.flag_bits & 0x1 or info.compress_type != zipfile.ZIP_DEFLATED:
+            return None
+        return info
+
+    def get_md5(self, info):
+        """ :return: MD5 of uncompressed data of entry. Decompression is much cheaper than compression,
+        and MD5 identifies content surely unlike CRC """
+        md5 = self._md5s.get(info.filename)
+        if md5 is None:
+            with self._zip.open(info) as content:
+                md5 = self._md5s[info.filename] = _get_md5(content)
+        return md5
+
+    def iter_compressed(self, info, check_cancelled):
+        """ :return: iterator over compressed data of entry, read as is """
+        self._file.seek(info.header_offset)
+        header = self._file.read(_LOCAL_HEADER.size)
+        if len(header) != _LOCAL_HEADER.size or header[0:4] != b"PK\x03\x04":
+            raise ArchiveFormatError("Bad local header of %s in base archive %s" % (info.filename, self._path))
+        name_length, extra_length = struct.unpack("<2H", header[26:30])
+        self._file.seek(info.header_offset + _LOCAL_HEADER.size + name_length + extra_length)
+        remaining = info.compress_size
+        while remaining:
+            check_cancelled()
+            chunk = self._file.read(min(remaining, _CHUNK_SIZE))
+            if not chunk:
+                raise ArchiveFormatError("Base archive %s is truncated" % self._path)
+            remaining -= len(chunk)
+            yield chunk
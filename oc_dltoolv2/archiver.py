@@ -3,65 +3,215 @@ import logging
 import random
 import re
 import string
-from collections import Counter
+import time
+from collections import Counter, namedtuple
 
 from oc_cdtapi.NexusAPI import parse_gav, gav_to_filename
 from oc_delivery_apps.checksums.controllers import CheckSumsController
-from fs.compress import write_zip
-from fs.errors import DirectoryExists
-from fs.tempfs import TempFS
+from fs.memoryfs import MemoryFS
 import json
+from .archive_formats import ARCHIVE_FORMATS, ZIP_EPOCH, ZipWriter, DigestWriter, get_parent_dirs
 from .delivery_info_decoder import DeliveryInfoDecoder
 from .delivery_copyright_appender import DeliveryCopyrightAppender
 
 
+_INSTALLER_GAV = re.compile(r"^.+?:load_sql:.+?:ssp$")
+
+# digests of built archive and files in it, computed while archive is written
+ArchiveContents = namedtuple("ArchiveContents", ("md5", "size", "files"))
+# file in archive; citype is None for metadata files and resources of unknown type
+ArchivedFile = namedtuple("ArchivedFile", ("path", "size", "md5", "citype"))
+
+
+def _get_content_size(resource):
+    """ :return: size of locally stored resource content, None if it is not a file """
+    fs_location = resource.resource_data.get_fs_location()
+    if not fs_location:
+        return None
+    return fs_location.fs.getsize(fs_location.location)
+
+
+def _get_stream_size(content):
+    """ :return: size of seekable stream (e.g. content kept in memory), None if it is not seekable """
+    try:
+        if not content.seekable():
+            return None
+        position = content.tell()
+        size = content.seek(0, os.SEEK_END) - position
+        content.seek(position)
+        return size
+    except (AttributeError, OSError):
+        return None
+
+
+def _is_copyright_enabled():
+    return os.getenv('COUNTERPARTY_ENABLED', 'false').lower() in ['true', 'yes', 'y']
+
+
+def _check_gav(parsed_gav):
+    """ Same check parse_gav does for GAV string, without parsing it again
+    :return: parsed_gav """
+    if not {"g", "a", "v"}.issubset(parsed_gav):
+        raise ValueError("GroupId, ArtifactId and Version are mandatory")
+    return parsed_gav
+
+
 class DeliveryArchiver(object):
-    """ Packages given resources to single zip archive. Resources are placed according to their types """
+    """ Packages given resources to single archive (zip by default). Resources are placed according to their types.
+    ArchiveContents of the last written archive is kept in contents attribute """
 
-    def __init__(self, work_fs, delivery_params):
-        """ :param work_fs: pyfilesystem2-like object. Will be used as work directory. Should be cleaned by calling code """
+    def __init__(self, work_fs, delivery_params, resource_tracker=None, cancellation=None, max_size=None,
+                 max_entries=None, reproducible=False, timestamp=None, base_archive=None, archive_format="zip",
+                 format_options=None):
+        """ :param work_fs: pyfilesystem2-like object. Will be used as work directory. Should be cleaned by calling code
+        :param resource_tracker: optional CachedResourceTracker. If given, resources are released
+        (as 'archive' consumer) right after they are written to archive
+        :param cancellation: optional CancellationToken checked while files are compressed
+        :param max_size: max total size in bytes of files put to archive. No limit if None
+        :param max_entries: max number of entries (files and directories) in archive. No limit if None
+        :param reproducible: make archive bytes depend on content only: files are sorted by path, all entries get
+        the same timestamp and delivery_info.json keys are sorted
+        :param timestamp: epoch time to set to entries of reproducible archive, e.g. date of delivery tag revision.
+        1980-01-01 (the earliest time zip supports) if None
+        :param base_archive: optional local path to previous zip delivery archive. Its compressed data is copied as is
+        for files with the same path, size and MD5, so only new and changed files are compressed
+        :param archive_format: name of archive format backend, one of ARCHIVE_FORMATS
+        :param format_options: optional dict of additional arguments of format backend, e.g. zstd level """
+        if archive_format not in ARCHIVE_FORMATS:
+            raise ArchivationError("Unknown archive format: %s; supported are %s"
+                                   % (archive_format, ", ".join(sorted(ARCHIVE_FORMATS))))
         self._work_fs = work_fs
         self._delivery_params = delivery_params
+        self._resource_tracker = resource_tracker
+        self._cancellation = cancellation
+        self._max_size = max_size
+        self._max_entries = max_entries
+        self._reproducible = reproducible
+        self._timestamp = timestamp
+        self._base_archive = base_archive
+        self._archive_format = archive_format
+        self._format_options = format_options or dict()
+        self.contents = None
 
     def build_archive(self, resources, svn_prefix):
-        """ Creates zip archive with given resources. Due to big size of archive result is returned via filename, not as content itself. 
+        """ Creates archive with given resources. Due to big size of archive result is returned via filename, not as content itself. 
         :param resources: list of DeliveryResource. Should be prepared for delivery already (e.g. wrapped)
         :param svn_prefix: URL of branch which SVN resources are belong to. Used to extract relative path in branch from full SVN url (specified in resource.location_stub.path) 
-        :return: path to built archive in work_fs. It is a random name, not artifactid-version.zip; caller should rename it itself """
+        :return: path to built archive in work_fs. It is a random name with extension of archive format, not
+        artifactid-version.zip; caller should rename it itself """
         logging.info("Start building the delivery from '%s'" % svn_prefix)
-        if not resources:
-            raise ArchivationError("Delivery archive cannot be empty")
+        resources_layout = self.check_plan(resources, svn_prefix)
 
         build_id = ''.join(random.sample(string.ascii_lowercase,10))
-        archive_name = "%s.zip" % build_id
+        archive_name = "%s.%s" % (build_id, ARCHIVE_FORMATS[self._archive_format].extension)
+        with self._work_fs.open(archive_name, "wb") as archive_file:
+            self.write_archive(resources_layout, archive_file)
+
+        return archive_name
+
+    def check_plan(self, resources, svn_prefix, get_size=_get_content_size):
+        """ Checks archive to be built against layout rules and size limits without reading resources content,
+        so it may be called for resolved resources before they are loaded
+        :param resources: list of DeliveryResource
+        :param svn_prefix: URL of branch which SVN resources are belong to
+        :param get_size: function returning size of resource content or None if it is unknown. Size of locally
+        stored content by default
+        :return: resource + name in archive
+        :raises: ArchivationError """
+        if not resources:
+            raise ArchivationError("Delivery archive cannot be empty")
         resources_layout = self._get_resources_layout(resources, svn_prefix)
+        if self._reproducible:
+            resources_layout.sort(key=lambda item: item[1])
+        entries = self._get_metadata_paths()
+        for resource, delivery_path in resources_layout:
+            entries.append(delivery_path)
+        entries_count = len(set(entries)) + len(get_parent_dirs(entries))
+        if len(set(entries)) < len(entries):
+            duplicates = [path for path, count in Counter(entries).items() if count > 1]
+            raise ArchivationError("Path %s already exists in delivery" % duplicates[0])
+        if self._max_entries and entries_count > self._max_entries:
+            raise ArchivationError("Delivery archive would contain %d entries, limit is %d"
+                                   % (entries_count, self._max_entries))
+
+        if self._max_size:
+            sizes = [get_size(resource) for resource, _ in resources_layout]
+            unknown = len([size for size in sizes if size is None])
+            total_size = sum(size for size in sizes if size is not None)
+            logging.info("Delivery archive content size: %d bytes (%d files of unknown size)" % (total_size, unknown))
+            if total_size > self._max_size:
+                raise ArchivationError("Delivery archive content would take %d bytes, limit is %d"
+                                       % (total_size, self._max_size))
+        return resources_layout
 
-        with TempFS(temp_dir=".") as temp_fs:
+    def write_archive(self, resources_layout, archive_file):
+        """ Streams resources to archive chunk by chunk, so memory used does not depend on file sizes.
+        Archive is written sequentially, digests of it and of every file are computed on the way
+        :param resources_layout: resource + name in archive, as returned by check_plan
+        :param archive_file: binary file object to write archive to. Needs not be seekable
+        :return: ArchiveContents """
+        digest_writer = DigestWriter(archive_file)
+        with self._get_writer(digest_writer) as writer:
             for resource, delivery_path in resources_layout:
-                self._write_resource(resource.resource_data, delivery_path, temp_fs)
+                self._check_cancelled()
+                with resource.resource_data.get_content() as content:
+                    size = _get_content_size(resource)
+                    writer.add_file(delivery_path, content, size if size is not None else _get_stream_size(content),
+                                    getattr(resource.resource_data, "md5", None))
+                if self._resource_tracker:
+                    self._resource_tracker.release(resource, "archive")
+            if self._base_archive:
+                logging.info("%d of %d files copied from base archive without recompression"
+                             % (len(writer.reused), len(resources_layout)))
 
-            DeliveryInfoDecoder(self._delivery_params, resources_layout).write_to_file(temp_fs, "delivery_info.json")
+            with MemoryFS() as metadata_fs:
+                DeliveryInfoDecoder(self._delivery_params, resources_layout,
+                                    sort_keys=self._reproducible).write_to_file(metadata_fs, "delivery_info.json")
+                if _is_copyright_enabled():
+                    DeliveryCopyrightAppender(self._delivery_params).write_to_file(metadata_fs, "Copyright")
+                for path in metadata_fs.listdir("/"):
+                    with metadata_fs.openbin(path) as content:
+                        writer.add_file(path, content, metadata_fs.getsize(path))
 
-            if os.getenv('COUNTERPARTY_ENABLED', 'false').lower() in ['true', 'yes', 'y']:
-                DeliveryCopyrightAppender(self._delivery_params).write_to_file(temp_fs, "Copyright")
+        citypes = dict((delivery_path, self._get_citype_code(resource)) for resource, delivery_path in resources_layout)
+        files = [ArchivedFile(entry.path, entry.size, entry.md5, citypes.get(entry.path)) for entry in writer.entries]
+        self.contents = ArchiveContents(digest_writer.hexdigest(), digest_writer.size, files)
+        logging.info("Delivery archive written: %d bytes, MD5 %s" % (self.contents.size, self.contents.md5))
+        return self.contents
 
-            with self._work_fs.open(archive_name, "wb") as zip_file:
-                write_zip(temp_fs, zip_file)
+    def _get_writer(self, archive_file):
+        mtime = max(self._timestamp or 0, ZIP_EPOCH) if self._reproducible else time.time()
+        writer_class = ARCHIVE_FORMATS[self._archive_format]
+        options = dict(self._format_options)
+        if writer_class is ZipWriter:
+            options.update(base_archive=self._base_archive, utc=self._reproducible)
+        elif self._base_archive:
+            logging.warning("Base archive is not used for %s format" % self._archive_format)
+        return writer_class(archive_file, mtime, self._cancellation, **options)
 
-        return archive_name
+    def _get_citype_code(self, resource):
+        citype = resource.location_stub.citype
+        return citype.code if citype else None
+
+    def _get_metadata_paths(self):
+        return ["delivery_info.json", "Copyright"] if _is_copyright_enabled() else ["delivery_info.json"]
 
     def _get_resources_layout(self, resources, svn_prefix):
         """
-        rule to put files of various types into archive
+        rule to put files of various types into archive. Resources are classified in a single pass
         :param resources:
         :param svn_prefix:
         :return: resource + name in archive
         """
-        check_loc_type = lambda code: lambda resource: resource.location_stub.location_type.code == code
-        from_svn, from_nexus, remaining = _split_by_conditions(resources, check_loc_type("SVN"),
-                                                               check_loc_type("NXS"))
-        svn_mapping = [(resource, self._get_svn_file_layout_path(resource, svn_prefix))
-                       for resource in from_svn]
+        svn_mapping, from_nexus, remaining = [], [], []
+        for resource in resources:
+            loc_type_code = resource.location_stub.location_type.code
+            if loc_type_code == "SVN":
+                svn_mapping.append((resource, self._get_svn_file_layout_path(resource, svn_prefix)))
+            elif loc_type_code == "NXS":
+                from_nexus.append(resource)
+            else:
+                remaining.append(resource)
         nexus_mapping = self._get_artifacts_layout(from_nexus)
         if remaining:
             resources_description = ", ".join([resource.location_stub.path for resource in remaining])
@@ -82,33 +232,30 @@ class DeliveryArchiver(object):
         """ Different artifacts are treated differently:
         1) release notes are placed to separate directory
         2) artifacts with same artifactid and version are placed to directories with name equal to their groupids 
-        3) other artifacts are placed at root of archive """
-        get_gav = lambda resource: resource.location_stub.path
-        make_basename = lambda resource: gav_to_filename(get_gav(resource))
-        make_separated_name = lambda resource: "/".join([parse_gav(get_gav(resource))["g"],
-                                                         make_basename(resource)])
-        make_unversioned_name = lambda resource: "%(a)s.%(p)s" % parse_gav(get_gav(resource))
-        basenames = map(make_basename, resources)
-        conflicting_names = [value for value, count in Counter(basenames).items()
-                             if count > 1]
-        is_conflicts = lambda resource: make_basename(resource) in conflicting_names
-        is_installer = lambda resource: re.match(r"^.+?:load_sql:.+?:ssp$", get_gav(resource))
-        releasenotes, conflicting, installers, regular = _split_by_conditions(resources, self._is_releasenotes,
-                                                                              is_conflicts, is_installer)
-        place_resources = lambda mapper, resources: [(resource, mapper(resource)) for resource in resources]
-        releasenotes_mapping = place_resources(self._get_releasenotes_location, releasenotes)
-        separated_mapping = place_resources(make_separated_name, conflicting)
-        installers_mapping = place_resources(make_unversioned_name, installers)
-        regular_mapping = place_resources(make_basename, regular)
-        return releasenotes_mapping + separated_mapping + installers_mapping + regular_mapping
+        3) other artifacts are placed at root of archive 
+        Each GAV is parsed once; basenames are counted before resources are classified.
+        Like before, only artifacts placed by their groupid, artifactid or packaging require full GAV """
+        parsed_gavs = [parse_gav(resource.location_stub.path, relaxed=True) for resource in resources]
+        basenames = [gav_to_filename(parsed_gav) for parsed_gav in parsed_gavs]
+        basenames_count = Counter(basenames)
+        releasenotes, conflicting, installers, regular = [], [], [], []
+        for resource, parsed_gav, basename in zip(resources, parsed_gavs, basenames):
+            if self._is_releasenotes(resource):
+                releasenotes.append((resource, self._get_releasenotes_location(_check_gav(parsed_gav))))
+            elif basenames_count[basename] > 1:
+                conflicting.append((resource, "/".join([_check_gav(parsed_gav)["g"], basename])))
+            elif _INSTALLER_GAV.match(resource.location_stub.path):
+                installers.append((resource, "%(a)s.%(p)s" % _check_gav(parsed_gav)))
+            else:
+                regular.append((resource, basename))
+        return releasenotes + conflicting + installers + regular
 
     def _is_releasenotes(self, resource):
         citype = resource.location_stub.citype.code # Locations.objects.get(loc_type__code="NXS", path=resource.location_stub.path).file.ci_type
         return citype == "RELEASENOTES"
 
-    def _get_releasenotes_location(self, resource):
+    def _get_releasenotes_location(self, parsed_gav):
         path_template = "Release Notes/Release notes %s-%s.%s"
-        parsed_gav = parse_gav(resource.location_stub.path)
         path = path_template % (parsed_gav["a"], parsed_gav["v"], parsed_gav["p"])
         return path
 
@@ -119,28 +266,10 @@ class DeliveryArchiver(object):
         ci_type = guesser.ci_type_by_path(full_path, loc_type_code)
         return ci_type
 
-    def _write_resource(self, resource_data, delivery_path, temp_fs):
-        if temp_fs.exists(delivery_path):
-            raise ArchivationError("Path %s already exists in delivery" % delivery_path)
-        resource_dir = os.path.dirname(delivery_path)
-        try:
-            temp_fs.makedirs(resource_dir)
-        except DirectoryExists:
-            pass
-        with resource_data.get_content() as content_handle:
-            temp_fs.upload(delivery_path, content_handle)
+    def _check_cancelled(self):
+        if self._cancellation:
+            self._cancellation.check()
 
 
 class ArchivationError(Exception):
     pass
-
-
-def _split_by_conditions(iterable, *conditions):
-    remaining = iterable
-    chunks = []
-    for condition in conditions:
-        chunk = list(filter(condition, remaining))
-        remaining = list(filter(lambda item: not condition(item), remaining))
-        chunks.append(chunk)
-    chunks.append(remaining)
-    return chunks
@@ -0,0 +1,59 @@
+import logging
+import os
+import uuid
+
+from .fast_copy import copy_file
+
+
+class BaseArchiveCache(object):
+    """ Keeps the latest delivery archive of each client artifact locally,
+    so the next delivery of the same artifact is built incrementally on top of it """
+
+    def __init__(self, cache_dir):
+        """ :param cache_dir: local directory to keep archives in. Is created if missing """
+        self._cache_dir = cache_dir
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def get(self, groupid, artifactid, download=None):
+        """ :param download: optional function writing previous delivery archive to given local path; returns False if
+        there is no previous delivery. Called once, if no archive is cached for the artifact yet
+        :return: local path to archive of previous delivery, None if there is no one """
+        archive_path = self._get_archive_path(groupid, artifactid)
+        if os.path.isfile(archive_path):
+            return archive_path
+        if not download:
+            return None
+
+        def _download(temp_path):
+            if not download(temp_path):
+                raise FileNotFoundError("No previous delivery of %s:%s" % (groupid, artifactid))
+
+        try:
+            self._put(archive_path, _download)
+        except Exception as err:
+            logging.info("No base archive for %s:%s: %s" % (groupid, artifactid, err))
+            return None
+        return archive_path
+
+    def put(self, groupid, artifactid, source_path):
+        """ Replaces cached archive of artifact with the new one
+        :param source_path: local path of built delivery archive """
+        self._put(self._get_archive_path(groupid, artifactid),
+                  lambda temp_path: copy_file(source_path, temp_path, allow_link=True))
+        logging.debug("Base archive of %s:%s updated" % (groupid, artifactid))
+
+    def _put(self, archive_path, write_function):
+        archive_dir = os.path.dirname(archive_path)
+        if not os.path.isdir(archive_dir):
+            os.makedirs(archive_dir, exist_ok=True)
+        temp_path = "%s.%s.tmp" % (archive_path, uuid.uuid4())
+        try:
+            write_function(temp_path)
+            os.replace(temp_path, archive_path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def _get_archive_path(self, groupid, artifactid):
+        return os.path.join(self._cache_dir, groupid, "%s.zip" % artifactid)
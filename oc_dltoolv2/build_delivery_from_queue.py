@@ -84,37 +84,88 @@ class BuildProcess(object):
         gav = parse_gav(gav_str)
 
         from .build_steps import BuildContext, collect_sources, calculate_and_check_checksums, build_delivery, upload_delivery
+        from .build_steps import ChecksumPipeline, get_archive_limits
         from .db_steps import save_delivery_to_db, delivery_is_in_db
+        from .known_checksums import find_known_checksums
+        from .pre_download_checks import PreDownloadValidator
+        from .disk_usage import CachedResourceTracker, DiskUsageMonitor
+        from .cancellation import CancellationToken
 
         if delivery_is_in_db(delivery_params):
             logging.info("Delivery is already in DB, skipping build")
             return ProcessStatus("build_process", "WARNING", "Delivery already built and stored in DB", None)
 
+        bounded_disk = os.getenv("BOUNDED_DISK_ENABLED", "false").lower() in ["true", "yes", "y"]
+        # tripped by the first stage failed in background, so work in flight in other threads stops at once
+        cancellation = CancellationToken()
         # exceptions at single steps are not processed - they should stop build process
         with TempFS(temp_dir=".") as workdir_fs:
-            # BuildContext is just a NamedTuple that has workdir_fs and conn_mgr
-            context = BuildContext(workdir_fs, self.conn_mgr)
-            resources = collect_sources(
-                delivery_params["mf_tag_svn"], delivery_list, context)
-            if self.distributives_api_client:
-                checksums_list = calculate_and_check_checksums(resources, self.distributives_api_client)
-            else:
-                checksums_list = None
-
-            if os.getenv('COUNTERPARTY_ENABLED', 'false').lower() in ['true', 'yes', 'y']:
-                logging.info("Checking inclusion of customer-specific artifacts")
-                DeliveryArtifactsChecker(delivery_params).check_artifacts_included(resources)
-            archive_path = build_delivery(resources, delivery_params, context)
-
-            upload_delivery(archive_path, gav, context)
-            delivery = save_delivery_to_db(delivery_params, resources, context)
-
-            # even if checksums registration will fail, delivery will still be created
-            logging.info("Starting registration process")
-            registration_process_res = self.registration_process(
-                    delivery, resources, workdir_fs, archive_path, gav, checksums_list)
-
-            return registration_process_res
+            disk_monitor = DiskUsageMonitor(workdir_fs.getsyspath("/"),
+                                            interval=float(os.getenv("DISK_USAGE_SAMPLE_INTERVAL", "1")))
+            try:
+                with disk_monitor:
+                    # BuildContext is just a NamedTuple that has workdir_fs and conn_mgr
+                    context = BuildContext(workdir_fs, self.conn_mgr)
+                    lookup_known_checksums = os.getenv("CHECKSUMS_DB_LOOKUP_ENABLED",
+                                                       "false").lower() in ["true", "yes", "y"]
+                    # checksums are calculated before archiving in bounded mode even without API check:
+                    # archived resources are removed, so registration can't read them afterwards
+                    calculate_checksums = bool(self.distributives_api_client) or bounded_disk
+                    resource_tracker = CachedResourceTracker() if bounded_disk else None
+                    check_artifacts = os.getenv('COUNTERPARTY_ENABLED', 'false').lower() in ['true', 'yes', 'y']
+                    validator = None
+                    if os.getenv("PRE_DOWNLOAD_CHECKS_ENABLED", "false").lower() in ["true", "yes", "y"]:
+                        validator = PreDownloadValidator(delivery_params, self.distributives_api_client,
+                                                         check_artifacts, lookup_known_checksums,
+                                                         **get_archive_limits())
+
+                    if calculate_checksums and os.getenv("CHECKSUM_PIPELINE_ENABLED",
+                                                         "false").lower() in ["true", "yes", "y"]:
+                        with ChecksumPipeline(self.distributives_api_client, lookup_known_checksums,
+                                              resource_tracker, consumers=["checksum", "archive"],
+                                              workers=int(os.getenv("CHECKSUM_PIPELINE_WORKERS", "4")),
+                                              cancellation=cancellation) as pipeline:
+                            resources = collect_sources(delivery_params["mf_tag_svn"], delivery_list, context,
+                                                        pipeline, validator, cancellation)
+                            checksums_list = pipeline.get_checksums()
+                        known_checksums = pipeline.known_checksums
+                        disk_monitor.sample()
+                    else:
+                        resources = collect_sources(delivery_params["mf_tag_svn"], delivery_list, context,
+                                                    validator=validator, cancellation=cancellation)
+                        disk_monitor.sample()
+                        if validator and lookup_known_checksums:
+                            known_checksums = validator.known_checksums
+                        else:
+                            known_checksums = find_known_checksums(resources) if lookup_known_checksums else None
+                        if resource_tracker:
+                            resource_tracker.track(resources, ["checksum", "archive"])
+                        if calculate_checksums:
+                            checksums_list = calculate_and_check_checksums(resources, self.distributives_api_client,
+                                                                           known_checksums, resource_tracker)
+                        else:
+                            checksums_list = None
+
+                    if check_artifacts and not validator:
+                        # lineup depends on paths only, so it is checked before download when validator is used
+                        logging.info("Checking inclusion of customer-specific artifacts")
+                        DeliveryArtifactsChecker(delivery_params).check_artifacts_included(resources)
+                    archive_path, archive_contents = build_delivery(resources, delivery_params, context,
+                                                                    resource_tracker, cancellation)
+                    disk_monitor.sample()
+
+                    upload_delivery(archive_path, gav, context, cancellation)
+                    delivery = save_delivery_to_db(delivery_params, resources, context)
+
+                    # even if checksums registration will fail, delivery will still be created
+                    logging.info("Starting registration process")
+                    registration_process_res = self.registration_process(
+                            delivery, resources, workdir_fs, archive_path, gav, checksums_list, known_checksums,
+                            archive_contents)
+
+                    return registration_process_res
+            finally:
+                logging.info("Peak disk usage of build: %.1f MB" % (disk_monitor.peak / 1024.0 / 1024.0))
 
     def build_delivery_from_tag(self, requested_tag=None):
         logging.info("Starting build from tag: %s", requested_tag)
@@ -147,7 +198,8 @@ class BuildProcess(object):
         logging.info("Build successful for tag %s" % requested_tag)
         return build_res
 
-    def registration_process(self, delivery, resources, workdir_fs, archive_path, gav, checksums_list):
+    def registration_process(self, delivery, resources, workdir_fs, archive_path, gav, checksums_list,
+                             known_checksums=None, archive_contents=None):
         from .register import register_delivery_content, register_delivery_resource
         registration_client = oc_checksumsq.checksums_interface.ChecksumsQueueClient()
         registration_client.setup(
@@ -163,10 +215,10 @@ class BuildProcess(object):
 
             logging.info("Registering delivery resources")
             for resource in resources:
-                register_delivery_resource(resource, registration_client, checksums_list)
+                register_delivery_resource(resource, registration_client, checksums_list, known_checksums)
 
             logging.info("Registering delivery content")
-            register_delivery_content(workdir_fs, archive_path, gav, registration_client)
+            register_delivery_content(workdir_fs, archive_path, gav, registration_client, archive_contents)
             registration_client.disconnect()
         except Exception as e:
             logging.exception(e)
@@ -1,27 +1,41 @@
+import hashlib
+import os
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait
 
 from oc_pyfs import SvnFS, NexusFS
-from fs import copy as fs_copy
 from fs.tempfs import TempFS
 
-from oc_sql_helpers.wrapper import PLSQLWrapper
+from .archive_formats import ZipWriter, TarZstWriter, get_archive_packaging
 from .archiver import DeliveryArchiver
-from .local_load import download_resource
+from .base_archive_cache import BaseArchiveCache
+from .cancellation import BuildCancelledError, CancellableReader
+from .content_cache import ContentCache
+from .db_steps import get_previous_delivery
+from .fast_copy import copy_fs_file, get_local_path, get_temp_dir
+from .known_checksums import find_known_checksums, get_resource_checksum
+from .local_load import download_resource, get_memory_pool
+from .nexus_download import NexusDownloader, get_published_sha1
 from .resolver import BuildRequestResolver
 from .resources import RequestContext
-from .wrapper import Wrapper
+from .svn_cache import SvnWorkingCopyCache
+from .svn_export import SvnBulkExporter
+from .wrap_cache import WrappedContentCache, get_wrap_tool_identity
+from .wrapper import Wrapper, BoundedWrapClient
 from .delivery_exceptions import DeliveryDeniedException
-from hashlib import md5
 import logging
 
 # Tuple representing working directory and ConnectionManager used to retrieve external connections
 BuildContext = namedtuple("BuildContext", ("local_fs", "conn_mgr"))
 
-def collect_sources(branch_url, delivery_list, context):
+def collect_sources(branch_url, delivery_list, context, pipeline=None, validator=None, cancellation=None):
     """ Collects source files included to delivery to local folder
     :param branch_url: URL of branch to load SVN files from
     :param delivery_list: DeliveryList instance
     :param context: BuildContext instance
+    :param pipeline: optional ChecksumPipeline to pass each resource to as soon as it is loaded
+    :param validator: optional PreDownloadValidator to check resolved resources with before loading them
+    :param cancellation: optional CancellationToken to stop loading with
     :return: list of DeliveryResource loaded locally """
     logging.info("Starting to collect sources from branch_url: %s", branch_url)
     local_fs, conn_mgr = context
@@ -34,87 +48,326 @@ def collect_sources(branch_url, delivery_list, context):
 
     logging.debug("Resolving delivery request using BuildRequestResolver")
     resources = BuildRequestResolver().resolve_request(delivery_list, request_context)
+    if validator:
+        validator.validate(resources, nexus_client, branch_fs.getsyspath("/"))
+    if pipeline:
+        pipeline.start(resources, validator.known_checksums if validator else None)
+
+    wc_cache = get_svn_wc_cache(svn_client)
+    if wc_cache:
+        logging.debug("Loading SVN resources from cached working copy")
+        resources = wc_cache.load_resources(resources, branch_fs, branch_url, local_fs, get_memory_pool())
+    elif os.getenv("SVN_BULK_EXPORT_ENABLED", "false").lower() in ["true", "yes", "y"]:
+        logging.debug("Exporting SVN resources in bulk")
+        exporter = SvnBulkExporter(branch_fs, svn_client, local_fs)
+        resources = exporter.export_resources(resources, delivery_list.svn_files)
+
+    nexus_downloader = get_nexus_downloader(nexus_client, cancellation)
 
     logging.debug("Downloading resources to local filesystem")
-    cached_resources = [download_resource(resource, local_fs)
-                        for resource in resources]
+    memory_pool = get_memory_pool()
+    cached_resources = []
+    for resource in resources:
+        if cancellation:
+            cancellation.check()
+        cached_resources.append(download_resource(resource, local_fs, nexus_downloader, memory_pool))
+        if pipeline:
+            pipeline.submit(cached_resources[-1])
     logging.info("Completed collecting sources. Total resources: %d", len(cached_resources))
     return cached_resources
 
-def build_delivery(resources, delivery_params, context):
+def get_svn_wc_cache(svn_client):
+    """ Creates SvnWorkingCopyCache if it is configured
+    :return: SvnWorkingCopyCache or None if SVN_WC_CACHE_DIR is not set """
+    if not os.getenv("SVN_WC_CACHE_DIR"):
+        return None
+    return SvnWorkingCopyCache(os.getenv("SVN_WC_CACHE_DIR"), svn_client,
+                               max_size=int(os.getenv("SVN_WC_CACHE_MAX_SIZE", "10240")) * 1024 * 1024,
+                               copies_per_client=int(os.getenv("SVN_WC_CACHE_PER_CLIENT", "2")))
+
+def get_nexus_downloader(nexus_client, cancellation=None):
+    """ Creates NexusDownloader if any of its optimizations is enabled
+    :param cancellation: optional CancellationToken to abort downloads with
+    :return: NexusDownloader or None if artifacts are to be read from NexusFS """
+    threshold = None
+    if os.getenv("MVN_RANGED_DOWNLOAD_ENABLED", "false").lower() in ["true", "yes", "y"]:
+        threshold = int(os.getenv("MVN_RANGED_DOWNLOAD_THRESHOLD", "256")) * 1024 * 1024
+    content_cache = None
+    if os.getenv("MVN_CONTENT_CACHE_DIR"):
+        content_cache = ContentCache(os.getenv("MVN_CONTENT_CACHE_DIR"),
+                                     max_size=int(os.getenv("MVN_CONTENT_CACHE_MAX_SIZE", "20480")) * 1024 * 1024)
+    if threshold is None and content_cache is None:
+        return None
+    return NexusDownloader(nexus_client, threshold=threshold,
+                           streams=int(os.getenv("MVN_RANGED_DOWNLOAD_STREAMS", "4")),
+                           content_cache=content_cache, cancellation=cancellation)
+
+def get_wrap_cache():
+    """ Creates WrappedContentCache if it is configured
+    :return: WrappedContentCache or None if WRAP_CACHE_DIR is not set or wrap tool is not found """
+    if not os.getenv("WRAP_CACHE_DIR"):
+        return None
+    tool_identity = get_wrap_tool_identity()
+    if not tool_identity:
+        logging.warning("Wrap tool is not found, wrapped content cache is not used")
+        return None
+    return WrappedContentCache(os.getenv("WRAP_CACHE_DIR"), tool_identity=tool_identity,
+                               max_size=int(os.getenv("WRAP_CACHE_MAX_SIZE", "1024")) * 1024 * 1024)
+
+def get_base_archive_cache():
+    """ Creates BaseArchiveCache if it is configured
+    :return: BaseArchiveCache or None if DELIVERY_BASE_CACHE_DIR is not set """
+    if not os.getenv("DELIVERY_BASE_CACHE_DIR"):
+        return None
+    return BaseArchiveCache(os.getenv("DELIVERY_BASE_CACHE_DIR"))
+
+
+def get_base_archive(base_cache, delivery_params, conn_mgr):
+    """ Finds archive of previous delivery of the same artifact, downloading it once if it is not cached
+    :return: local path to archive, None if there is no one """
+
+    def _download(target_path):
+        previous = get_previous_delivery(delivery_params)
+        if not previous:
+            return False
+        gav_str = "%s:%s:%s:zip" % (previous.groupid, previous.artifactid, previous.version)
+        logging.info("Downloading %s to build delivery incrementally" % gav_str)
+        nexus_client = conn_mgr.get_mvn_client("MVN", readonly=True)
+        with open(target_path, "wb") as target_file:
+            nexus_client.cat(gav_str, repo=os.getenv("MVN_DOWNLOAD_REPO"), stream=True, write_to=target_file)
+        return True
+
+    return base_cache.get(delivery_params["groupid"], delivery_params["artifactid"], _download)
+
+
+def get_archive_limits():
+    """ :return: DeliveryArchiver limits arguments configured; zero means no limit """
+    max_size = int(os.getenv("DELIVERY_MAX_SIZE", "0")) * 1024 * 1024
+    max_entries = int(os.getenv("DELIVERY_MAX_ENTRIES", "0"))
+    return dict(max_size=max_size or None, max_entries=max_entries or None)
+
+
+def get_archive_format(delivery_params):
+    """ :param delivery_params: delivery parameters; 'archive_format' one overrides DELIVERY_ARCHIVE_FORMAT setting
+    :return: DeliveryArchiver format arguments """
+    archive_format = delivery_params.get("archive_format") or os.getenv("DELIVERY_ARCHIVE_FORMAT", "zip")
+    format_options = dict()
+    if archive_format == TarZstWriter.extension:
+        format_options.update(level=int(os.getenv("DELIVERY_ZSTD_LEVEL", "3")),
+                              threads=int(os.getenv("DELIVERY_ZSTD_THREADS", "0")) or None)
+    return dict(archive_format=archive_format, format_options=format_options)
+
+
+def build_delivery(resources, delivery_params, context, resource_tracker=None, cancellation=None):
     """ Packages delivery resources into archive performing required obfuscation
     :param resources: DeliveryResource list
     :param delivery_params: delivery parameters (parsed as ConfigObj)
     :param context: BuildContext instance
-    :return: path to archive in local_fs """
+    :param resource_tracker: optional CachedResourceTracker to release resources with once they are archived
+    :param cancellation: optional CancellationToken to stop wrapping and archiving with
+    :return: path to archive in local_fs and its ArchiveContents """
     logging.info("Starting to build delivery with %d resources", len(resources))
     local_fs, conn_mgr = context
     svn_client = conn_mgr.get_svn_client("SVN")
     branch_fs = SvnFS.SvnFS(delivery_params["mf_tag_svn"], svn_client)
 
-    with TempFS(temp_dir=".") as workdir_fs:
+    with TempFS(temp_dir=get_temp_dir(local_fs)) as workdir_fs:
         logging.debug("Wrapping resources")
-        wrapper = Wrapper(PLSQLWrapper())
+        wrap_client = BoundedWrapClient(timeout=int(os.getenv("WRAP_TIMEOUT", "600")) or None, cancellation=cancellation)
+        wrapper = Wrapper(wrap_client, memory_pool=get_memory_pool(), work_fs=workdir_fs,
+                          cancellation=cancellation, workers=int(os.getenv("WRAP_WORKERS", "0")),
+                          wrap_cache=get_wrap_cache())
         wrapped_resources = wrapper.get_wrapped_resources(resources, branch_fs)
         svn_prefix = branch_fs.getsyspath("/")
         logging.debug("Creating delivery archive")
-        archiver = DeliveryArchiver(workdir_fs, delivery_params)
+        reproducible = _is_reproducible_archive_enabled()
+        archive_format = get_archive_format(delivery_params)
+        # only zip entries can be reused without recompression
+        base_cache = get_base_archive_cache() if archive_format["archive_format"] == ZipWriter.extension else None
+        archiver = DeliveryArchiver(workdir_fs, delivery_params, resource_tracker, cancellation,
+                                    reproducible=reproducible,
+                                    timestamp=get_revision_timestamp(branch_fs) if reproducible else None,
+                                    base_archive=get_base_archive(base_cache, delivery_params,
+                                                                  conn_mgr) if base_cache else None,
+                                    **get_archive_limits(), **archive_format)
         temp_archive_name = archiver.build_archive(wrapped_resources, svn_prefix)
+        if base_cache:
+            base_cache.put(delivery_params["groupid"], delivery_params["artifactid"],
+                           get_local_path(workdir_fs, temp_archive_name))
         logging.debug("Copying archive to local filesystem")
-        fs_copy.copy_file(workdir_fs, temp_archive_name, local_fs, temp_archive_name)
+        # workdir is removed right after, so archive may be linked instead of copied
+        copy_fs_file(workdir_fs, temp_archive_name, local_fs, temp_archive_name, allow_link=True)
 
     logging.info("Delivery build completed: %s", temp_archive_name)
-    return temp_archive_name
+    return temp_archive_name, archiver.contents
+
 
+def get_revision_timestamp(branch_fs):
+    """ :param branch_fs: SvnFS pointing to delivery tag
+    :return: epoch time of the last change of tag, None if it is unknown """
+    try:
+        change_history = branch_fs.getinfo("/", ["log_1"]).get("log_1", "change_history")
+    except Exception as err:
+        logging.warning("Unable to get revision date of %s: %s" % (branch_fs.getsyspath("/"), err))
+        return None
+    return change_history[0]["date"] if change_history else None
 
-def upload_delivery(archive_path, gav, context):
-    """ Uploads delivery archive to Nexus under given name
+
+def upload_delivery(archive_path, gav, context, cancellation=None):
+    """ Uploads delivery archive to Nexus under given name; packaging follows archive format.
+    Reproducible archive is not uploaded if the same content is published already
     :param archive_name: path to delivery archive in local_fs
     :param gav: NexusAPI's gav of delivery to save 
     :param context: BuildContext instance
+    :param cancellation: optional CancellationToken to abort upload with
     """
     logging.info("Starting upload of delivery archive: %s", archive_path)
     local_fs, conn_mgr = context
     upload_repo = conn_mgr.get_credential("MVN_UPLOAD_REPO")
     nexus_client = conn_mgr.get_mvn_client("MVN")
-    gav_str = "%s:%s:%s:zip" % tuple(gav[key] for key in ["g", "a", "v"])
+    gav_str = "%s:%s:%s:%s" % (gav["g"], gav["a"], gav["v"], get_archive_packaging(archive_path))
+    if _is_reproducible_archive_enabled() and _is_published(local_fs, archive_path, nexus_client, gav_str,
+                                                            upload_repo):
+        logging.info("Identical delivery is already uploaded as %s, upload skipped", gav_str)
+        return
     logging.debug("Uploading archive to Nexus with GAV: %s", gav_str)
     with local_fs.openbin(archive_path) as zip_file:
-        nexus_client.upload(gav_str, data=zip_file, repo=upload_repo)
+        data = CancellableReader(zip_file, cancellation) if cancellation else zip_file
+        nexus_client.upload(gav_str, data=data, repo=upload_repo)
     logging.info("Upload completed for: %s", archive_path)
 
-def calculate_and_check_checksums(resources, api_client):
+def _is_published(local_fs, archive_path, nexus_client, gav_str, upload_repo):
+    """ :return: True if artifact with the same sha1 as local archive is published under gav_str """
+    try:
+        url = nexus_client.gav_get_url(gav_str, repo=upload_repo)
+    except Exception as err:
+        logging.warning("Unable to get URL of %s: %s" % (gav_str, err))
+        return False
+    published_sha1 = get_published_sha1(nexus_client, url)
+    if not published_sha1:
+        return False
+    archive_sha1 = hashlib.sha1()
+    with local_fs.openbin(archive_path) as zip_file:
+        for chunk in iter(lambda: zip_file.read(1 * 1024 * 1024), b""):
+            archive_sha1.update(chunk)
+    logging.debug("Archive sha1: %s, published sha1: %s" % (archive_sha1.hexdigest(), published_sha1))
+    return archive_sha1.hexdigest() == published_sha1
+
+
+def _is_reproducible_archive_enabled():
+    return os.getenv("REPRODUCIBLE_ARCHIVE_ENABLED", "false").lower() in ["true", "yes", "y"]
+
+
+def calculate_and_check_checksums(resources, api_client, known_checksums=None, resource_tracker=None):
     """
     Calculate checksum for each file in resources list and check if the
     distributive is allowed for delivering using Distributives Mongo API
     :param resources: DeliveryResource list
-    :param api_client: DistributivesAPIClient object
+    :param api_client: DistributivesAPIClient object. If None, checksums are calculated only
+    :param known_checksums: optional dict returned by find_known_checksums; these resources are not hashed
+    :param resource_tracker: optional CachedResourceTracker to release resources with ('checksum' consumer)
     :return: list, paths and checksums within separate dicts
     """
     logging.info("Starting checksum calculation and distributive check")
-    calculated_checksums = []
-    for resource in resources:
-        location_stub, resource_data = resource
-        logging.debug("Calculating checksum for: %s", location_stub.path)
-
-        with resource_data.get_content() as content_handle:
-            hmd5 = md5()
-            while True:
-                chunk = content_handle.read(1 * 1024 * 1024)  # read in 1M chunks, 16M was too much
-                if not chunk: break
-                hmd5.update(chunk)
-
-            str_md5 = hmd5.hexdigest()
-            loc_type = str(location_stub.location_type).split(":")[0]
-
-            logging.debug("Checking allowance for checksum: %s", str_md5)
-            if not api_client.check_distributive_allowance(str_md5):
-                logging.error("Delivery denied for path: %s, checksum: %s", location_stub.path, str_md5)
-                raise DeliveryDeniedException("{} is forbidden for delivery".format(location_stub.path))
-    
-            calculated_checksums.append({"path": location_stub.path, "checksum": str_md5})
-            logging.debug("Checksum accepted: %s", str_md5)
+    calculated_checksums = [_calculate_and_check_checksum(resource, api_client, known_checksums, resource_tracker)
+                            for resource in resources]
 
     logging.info("Checksum calculation and validation completed. Total: %d", len(calculated_checksums))
     return calculated_checksums
 
+def _calculate_and_check_checksum(resource, api_client, known_checksums, resource_tracker):
+    location_stub = resource.location_stub
+    str_md5 = get_resource_checksum(resource, known_checksums)
+
+    if resource_tracker:
+        resource_tracker.release(resource, "checksum")
+
+    logging.debug("Checking allowance for checksum: %s", str_md5)
+    if api_client and not api_client.check_distributive_allowance(str_md5):
+        logging.error("Delivery denied for path: %s, checksum: %s", location_stub.path, str_md5)
+        raise DeliveryDeniedException("{} is forbidden for delivery".format(location_stub.path))
+
+    logging.debug("Checksum accepted: %s", str_md5)
+    return {"path": location_stub.path, "checksum": str_md5}
+
+
+class ChecksumPipeline(object):
+    """ Same as calculate_and_check_checksums, but each resource is hashed and checked in background
+    as soon as it is loaded by collect_sources. Check latency is hidden behind remaining downloads,
+    and denied distributive stops the build before they are finished. Used as context manager """
+
+    def __init__(self, api_client, lookup_known_checksums=False, resource_tracker=None, consumers=None, workers=4,
+                 cancellation=None):
+        """ :param api_client: DistributivesAPIClient object. If None, checksums are calculated only
+        :param lookup_known_checksums: whether to fetch checksums known to checksums DB when resources are resolved
+        :param resource_tracker: optional CachedResourceTracker to track loaded resources with
+        :param consumers: stages resources are tracked for; should include 'checksum'
+        :param workers: number of resources processed simultaneously
+        :param cancellation: optional CancellationToken. Tripped by failed check, so loading stops at once;
+            pending checks are skipped once it is tripped by other stage """
+        self._api_client = api_client
+        self._lookup_known_checksums = lookup_known_checksums
+        self._resource_tracker = resource_tracker
+        self._consumers = consumers or ["checksum"]
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="checksum")
+        self._futures = []
+        self._cancellation = cancellation
+        self.known_checksums = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type and self._cancellation:
+            # loading has failed - checks in progress are not needed anymore
+            self._cancellation.cancel(repr(exc_value))
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        if exc_type and issubclass(exc_type, BuildCancelledError):
+            # report check which has cancelled the build rather than cancellation itself
+            self._raise_failed()
+        return False
+
+    def start(self, resources, known_checksums=None):
+        """ Called by collect_sources when resources are resolved, before they are loaded
+        :param known_checksums: checksums already fetched from checksums DB; lookup is not repeated if given """
+        if known_checksums is not None:
+            self.known_checksums = known_checksums
+        elif self._lookup_known_checksums:
+            self.known_checksums = find_known_checksums(resources)
+
+    def submit(self, resource):
+        """ Called by collect_sources for each loaded resource
+        :raises: exception of already failed check, e.g. DeliveryDeniedException """
+        self._raise_failed()
+        if self._resource_tracker:
+            self._resource_tracker.track([resource], self._consumers)
+        self._futures.append(self._executor.submit(self._check, resource))
+
+    def get_checksums(self):
+        """ Waits for all submitted resources
+        :return: list of paths and checksums, same as calculate_and_check_checksums returns """
+        wait(self._futures)
+        self._raise_failed()
+        calculated_checksums = [future.result() for future in self._futures]
+        logging.info("Checksum calculation and validation completed. Total: %d", len(calculated_checksums))
+        return calculated_checksums
+
+    def _check(self, resource):
+        if self._cancellation:
+            self._cancellation.check()
+        try:
+            return _calculate_and_check_checksum(resource, self._api_client, self.known_checksums,
+                                                 self._resource_tracker)
+        except Exception as err:
+            if self._cancellation:
+                self._cancellation.cancel("checksum check of %s failed: %s" % (resource.location_stub.path, err))
+            raise
+
+    def _raise_failed(self):
+        """ Raises exception of failed check, if any. Checks skipped due to cancellation are not failures """
+        for future in self._futures:
+            if not future.done() or future.cancelled():
+                continue
+            if future.exception() and not isinstance(future.exception(), BuildCancelledError):
+                raise future.exception()
+
@@ -0,0 +1,96 @@
+import logging
+import threading
+from contextlib import contextmanager
+
+
+class BuildCancelledError(Exception):
+    pass
+
+
+class CancellationToken(object):
+    """ Shared by all stages of single build. Tripped when any stage fails, so work still in flight in other threads
+    (downloads, checksum workers, wrapping, compression, upload) stops at its next check instead of running to the end """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = dict()
+        self._next_handle = 0
+        self.reason = None
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def cancel(self, reason=None):
+        """ Trips the token. Only the first call has effect
+        :param reason: description of failure which caused cancellation """
+        with self._lock:
+            if self._event.is_set():
+                return
+            self.reason = reason
+            self._event.set()
+            callbacks = list(self._callbacks.values())
+            self._callbacks.clear()
+        logging.warning("Build cancelled: %s" % reason)
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as err:
+                logging.warning("Cancellation callback failed: %s" % err)
+
+    def check(self):
+        """ :raises: BuildCancelledError if token is tripped """
+        if self._event.is_set():
+            raise BuildCancelledError(self.reason)
+
+    def wait(self, timeout=None):
+        """ :return: True if token was tripped within timeout """
+        return self._event.wait(timeout)
+
+    def on_cancel(self, callback):
+        """ Registers function to call when token is tripped; it is called at once if token is tripped already
+        :return: handle to pass to remove_callback """
+        with self._lock:
+            if not self._event.is_set():
+                self._next_handle += 1
+                self._callbacks[self._next_handle] = callback
+                return self._next_handle
+        callback()
+        return None
+
+    def remove_callback(self, handle):
+        with self._lock:
+            self._callbacks.pop(handle, None)
+
+    @contextmanager
+    def killing(self, process, kill=None):
+        """ Kills child process if token is tripped while the block is executed
+        :param process: subprocess.Popen instance
+        :param kill: optional function to kill process with, e.g. together with its process group """
+        handle = self.on_cancel(kill or process.kill)
+        try:
+            yield process
+        finally:
+            self.remove_callback(handle)
+
+
+class CancellableReader(object):
+    """ File-like wrapper stopping reading (e.g. by upload) once token is tripped """
+
+    def __init__(self, source_file, cancellation):
+        self._source_file = source_file
+        self._cancellation = cancellation
+
+    def read(self, *args):
+        self._cancellation.check()
+        return self._source_file.read(*args)
+
+    def __getattr__(self, name):
+        return getattr(self._source_file, name)
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(1 * 1024 * 1024)
+            if not chunk: break
+            yield chunk
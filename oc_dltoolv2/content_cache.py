@@ -0,0 +1,98 @@
+import logging
+import os
+import re
+import uuid
+
+from .fast_copy import copy_file
+
+
+class ContentCache(object):
+    """ Persistent local storage of artifacts content addressed by md5.
+    Allows to skip downloading of artifact when its checksum (e.g. published by Nexus next to it) is already known locally.
+    Least recently used entries are removed when cache exceeds its size limit """
+
+    def __init__(self, cache_dir, max_size):
+        """ :param cache_dir: local directory to keep content in. Is created if missing
+        :param max_size: cache size limit in bytes """
+        self._cache_dir = cache_dir
+        self._max_size = max_size
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def get(self, md5):
+        """ :return: local path to content with given md5, None if it is not cached """
+        if not _is_md5(md5):
+            return None
+        blob_path = self._get_blob_path(md5)
+        if not os.path.isfile(blob_path):
+            return None
+        # mtime marks usage for eviction
+        try:
+            os.utime(blob_path, None)
+        except OSError as err:
+            logging.debug("Unable to touch %s: %s" % (blob_path, err))
+        return blob_path
+
+    def put(self, md5, source_path):
+        """ Adds local file to cache. Existing content is kept
+        :param md5: checksum of file content
+        :param source_path: local path of file to add """
+        if not _is_md5(md5):
+            raise ValueError("Not a md5 checksum: %s" % md5)
+        self._put(md5, lambda temp_path: copy_file(source_path, temp_path, allow_link=True))
+
+    def put_content(self, md5, content):
+        """ Same as put, but for content kept in memory
+        :param content: bytes """
+        if not _is_md5(md5):
+            raise ValueError("Not a md5 checksum: %s" % md5)
+
+        def _write(temp_path):
+            with open(temp_path, "wb") as temp_file:
+                temp_file.write(content)
+
+        self._put(md5, _write)
+
+    def _put(self, md5, write_function):
+        blob_path = self._get_blob_path(md5)
+        if os.path.isfile(blob_path):
+            return
+        blob_dir = os.path.dirname(blob_path)
+        if not os.path.isdir(blob_dir):
+            os.makedirs(blob_dir, exist_ok=True)
+        temp_path = "%s.%s.tmp" % (blob_path, uuid.uuid4())
+        write_function(temp_path)
+        os.replace(temp_path, blob_path)
+        logging.debug("Content %s added to cache" % md5)
+        self._evict(keep=blob_path)
+
+    def _evict(self, keep):
+        blobs = []
+        for dir_path, _, filenames in os.walk(self._cache_dir):
+            for filename in filter(_is_md5, filenames):  # skip temporary files of ongoing puts
+                blob_path = os.path.join(dir_path, filename)
+                try:
+                    stat = os.stat(blob_path)
+                except OSError:
+                    continue  # removed by other worker
+                blobs.append((stat.st_mtime, stat.st_size, blob_path))
+        total_size = sum(size for _, size, _ in blobs)
+        for _, size, blob_path in sorted(blobs):
+            if total_size <= self._max_size:
+                break
+            if blob_path == keep:
+                continue
+            logging.debug("Evicting %s from content cache" % blob_path)
+            try:
+                os.remove(blob_path)
+            except OSError:
+                pass
+            total_size -= size
+
+    def _get_blob_path(self, md5):
+        md5 = md5.lower()
+        return os.path.join(self._cache_dir, md5[:2], md5)
+
+
+def _is_md5(value):
+    return bool(value) and re.match(r"^[0-9a-fA-F]{32}$", value) is not None
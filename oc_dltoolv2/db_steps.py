@@ -25,6 +25,15 @@ def delivery_is_in_db(delivery_params):
     return bool(delivery_number)
 
 
+def get_previous_delivery(delivery_params):
+    """ :return: the latest Delivery of the same groupid and artifactid other than given one, None if there is no one """
+    previous = Delivery.objects.filter(Q(groupid=delivery_params["groupid"]) &
+                                       Q(artifactid=delivery_params["artifactid"])) \
+        .exclude(version=delivery_params["version"]).order_by("-id").first()
+    logging.debug("Previous delivery: %s" % (previous.version if previous else None))
+    return previous
+
+
 def save_delivery_to_db(delivery_params, resources, context):
     logging.info("Saving delivery to DB with GAV: %s:%s:%s",
                  delivery_params["groupid"],
@@ -8,7 +8,7 @@ from .delivery_info_helper import DeliveryInfoHelper
 #import urlparse
 
 class DeliveryInfoDecoder(DeliveryInfoHelper):
-    def __init__(self, delivery_params, delivery_resources, separators=None):
+    def __init__(self, delivery_params, delivery_resources, separators=None, sort_keys=False):
         """
         :param delivery_params: delivery parameters
         :type delivery_params: configObj
@@ -16,12 +16,15 @@ class DeliveryInfoDecoder(DeliveryInfoHelper):
         :type delivery_resources: ResourcesLayout
         :param separators: separators for JSON pretty-print
         :type separators: Tuple
+        :param sort_keys: write JSON keys sorted, so output does not depend on order they are added in
+        :type sort_keys: bool
         """
         logging.debug("Creating new DeliveryInfoDecoder instance")
 
         super(DeliveryInfoDecoder, self).__init__(delivery_params)
         self._delivery_resources = delivery_resources
         self._seps = separators
+        self._sort_keys = sort_keys
         self._output = dict()
 
         # set default separators for pretty-print
@@ -104,7 +107,7 @@ class DeliveryInfoDecoder(DeliveryInfoHelper):
         logging.debug("Attempting to write delivery info JSON to: '%s'" % dst_path)
         try:
             with dst_fs.open(dst_path, mode="w") as _fl_out:
-                _fl_out.write(json.dumps(self._output, sort_keys=False, 
+                _fl_out.write(json.dumps(self._output, sort_keys=self._sort_keys, 
                     indent=4, ensure_ascii=False, separators=self._seps))
                 logging.debug("Successfully wrote delivery info to '%s'" % dst_path)
         except Exception as e:
@@ -0,0 +1,120 @@
+import logging
+import os
+import threading
+
+
+class CachedResourceTracker(object):
+    """ Keeps track of build stages which still need locally cached content of resources.
+    Cached file is removed as soon as the last stage using it releases the resource,
+    so staged copies do not pile up until the whole build is over """
+
+    def __init__(self):
+        self._consumers = dict()  # location_stub -> set of stages which did not release it yet
+        self._locations = dict()  # location_stub -> list of FSLocation of cached content
+        self._lock = threading.Lock()
+
+    def track(self, resources, consumers):
+        """ Starts tracking locally cached resources. Resources which content is not a local file are ignored
+        :param resources: DeliveryResource list
+        :param consumers: names of stages which are going to read resources content """
+        with self._lock:
+            for resource in resources:
+                fs_location = resource.resource_data.get_fs_location()
+                if not fs_location:
+                    continue
+                self._consumers.setdefault(resource.location_stub, set()).update(consumers)
+                self._locations.setdefault(resource.location_stub, []).append(fs_location)
+
+    def release(self, resource, consumer):
+        """ Marks resource as not needed by consumer anymore; removes its content if nobody else needs it
+        :param resource: DeliveryResource or its location_stub. Resource may be changed (e.g. wrapped) since tracking """
+        location_stub = getattr(resource, "location_stub", resource)
+        with self._lock:
+            consumers = self._consumers.get(location_stub)
+            if consumers is None:
+                return
+            consumers.discard(consumer)
+            if consumers:
+                return
+            del self._consumers[location_stub]
+            fs_locations = self._locations.pop(location_stub)
+        for fs, location in fs_locations:
+            logging.debug("Removing %s: not needed by build anymore" % location)
+            if fs.exists(location):
+                fs.remove(location)
+
+    def release_all(self, consumer):
+        """ Marks all tracked resources as not needed by consumer, e.g. when stage is skipped """
+        with self._lock:
+            location_stubs = list(self._consumers.keys())
+        for location_stub in location_stubs:
+            self.release(location_stub, consumer)
+
+
+class DiskUsageMonitor(object):
+    """ Samples disk space occupied by directory in background and remembers the peak.
+    Hardlinked files are counted once. Used as context manager """
+
+    def __init__(self, path, interval=1.0):
+        """ :param path: local directory to watch
+        :param interval: seconds between samples """
+        self._path = path
+        self._interval = interval
+        self._stopped = threading.Event()
+        self._thread = None
+        self.peak = 0
+
+    def __enter__(self):
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="disk-usage-monitor", daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stopped.set()
+        self._thread.join()
+        return False
+
+    def sample(self):
+        """ Measures current usage immediately. May be called at stage boundaries not to miss short peaks
+        :return: current size in bytes """
+        size = get_dir_size(self._path)
+        self.peak = max(self.peak, size)
+        return size
+
+    def _run(self):
+        while True:
+            try:
+                self.sample()
+            except OSError as err:
+                logging.debug("Unable to measure %s: %s" % (self._path, err))
+            if self._stopped.wait(self._interval):
+                break
+
+
+def get_dir_size(path):
+    """ :return: total size of files in directory; hardlinks to the same file are counted once """
+    size = 0
+    seen_inodes = set()
+    pending = [path]
+    while pending:
+        try:
+            entries = list(os.scandir(pending.pop()))
+        except FileNotFoundError:
+            continue  # removed while walking
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(entry.path)
+                    continue
+                if not entry.is_file(follow_symlinks=False):
+                    continue
+                stat = entry.stat(follow_symlinks=False)
+            except FileNotFoundError:
+                continue
+            if stat.st_nlink > 1:
+                if (stat.st_dev, stat.st_ino) in seen_inodes:
+                    continue
+                seen_inodes.add((stat.st_dev, stat.st_ino))
+            size += stat.st_size
+    return size
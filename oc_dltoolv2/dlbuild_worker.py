@@ -13,6 +13,21 @@ class DLBuildWorker(DLBuildQueueServer):
         logging.debug('Reached DLBuildWorker.connect')
         self.pgq = PgQAPI.PgQAPI()
         logging.debug('self.pgq: [%s]' % self.pgq)
+        if os.getenv("PREFETCH_ENABLED", "false").lower() in ["true", "yes", "y"]:
+            self.start_cache_warmer()
+
+    def start_cache_warmer(self):
+        """ Starts background loading of content listed in prefetch hints to local caches.
+        Warmer has its own queue connection: PgQAPI connection is not shared between threads.
+        Called on every (re)connect, so warmer started before is kept running instead of starting one more """
+        if getattr(self, "cache_warmer", None) and self.cache_warmer.is_alive():
+            logging.debug("Cache warmer is running already")
+            return
+        from oc_connections.ConnectionManager import ConnectionManager
+        from .prefetch import CacheWarmer
+        conn_mgr = self._kwargs.get('conn_mgr') or ConnectionManager()
+        self.cache_warmer = CacheWarmer(PgQAPI.PgQAPI(), conn_mgr, sleep=int(self.sleep))
+        self.cache_warmer.start()
 
     def custom_run(self):
         logging.debug('Reached DLBuildWorker.run')
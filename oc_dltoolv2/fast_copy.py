@@ -0,0 +1,124 @@
+import errno
+import fcntl
+import logging
+import os
+import shutil
+
+from fs.copy import copy_file as fs_copy_file
+from fs.errors import NoSysPath
+
+# ioctl request cloning whole file on copy-on-write filesystems (btrfs, xfs), from linux/fs.h
+FICLONE = 0x40049409
+
+# errors meaning that copy method is not supported for these files, not that copying has failed
+_UNSUPPORTED_ERRORS = (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP, errno.EOPNOTSUPP, errno.EINVAL,
+                       errno.ENOSYS, errno.ENOTTY, errno.EBADF, errno.ETXTBSY)
+
+
+def copy_file(source_path, target_path, allow_link=False, chunk_size=1 * 1024 * 1024):
+    """ Copies local file the cheapest way supported by OS and filesystem: hardlink (if allowed),
+    reflink, in-kernel copy_file_range or sendfile, buffered copy if none of them works
+    :param source_path: OS path of file to copy
+    :param target_path: OS path of copy. Existing file is overwritten
+    :param allow_link: whether target may share content with source. Allowed only if neither file is modified in place
+    :return: name of copy method used """
+    if allow_link and not os.path.exists(target_path):
+        try:
+            os.link(source_path, target_path)
+            return "link"
+        except OSError as err:
+            if err.errno not in _UNSUPPORTED_ERRORS:
+                raise
+
+    with open(source_path, "rb") as source_file, open(target_path, "wb") as target_file:
+        source_fd, target_fd = source_file.fileno(), target_file.fileno()
+        size = os.fstat(source_fd).st_size
+        for method, copy_function in [("reflink", _clone), ("copy_file_range", _copy_file_range),
+                                      ("sendfile", _sendfile)]:
+            try:
+                copy_function(source_fd, target_fd, size)
+                return method
+            except (OSError, AttributeError) as err:
+                if isinstance(err, OSError) and err.errno not in _UNSUPPORTED_ERRORS:
+                    raise
+                logging.debug("%s is not supported for %s: %s" % (method, source_path, err))
+                # start from scratch if method failed in the middle
+                target_file.seek(0)
+                target_file.truncate()
+        source_file.seek(0)
+        shutil.copyfileobj(source_file, target_file, chunk_size)
+    return "buffered"
+
+
+def copy_fs_file(source_fs, source_path, target_fs, target_path, allow_link=False):
+    """ Copies file between pyfilesystem2-like objects, locally if both are backed by OS filesystem
+    :return: name of copy method used """
+    source_syspath = get_local_path(source_fs, source_path)
+    target_syspath = get_local_path(target_fs, target_path, exists=False)
+    if source_syspath and target_syspath:
+        return copy_file(source_syspath, target_syspath, allow_link=allow_link)
+    fs_copy_file(source_fs, source_path, target_fs, target_path)
+    return "fs"
+
+
+def upload_content(resource_data, target_fs, target_path, allow_link=False):
+    """ Copies content of ResourceData to target_fs. Local copy is made if content is a file on local disk
+    :return: name of copy method used """
+    fs_location = resource_data.get_fs_location()
+    if fs_location:
+        return copy_fs_file(fs_location.fs, fs_location.location, target_fs, target_path, allow_link=allow_link)
+    with resource_data.get_content() as content_handle:
+        target_fs.upload(target_path, content_handle)
+    return "upload"
+
+
+def get_local_path(fs_obj, path, exists=True):
+    """ :param exists: whether file should exist; otherwise only its parent directory should
+    :return: OS path of file in pyfilesystem2-like object, None if it is not backed by local disk """
+    try:
+        syspath = fs_obj.getsyspath(path)
+    except NoSysPath:
+        return None
+    # some filesystems (e.g. SvnFS) return URL instead of OS path
+    if not syspath or not os.path.isabs(syspath):
+        return None
+    if exists:
+        return syspath if os.path.isfile(syspath) else None
+    return syspath if os.path.isdir(os.path.dirname(syspath)) else None
+
+
+def get_temp_dir(fs_obj):
+    """ :return: OS path of pyfilesystem2-like object root to create temporary directories in; current dir if none """
+    try:
+        syspath = fs_obj.getsyspath("/")
+    except NoSysPath:
+        return "."
+    return syspath if os.path.isdir(syspath) else "."
+
+
+def _clone(source_fd, target_fd, size):
+    fcntl.ioctl(target_fd, FICLONE, source_fd)
+
+
+def _copy_file_range(source_fd, target_fd, size):
+    offset = 0
+    while offset < size:
+        copied = os.copy_file_range(source_fd, target_fd, size - offset, offset, offset)
+        if not copied: break
+        offset += copied
+    _check_copied(offset, size)
+
+
+def _sendfile(source_fd, target_fd, size):
+    offset = 0
+    while offset < size:
+        sent = os.sendfile(target_fd, source_fd, offset, size - offset)
+        if not sent: break
+        offset += sent
+    _check_copied(offset, size)
+
+
+def _check_copied(copied, size):
+    if copied != size:
+        # file was truncated while copying
+        raise OSError(errno.EIO, "%d of %d bytes copied" % (copied, size))
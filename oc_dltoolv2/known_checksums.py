@@ -0,0 +1,78 @@
+import logging
+from hashlib import md5
+
+from django.db import DatabaseError
+from oc_delivery_apps.checksums.models import Locations
+
+
+def find_known_checksums(resources, batch_size=500):
+    """ Fetches md5 checksums registered in checksums DB for locations of resources.
+    Nexus artifacts are matched by GAV, SVN files by path and revision; other locations are skipped
+    :param resources: DeliveryResource list
+    :param batch_size: max number of paths in single query
+    :return: dict of location key (see get_location_key) to md5 """
+    requested_keys = set(filter(None, (get_location_key(resource.location_stub) for resource in resources)))
+    paths = dict()
+    for loc_type, path, _ in requested_keys:
+        paths.setdefault(loc_type, set()).add(path)
+
+    known_checksums = dict()
+    ambiguous = set()
+    try:
+        for loc_type, type_paths in paths.items():
+            type_paths = sorted(type_paths)
+            for start in range(0, len(type_paths), batch_size):
+                records = Locations.objects.filter(
+                    loc_type__code=loc_type, path__in=type_paths[start:start + batch_size],
+                    file__checksums__cs_type__code="MD5").values_list("path", "revision", "file__checksums__checksum")
+                for path, revision, checksum in records:
+                    key = (loc_type, path, revision if loc_type == "SVN" else None)
+                    if key not in requested_keys:
+                        continue  # other revision of SVN file
+                    if known_checksums.setdefault(key, checksum) != checksum:
+                        ambiguous.add(key)
+    except DatabaseError as err:
+        logging.warning("Unable to fetch known checksums, all resources will be hashed: %s" % err)
+        return dict()
+
+    for key in ambiguous:
+        # same location registered for different content - it can't be trusted
+        logging.debug("Location %s has several checksums registered, ignored" % (key,))
+        known_checksums.pop(key)
+    logging.info("Found %d known checksums for %d resources" % (len(known_checksums), len(resources)))
+    return known_checksums
+
+
+def get_location_key(location_stub):
+    """ :return: tuple identifying location in checksums DB, None if location content is not fixed """
+    loc_type = str(location_stub.location_type).split(":")[0]
+    if loc_type == "NXS":
+        return (loc_type, location_stub.path, None)
+    if loc_type == "SVN" and location_stub.revision:
+        return (loc_type, location_stub.path, str(location_stub.revision))
+    return None
+
+
+def get_resource_checksum(resource, known_checksums=None):
+    """ Provides md5 of resource content. Checksum calculated while loading resource or known from DB is preferred,
+    content is read only if neither is available
+    :param resource: DeliveryResource
+    :param known_checksums: dict returned by find_known_checksums
+    :return: md5 hexdigest """
+    location_stub, resource_data = resource
+    checksum = getattr(resource_data, "md5", None)
+    if not checksum and known_checksums:
+        key = get_location_key(location_stub)
+        checksum = known_checksums.get(key) if key else None
+    if checksum:
+        logging.debug("Using known checksum of %s: %s" % (location_stub.path, checksum))
+        return checksum
+
+    logging.debug("Calculating checksum for: %s" % location_stub.path)
+    with resource_data.get_content() as content_handle:
+        hmd5 = md5()
+        while True:
+            chunk = content_handle.read(1 * 1024 * 1024)  # read in 1M chunks, 16M was too much
+            if not chunk: break
+            hmd5.update(chunk)
+    return hmd5.hexdigest()
@@ -1,25 +1,137 @@
+import logging
+import os
+import shutil
+import threading
 import uuid
+import weakref
+from io import BytesIO
 
-from .resources import DeliveryResource, ResourceData
+from .fast_copy import get_local_path, upload_content
+from .resources import DeliveryResource, ResourceData, FSLocation
 
 
-def download_resource(resource, work_fs):
+def download_resource(resource, work_fs, nexus_downloader=None, memory_pool=None):
     """ Caches resource locally for faster access 
     :param resource: DeliveryResource to be cached 
     :param work_fs: pyfilesystem2-like object used to place cached content 
+    :param nexus_downloader: optional NexusDownloader to load artifacts with instead of reading them from NexusFS
+    :param memory_pool: optional MemoryPool; small resources fitting it are kept in memory instead of work_fs
     :return: DeliveryResource with same location_stub and LocallyCachedResourceData with cached content """
-    cached_data = LocallyCachedResourceData(resource.resource_data, work_fs)
+    if isinstance(resource.resource_data, (LocallyCachedResourceData, MemoryCachedResourceData)):
+        # already loaded, e.g. by bulk SVN export
+        return resource
+    if nexus_downloader and resource.location_stub.location_type.code == "NXS":
+        cached_data = nexus_downloader.download(resource.location_stub.path, work_fs)
+    elif memory_pool:
+        cached_data = _cache_adaptively(resource.resource_data, work_fs, memory_pool)
+    else:
+        cached_data = LocallyCachedResourceData(resource.resource_data, work_fs)
     cached_resource = DeliveryResource(resource.location_stub, cached_data)
     return cached_resource
 
 
+def _cache_adaptively(resource_data, work_fs, memory_pool):
+    """ Keeps content in memory if it is small enough and pool has room for it, places it to work_fs otherwise """
+    fs_location = resource_data.get_fs_location()
+    local_path = get_local_path(*fs_location) if fs_location else None
+    if local_path:
+        # size of local file is known without reading it, large ones are copied by OS
+        size = os.path.getsize(local_path)
+        if memory_pool.reserve(size):
+            with open(local_path, "rb") as local_file:
+                content = local_file.read()
+            memory_pool.release(size - len(content))  # in case file was changed meanwhile
+            return MemoryCachedResourceData(content, memory_pool)
+        return LocallyCachedResourceData(resource_data, work_fs)
+
+    with resource_data.get_content() as content_handle:
+        head = content_handle.read(memory_pool.threshold + 1)
+        if len(head) <= memory_pool.threshold and memory_pool.reserve(len(head)):
+            return MemoryCachedResourceData(head, memory_pool)
+        cache_filename = "cache_%s" % uuid.uuid4()
+        with work_fs.openbin(cache_filename, "w") as cache_file:
+            cache_file.write(head)
+            shutil.copyfileobj(content_handle, cache_file, 1 * 1024 * 1024)
+    return LocallyCachedResourceData(None, work_fs, cache_filename=cache_filename)
+
+
+class MemoryPool(object):
+    """ Global budget of memory to keep small resources in. Keeping thousands of small files in memory
+    saves creation and removal of as many files on disk, while the cap keeps process memory bounded """
+
+    def __init__(self, max_size, threshold):
+        """ :param max_size: max total size of content kept in memory, bytes
+        :param threshold: max size of single content kept in memory, bytes """
+        self.max_size = max_size
+        self.threshold = threshold
+        self.used = 0
+        self._lock = threading.Lock()
+
+    def reserve(self, size):
+        """ :return: True if content of given size may be kept in memory; its size is accounted then """
+        if size > self.threshold:
+            return False
+        with self._lock:
+            if self.used + size > self.max_size:
+                return False
+            self.used += size
+            return True
+
+    def release(self, size):
+        with self._lock:
+            self.used -= size
+
+
+_memory_pool = None
+_memory_pool_lock = threading.Lock()
+
+
+def get_memory_pool():
+    """ :return: process-wide MemoryPool configured by RESOURCE_MEMORY_CACHE_* settings, None if disabled """
+    global _memory_pool
+    threshold = int(os.getenv("RESOURCE_MEMORY_CACHE_THRESHOLD", "0")) * 1024
+    if not threshold:
+        return None
+    with _memory_pool_lock:
+        if _memory_pool is None:
+            max_size = int(os.getenv("RESOURCE_MEMORY_CACHE_MAX_SIZE", "256")) * 1024 * 1024
+            logging.debug("Keeping resources up to %d bytes in memory, %d bytes total" % (threshold, max_size))
+            _memory_pool = MemoryPool(max_size, threshold)
+        return _memory_pool
+
+
+class MemoryCachedResourceData(ResourceData):
+    """ Content kept in memory. Its size is returned to pool when object is garbage collected """
+
+    def __init__(self, content, memory_pool, md5=None):
+        """ :param content: bytes, already reserved in memory_pool
+        :param memory_pool: MemoryPool content size is accounted in """
+        self._content = content
+        self.md5 = md5
+        weakref.finalize(self, memory_pool.release, len(content))
+
+    def get_content(self):
+        return BytesIO(self._content)
+
+
 class LocallyCachedResourceData(ResourceData):
 
-    def __init__(self, wrapped_data, cache_fs):
+    def __init__(self, wrapped_data, cache_fs, cache_filename=None, md5=None):
+        """ :param wrapped_data: ResourceData to be copied to cache. May be None if content is already placed to cache_fs
+        :param cache_fs: pyfilesystem2-like object to keep content in
+        :param cache_filename: path to already cached content in cache_fs. Random name is generated if omitted
+        :param md5: checksum of content if it is already known (e.g. calculated while downloading) """
         self.cache_fs = cache_fs
+        self.md5 = md5
+        if cache_filename:
+            self.cache_filename = cache_filename
+            return
         self.cache_filename = "cache_%s" % uuid.uuid4()
-        with wrapped_data.get_content() as content_handle:
-            cache_fs.upload(self.cache_filename, content_handle)
+        # no hardlinks: source may be a working copy which is modified later
+        upload_content(wrapped_data, cache_fs, self.cache_filename)
 
     def get_content(self):
         return self.cache_fs.openbin(self.cache_filename)
+
+    def get_fs_location(self):
+        return FSLocation(self.cache_fs, self.cache_filename)
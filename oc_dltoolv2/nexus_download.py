@@ -0,0 +1,277 @@
+import logging
+import os
+import re
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_EXCEPTION
+from hashlib import md5, sha1
+
+from fs.errors import NoSysPath
+
+from .fast_copy import copy_file, copy_fs_file
+from .local_load import LocallyCachedResourceData
+
+
+class NexusDownloader(object):
+    """ Downloads artifacts from Nexus to local cache.
+    If content cache is given, md5 published by Nexus next to artifact is fetched first, and artifact is taken
+    from cache (or from other artifact already downloaded by this build) on a hit, without downloading it again.
+    Artifacts larger than threshold are fetched by several byte ranges at once, which is faster than single stream
+    limited by per-connection throughput. Result of ranged download is verified against sha1 published by Nexus """
+
+    def __init__(self, nexus_client, threshold=None, streams=4, repo=None, content_cache=None,
+                 chunk_size=1 * 1024 * 1024, cancellation=None):
+        """ :param nexus_client: NexusAPI instance
+        :param threshold: min artifact size in bytes to download it by ranges. Ranged download is disabled if None
+        :param streams: number of ranges fetched simultaneously
+        :param repo: repository to download from; MVN_DOWNLOAD_REPO or NexusAPI default is used if omitted
+        :param content_cache: optional ContentCache to look artifacts up by published md5 before downloading
+        :param chunk_size: size of buffer to read response with
+        :param cancellation: optional CancellationToken; download in progress is aborted once it is tripped """
+        self._nexus = nexus_client
+        self._threshold = threshold
+        self._streams = streams
+        self._repo = repo or os.getenv("MVN_DOWNLOAD_REPO")
+        self._content_cache = content_cache
+        self._chunk_size = chunk_size
+        self._downloaded = dict()  # md5 -> (work_fs, cache_filename) of artifacts loaded by this downloader
+        self._cancellation = cancellation
+
+    def download(self, gav, work_fs):
+        """ Loads artifact to work_fs
+        :param gav: full GAV of artifact
+        :param work_fs: pyfilesystem2-like object to place artifact into
+        :return: LocallyCachedResourceData pointing to downloaded file """
+        cache_filename = "cache_%s" % uuid.uuid4()
+        url = self._nexus.gav_get_url(gav, repo=self._repo)
+
+        try:
+            target_path = work_fs.getsyspath(cache_filename)
+        except NoSysPath:
+            target_path = None
+
+        published_md5 = get_published_md5(self._nexus, url) if self._content_cache else None
+        if published_md5 and self._load_known_content(published_md5, work_fs, cache_filename):
+            logging.info("%s is already available locally (md5 %s), download skipped" % (gav, published_md5))
+            return LocallyCachedResourceData(None, work_fs, cache_filename=cache_filename, md5=published_md5)
+
+        try:
+            downloaded_md5 = self._download_content(gav, url, work_fs, cache_filename, target_path)
+        except Exception:
+            # partial content is useless, don't leave it in work_fs till the end of build
+            if work_fs.exists(cache_filename):
+                work_fs.remove(cache_filename)
+            raise
+
+        if published_md5 and published_md5 != downloaded_md5:
+            raise DownloadError("Checksum mismatch for %s: md5 %s published, %s downloaded"
+                                % (url, published_md5, downloaded_md5))
+        self._downloaded[downloaded_md5] = (work_fs, cache_filename)
+        if self._content_cache and target_path:
+            self._content_cache.put(downloaded_md5, target_path)
+
+        return LocallyCachedResourceData(None, work_fs, cache_filename=cache_filename, md5=downloaded_md5)
+
+    def _download_content(self, gav, url, work_fs, cache_filename, target_path):
+        """ :return: md5 of downloaded content """
+        size = self._get_ranged_size(url) if self._threshold is not None and target_path else None
+        # empty artifact has no byte range to request
+        if size and size >= self._threshold:
+            logging.info("Downloading %s (%d bytes) in %d streams" % (gav, size, self._streams))
+            self._download_ranges(url, size, target_path)
+            downloaded_md5, downloaded_sha1 = self._get_file_digests(target_path)
+            self._verify_sha1(url, downloaded_sha1)
+            return downloaded_md5
+
+        logging.debug("Downloading %s in single stream" % gav)
+        with work_fs.openbin(cache_filename, "w") as cache_file:
+            hashing_file = _HashingWriter(cache_file, self._cancellation)
+            self._nexus.cat(gav, repo=self._repo, stream=True, write_to=hashing_file)
+        return hashing_file.hmd5.hexdigest()
+
+    def _load_known_content(self, md5, work_fs, cache_filename):
+        """ Places content with given checksum to work_fs if it is available locally
+        :return: True if content was found """
+        if md5 in self._downloaded:
+            source_fs, source_filename = self._downloaded[md5]
+            if source_fs.exists(source_filename):
+                copy_fs_file(source_fs, source_filename, work_fs, cache_filename, allow_link=True)
+                return True
+
+        cached_path = self._content_cache.get(md5)
+        if not cached_path:
+            return False
+        try:
+            copy_file(cached_path, work_fs.getsyspath(cache_filename), allow_link=True)
+        except NoSysPath:
+            with open(cached_path, "rb") as cached_file:
+                work_fs.upload(cache_filename, cached_file)
+        self._downloaded[md5] = (work_fs, cache_filename)
+        return True
+
+    def _get_ranged_size(self, url):
+        """ :return: artifact size if server allows to download it by ranges, None otherwise """
+        try:
+            response = self._nexus.web.head(url, allow_redirects=True, headers={"Accept-Encoding": "identity"})
+        except Exception as err:
+            logging.warning("HEAD request for %s failed, single stream is used: %s" % (url, err))
+            return None
+        if response.status_code != 200:
+            logging.debug("HEAD %s returned %d" % (url, response.status_code))
+            return None
+        if response.headers.get("Accept-Ranges", "").lower() != "bytes":
+            logging.debug("Ranges are not supported for %s" % url)
+            return None
+        try:
+            return int(response.headers["Content-Length"])
+        except (KeyError, ValueError):
+            return None
+
+    def _download_ranges(self, url, size, target_path):
+        ranges = split_ranges(size, self._streams)
+        fd = os.open(target_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            try:
+                os.posix_fallocate(fd, 0, size)
+            except (AttributeError, OSError):
+                os.ftruncate(fd, size)  # fallocate is not supported by platform or filesystem
+            # set by the first failed range, so the others stop instead of downloading data to be thrown away
+            aborted = threading.Event()
+            with ThreadPoolExecutor(max_workers=len(ranges)) as pool:
+                futures = [pool.submit(self._download_range, url, byte_range, fd, aborted) for byte_range in ranges]
+                wait(futures, return_when=FIRST_EXCEPTION)
+                failed = [future for future in futures if future.done() and future.exception()]
+                if failed:
+                    aborted.set()
+                    for future in futures:
+                        future.cancel()
+                    raise failed[0].exception()
+        finally:
+            os.close(fd)
+
+    def _download_range(self, url, byte_range, fd, aborted):
+        start, end = byte_range
+        headers = {"Range": "bytes=%d-%d" % (start, end), "Accept-Encoding": "identity"}
+        response = self._nexus.web.get(url, headers=headers, stream=True)
+        try:
+            if response.status_code != 206:
+                raise DownloadError("Range %d-%d of %s was not returned: HTTP %d"
+                                    % (start, end, url, response.status_code))
+            offset = start
+            for chunk in response.iter_content(self._chunk_size):
+                if self._cancellation:
+                    self._cancellation.check()
+                if aborted.is_set():
+                    raise DownloadError("Range %d-%d of %s aborted" % (start, end, url))
+                os.pwrite(fd, chunk, offset)
+                offset += len(chunk)
+            if offset != end + 1:
+                raise DownloadError("Range %d-%d of %s is incomplete: %d bytes received"
+                                    % (start, end, url, offset - start))
+        finally:
+            response.close()
+
+    def _get_file_digests(self, target_path):
+        """ :return: md5 and sha1 of file, calculated in one pass """
+        hmd5 = md5()
+        hsha1 = sha1()
+        with open(target_path, "rb") as downloaded_file:
+            while True:
+                chunk = downloaded_file.read(self._chunk_size)
+                if not chunk: break
+                hmd5.update(chunk)
+                hsha1.update(chunk)
+        return hmd5.hexdigest(), hsha1.hexdigest()
+
+    def _verify_sha1(self, url, downloaded_sha1):
+        expected = get_published_sha1(self._nexus, url)
+        if not expected:
+            logging.warning("No sha1 published for %s, downloaded file is not verified" % url)
+            return
+        if downloaded_sha1 != expected:
+            raise DownloadError("Checksum mismatch for %s: sha1 %s expected, %s downloaded"
+                                % (url, expected, downloaded_sha1))
+        logging.debug("Verified sha1 of %s" % url)
+
+
+class DownloadError(Exception):
+    pass
+
+
+class _HashingWriter(object):
+    """ File-like wrapper calculating md5 of data written through it. Stops writing once cancellation is tripped """
+
+    def __init__(self, target_file, cancellation=None):
+        self._target_file = target_file
+        self._cancellation = cancellation
+        self.hmd5 = md5()
+
+    def write(self, data):
+        if self._cancellation:
+            self._cancellation.check()
+        self.hmd5.update(data)
+        return self._target_file.write(data)
+
+    def flush(self):
+        self._target_file.flush()
+
+
+def get_published_md5(nexus_client, url):
+    """ :param nexus_client: NexusAPI instance
+    :param url: URL of artifact
+    :return: md5 from checksum file published next to artifact, None if there is no one """
+    return _get_published_digest(nexus_client, url, "md5", 32)
+
+
+def get_published_sha1(nexus_client, url):
+    """ :param nexus_client: NexusAPI instance
+    :param url: URL of artifact
+    :return: sha1 from checksum file published next to artifact, None if there is no one """
+    return _get_published_digest(nexus_client, url, "sha1", 40)
+
+
+def _get_published_digest(nexus_client, url, algorithm, length):
+    try:
+        response = nexus_client.web.get(url + "." + algorithm)
+    except Exception as err:
+        logging.warning("Unable to get %s of %s: %s" % (algorithm, url, err))
+        return None
+    if response.status_code != 200:
+        logging.debug("No %s published for %s" % (algorithm, url))
+        return None
+    published = response.text.strip().split()[0].lower() if response.text.strip() else ""
+    return published if re.match(r"^[0-9a-f]{%d}$" % length, published) else None
+
+
+def get_published_size(nexus_client, url):
+    """ :param nexus_client: NexusAPI instance
+    :param url: URL of artifact
+    :return: artifact size reported by repository, None if it is unknown """
+    try:
+        response = nexus_client.web.head(url, allow_redirects=True, headers={"Accept-Encoding": "identity"})
+    except Exception as err:
+        logging.warning("Unable to get size of %s: %s" % (url, err))
+        return None
+    if response.status_code != 200:
+        logging.debug("HEAD %s returned %d" % (url, response.status_code))
+        return None
+    try:
+        return int(response.headers["Content-Length"])
+    except (KeyError, ValueError):
+        return None
+
+
+def split_ranges(size, parts):
+    """ Splits [0, size) into at most given number of inclusive byte ranges of nearly equal length.
+    There are no ranges for zero size """
+    if size <= 0:
+        return []
+    parts = max(1, min(parts, size))
+    part_size, remainder = divmod(size, parts)
+    ranges = []
+    start = 0
+    for index in range(parts):
+        length = part_size + (1 if index < remainder else 0)
+        ranges.append((start, start + length - 1))
+        start += length
+    return ranges
@@ -0,0 +1,106 @@
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from .archiver import DeliveryArchiver
+from .delivery_artifacts_checker import DeliveryArtifactsChecker
+from .delivery_exceptions import DeliveryDeniedException
+from .known_checksums import find_known_checksums, get_location_key
+from .nexus_download import get_published_md5, get_published_size
+
+
+class PreDownloadValidator(object):
+    """ Runs delivery checks needing paths or checksums only on resolved resources, before their content is loaded,
+    so denied delivery fails in seconds instead of after all sources are transferred.
+    Downloaded content is still checked as usual, so resources without remote checksum are covered too """
+
+    def __init__(self, delivery_params, api_client=None, check_artifacts=False, lookup_known_checksums=False,
+                 workers=8, max_size=None, max_entries=None):
+        """ :param delivery_params: dict-like delivery attributes
+        :param api_client: DistributivesAPIClient object. Allowance is not checked if None
+        :param check_artifacts: whether to check customer artifacts lineup with DeliveryArtifactsChecker
+        :param lookup_known_checksums: whether to take checksums from checksums DB
+        :param workers: number of remote checksums fetched and checked simultaneously
+        :param max_size: max total size in bytes of delivery archive content, counted by sizes known before download
+        :param max_entries: max number of entries in delivery archive """
+        self._delivery_params = delivery_params
+        self._max_size = max_size
+        self._max_entries = max_entries
+        self._api_client = api_client
+        self._check_artifacts = check_artifacts
+        self._lookup_known_checksums = lookup_known_checksums
+        self._workers = workers
+        self.known_checksums = None
+
+    def validate(self, resources, nexus_client=None, svn_prefix=None):
+        """ Called by collect_sources when resources are resolved
+        :param resources: DeliveryResource list, content is not loaded yet
+        :param nexus_client: NexusAPI instance to read checksums and sizes published for artifacts with
+        :param svn_prefix: URL of branch which SVN resources are belong to. Needed if archive limits are set
+        :raises: DeliveryDeniedException, ArchivationError if delivery archive would exceed limits """
+        logging.info("Validating %d resources before download" % len(resources))
+        if self._check_artifacts:
+            logging.info("Checking inclusion of customer-specific artifacts")
+            DeliveryArtifactsChecker(self._delivery_params).check_artifacts_included(resources)
+
+        if self._max_size or self._max_entries:
+            self._check_archive_plan(resources, nexus_client, svn_prefix)
+
+        if self._lookup_known_checksums:
+            self.known_checksums = find_known_checksums(resources)
+
+        if self._api_client:
+            self._check_allowance(resources, nexus_client)
+
+    def _check_allowance(self, resources, nexus_client):
+        with ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix="pre-download") as executor:
+            checksums = list(executor.map(lambda resource: self._get_remote_checksum(resource, nexus_client),
+                                          resources))
+            known = [(resource, checksum) for resource, checksum in zip(resources, checksums) if checksum]
+            logging.info("Checking allowance of %d resources with checksums known before download" % len(known))
+            allowed = list(executor.map(lambda item: self._api_client.check_distributive_allowance(item[1]), known))
+
+        for (resource, checksum), is_allowed in zip(known, allowed):
+            if not is_allowed:
+                logging.error("Delivery denied for path: %s, checksum: %s", resource.location_stub.path, checksum)
+                raise DeliveryDeniedException("{} is forbidden for delivery".format(resource.location_stub.path))
+
+    def _check_archive_plan(self, resources, nexus_client, svn_prefix):
+        logging.info("Checking delivery archive limits")
+        sizes = dict()
+        if self._max_size:
+            # SVN sources are not counted: their sizes are unknown without a request per file
+            with ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix="pre-download") as executor:
+                sizes = dict(zip([resource.location_stub for resource in resources],
+                                 executor.map(lambda resource: self._get_remote_size(resource, nexus_client),
+                                              resources)))
+        archiver = DeliveryArchiver(None, self._delivery_params, max_size=self._max_size,
+                                    max_entries=self._max_entries)
+        archiver.check_plan(resources, svn_prefix, lambda resource: sizes.get(resource.location_stub))
+
+    def _get_remote_size(self, resource, nexus_client):
+        """ :return: size of artifact content known without loading it, None if there is no one """
+        if resource.location_stub.location_type.code != "NXS" or not nexus_client:
+            return None
+        url = self._get_artifact_url(resource.location_stub.path, nexus_client)
+        return get_published_size(nexus_client, url) if url else None
+
+    def _get_artifact_url(self, gav, nexus_client):
+        try:
+            return nexus_client.gav_get_url(gav, repo=os.getenv("MVN_DOWNLOAD_REPO"))
+        except Exception as err:
+            logging.warning("Unable to get URL of %s: %s" % (gav, err))
+            return None
+
+    def _get_remote_checksum(self, resource, nexus_client):
+        """ :return: md5 of resource content known without loading it, None if there is no one """
+        key = get_location_key(resource.location_stub)
+        if not key:
+            return None
+        if self.known_checksums and key in self.known_checksums:
+            return self.known_checksums[key]
+        loc_type, path, _ = key
+        if loc_type != "NXS" or not nexus_client:
+            return None
+        url = self._get_artifact_url(path, nexus_client)
+        return get_published_md5(nexus_client, url) if url else None
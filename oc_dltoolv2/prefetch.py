@@ -0,0 +1,109 @@
+import logging
+import os
+import threading
+
+from fs.tempfs import TempFS
+
+PREFETCH_QUEUE = "cdt.dlbuild.prefetch"
+
+
+def compose_prefetch_hint(delivery_params):
+    """ Lists what build of delivery is going to download
+    :param delivery_params: dict-like delivery attributes, as saved to delivery tag
+    :return: dict with tag URL, GAVs and SVN paths (relative to tag) of delivery """
+    from oc_delivery_apps.dlmanager.DLModels import DeliveryList
+    delivery_list = DeliveryList(delivery_params["mf_delivery_files_specified"])
+    return {"tag": delivery_params["mf_tag_svn"],
+            "gavs": delivery_list.mvn_files,
+            "svn_paths": delivery_list.svn_files}
+
+
+class PgQPrefetchPublisher(object):
+    """ Publishes prefetch hints to PgQ queue read by CacheWarmer of build workers """
+
+    def __init__(self, pgq, queue_code=PREFETCH_QUEUE):
+        """ :param pgq: PgQAPI instance
+        :param queue_code: queue to publish hints to """
+        self._pgq = pgq
+        self._queue_code = queue_code
+
+    def publish(self, delivery_params):
+        """ Publishes hint for delivery which tag has just been created. Failures are logged only:
+        prefetch is an optimization and should never prevent delivery creation
+        :param delivery_params: dict-like delivery attributes """
+        try:
+            hint = compose_prefetch_hint(delivery_params)
+            message = self._pgq.compose_any_message("prefetch", hint)
+            self._pgq.enqueue_message(queue_code=self._queue_code, msg_text=message)
+            logging.info("Prefetch hint for %s published: %d artifacts, %d SVN paths"
+                         % (hint["tag"], len(hint["gavs"]), len(hint["svn_paths"])))
+        except Exception as err:
+            logging.warning("Unable to publish prefetch hint: %s" % err)
+
+
+class CacheWarmer(threading.Thread):
+    """ Background thread of build worker reading prefetch hints and loading artifacts to content cache
+    and delivery tags to SVN working copies cache, so builds find them locally when they start.
+    Does nothing for caches which are not configured """
+
+    def __init__(self, pgq, conn_mgr, sleep=10, queue_code=PREFETCH_QUEUE):
+        """ :param pgq: PgQAPI instance used by this thread only
+        :param conn_mgr: ConnectionManager to create SVN and Nexus clients with
+        :param sleep: seconds to wait when queue is empty """
+        super(CacheWarmer, self).__init__(name="cache-warmer", daemon=True)
+        self._pgq = pgq
+        self._conn_mgr = conn_mgr
+        self._sleep = sleep
+        self._queue_code = queue_code
+        self._stopped = threading.Event()
+
+    def stop(self):
+        self._stopped.set()
+
+    def run(self):
+        logging.info("Cache warmer started")
+        while not self._stopped.is_set():
+            try:
+                ds = self._pgq.new_msg_from_queue(self._queue_code)
+            except Exception as err:
+                logging.warning("Unable to read prefetch queue: %s" % err)
+                ds = None
+            if not ds:
+                self._stopped.wait(self._sleep)
+                continue
+
+            msg, msg_id = ds
+            try:
+                self.warm(msg[1][0])
+                self._pgq.msg_proc_end(msg_id)
+            except Exception as err:
+                logging.warning("Prefetch by message [%s] failed: %s" % (msg_id, err))
+                self._pgq.msg_proc_fail(msg_id, error_message=str(err))
+
+    def warm(self, hint):
+        """ Loads content listed in prefetch hint to local caches
+        :param hint: dict returned by compose_prefetch_hint """
+        from .build_steps import get_nexus_downloader, get_svn_wc_cache
+        logging.info("Prefetching %s" % hint["tag"])
+
+        if hint.get("svn_paths") and os.getenv("SVN_WC_CACHE_DIR"):
+            from oc_pyfs.SvnFS import _get_pysvn_url
+            svn_client = self._conn_mgr.get_svn_client("SVN")
+            # escaped the same way as the build escapes URLs it passes to SVN client
+            revision = svn_client.info2(_get_pysvn_url(hint["tag"]), recurse=False)[0][1].rev.number
+            # switching cached working copy to the tag is all the build will need
+            with get_svn_wc_cache(svn_client).working_copy(hint["tag"], revision):
+                pass
+
+        if hint.get("gavs") and os.getenv("MVN_CONTENT_CACHE_DIR"):
+            downloader = get_nexus_downloader(self._conn_mgr.get_mvn_client("MVN", readonly=True))
+            # artifacts stay in content cache after temporary copies are removed
+            with TempFS() as temp_fs:
+                for gav in hint["gavs"]:
+                    if self._stopped.is_set():
+                        break
+                    try:
+                        temp_fs.remove(downloader.download(gav, temp_fs).cache_filename)
+                    except Exception as err:
+                        logging.warning("Unable to prefetch %s: %s" % (gav, err))
+        logging.info("Prefetch of %s completed" % hint["tag"])
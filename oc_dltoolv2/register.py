@@ -1,17 +1,20 @@
 import logging
-from hashlib import md5
 
 from oc_checksumsq.checksums_interface import FileLocation
 from fs.errors import ResourceNotFound
 
+from .archive_formats import get_archive_packaging
+from .known_checksums import get_resource_checksum
+
 logger = logging.getLogger(__name__)
 
 
-def register_delivery_resource(resource, registration_client, checksums_list):
+def register_delivery_resource(resource, registration_client, checksums_list, known_checksums=None):
     """
     Registers (put checksumms into DB) single delivery source file. Should have proper path as it is used to determine CiType.
     It should be called before register_delivery_content in order to create correct File entries.
     :param resource: DeliveryResource item
+    :param known_checksums: optional dict returned by find_known_checksums, used if checksums_list has no checksum
     """
     location_stub, resource_data = resource
     logging.debug("Registering delivery resource for path: %s", location_stub.path)
@@ -27,13 +30,7 @@ def register_delivery_resource(resource, registration_client, checksums_list):
         checksum = precalculated_checksum
     else:
         logging.debug("No precalculated checksum found, calculating manually")
-        with resource_data.get_content() as content_handle:
-            hmd5 = md5()
-            while True:
-                chunk = content_handle.read(1 * 1024 * 1024)  # read in 1M chunks, 16M was too much
-                if not chunk: break
-                hmd5.update(chunk)
-            checksum = hmd5.hexdigest()
+        checksum = get_resource_checksum(resource, known_checksums)
     logging.debug("Calculated checksum: %s", checksum)
 
     file_location = FileLocation(location_stub.path, location_stub.location_type.code, location_stub.revision)
@@ -42,27 +39,46 @@ def register_delivery_resource(resource, registration_client, checksums_list):
     registration_client.register_checksum(file_location, checksum, citype=location_stub.citype.code)
     logging.info("Registered checksum for resource: %s", location_stub.path)
 
-def register_delivery_content(local_fs, archive_path, gav, registration_client):
+def register_delivery_content(local_fs, archive_path, gav, registration_client, archive_contents=None):
     """ 
     Registers delivery archive and files included in it.
     :param local_fs: pyfilesystem-like object
     :param archive_path: path to delivery archive in local_fs
     :param gav: NexusAPI's GAV to register under
+    :param archive_contents: optional ArchiveContents computed while archive was written. If given, checksums of
+    archive and its files are sent, so registration service needs not download and unpack the archive
     """
-    gav_str = "%s:%s:%s:zip" % tuple(gav[key] for key in ["g", "a", "v"])
+    gav_str = "%s:%s:%s:%s" % (gav["g"], gav["a"], gav["v"], get_archive_packaging(archive_path))
     logging.debug("Registering delivery content for GAV: %s", gav_str)
     try:
         if local_fs.getinfo(archive_path, namespaces=["details"]).size == 0:
             logging.error("File %s for %s is empty", archive_path, gav_str)
             raise RegisterError("File %s for %s is empty" % (archive_path, gav_str))
         file_location = FileLocation(gav_str, "NXS", None)
-        logging.debug("Registering file with location: %s", file_location)
-        registration_client.register_file(file_location, "DELIVERY", 1)
+        if archive_contents:
+            _register_archive_contents(file_location, archive_contents, registration_client)
+        else:
+            logging.debug("Registering file with location: %s", file_location)
+            registration_client.register_file(file_location, "DELIVERY", 1)
         logging.info("Registered delivery content for GAV: %s", gav_str)
     except ResourceNotFound:
         logging.error("File %s not found for %s", archive_path, gav_str)
         raise RegisterError("File %s not found for %s" % (archive_path, gav_str))
 
 
+def _register_archive_contents(file_location, archive_contents, registration_client):
+    """ Registers checksum of archive, then checksums of its files the way registration service stores members
+    of archive it unpacks itself: location of type ARCH is path inside the archive, and archive checksum given as
+    parent makes the service add inclusion by checksums. Archive is sent first, so parent is known by then.
+    Files of no specific CI type are registered as FILE, the type the service gives to unpacked members """
+    logging.debug("Registering checksum %s for location: %s", archive_contents.md5, file_location)
+    registration_client.register_checksum(file_location, archive_contents.md5, citype="DELIVERY")
+    for archived_file in archive_contents.files:
+        logging.debug("Registering checksum %s for %s in archive", archived_file.md5, archived_file.path)
+        registration_client.register_checksum(FileLocation(archived_file.path, "ARCH", None), archived_file.md5,
+                                              citype=archived_file.citype or "FILE", parent=archive_contents.md5)
+    logging.info("Registered checksums of %d files in delivery archive", len(archive_contents.files))
+
+
 class RegisterError(Exception):
     pass
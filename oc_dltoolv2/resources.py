@@ -26,6 +26,10 @@ class ResourceData(object):
         logging.debug("ResourceData.get_content: entering abstract method.")
         raise NotImplementedError("Subclasses must implement it")
 
+    def get_fs_location(self):
+        """ :return: FSLocation of file keeping resource content as is, None if content is not a file """
+        return None
+
 
 class FileBasedResourceData(ResourceData):
     """ Implements content retrieval via access to some pyFS file """
@@ -43,6 +47,9 @@ class FileBasedResourceData(ResourceData):
         logging.info("FileBasedResourceData.get_content: content handle obtained for location=%s", location)
         return content_handle
 
+    def get_fs_location(self):
+        return self.fs_location
+
 
 # Represents single file to be included into delivery
 DeliveryResource = namedtuple("DeliveryResource",
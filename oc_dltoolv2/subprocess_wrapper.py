@@ -1,9 +1,24 @@
 from sys import version_info
+import asyncio
+import errno
+import functools
+import os
+import signal
 import subprocess
+import tempfile
+import threading
+import time
 import logging
+from collections import namedtuple
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
 
 strtype = str
 
+# Result of command run by SubprocessWrapper.execute_bounded. Output is in files, not in memory
+CommandResult = namedtuple("CommandResult", ("args", "returncode", "stdout_path", "stderr_path",
+                                             "wall_time", "cpu_time", "timed_out"))
+
 class SubprocessWrapper(object):
     """
     Popen factory
@@ -45,17 +60,163 @@ class SubprocessWrapper(object):
         if fail and n != 0: raise(subprocess.CalledProcessError(n, ' '.join(args), None))
         return n
 
-    def _execute_and_get(self, args, options = {}, inputdata = None, fail = False):
+    def _execute_and_get(self, args, options = {}, inputdata = None, fail = False, timeout = None):
         """
         Executes a program and returns (stdoutdata, stderrdata, returncode) tuple
+        If timeout (seconds) is given, the program and all its children are killed when it expires
+        and subprocess.TimeoutExpired is raised
         """
         options = options.copy()
         options['stdout'] = subprocess.PIPE
         options['stderr'] = subprocess.PIPE
         if (inputdata != None): options['stdin'] = subprocess.PIPE
+        if timeout is not None: options['start_new_session'] = True
         proc = self._execute(args, options)
-        (stdoutdata,stderrdata) = proc.communicate(inputdata)
+        try:
+            (stdoutdata,stderrdata) = proc.communicate(inputdata, timeout=timeout)
+        except subprocess.TimeoutExpired:
+            _kill_group(proc)
+            proc.communicate()
+            raise
         (self.out, self.err, self.code) = (stdoutdata, stderrdata, proc.returncode)
         if fail and proc.returncode != 0: raise(subprocess.CalledProcessError(proc.returncode, ' '.join(args), stderrdata))
         return (stdoutdata, stderrdata, proc.returncode)
 
+    def execute_bounded(self, args, timeout = None, output_dir = None, max_output = 1024 * 1024, options = {},
+                        fail = False, cancellation = None):
+        """
+        Executes a program in its own process group and waits for it, without keeping its output in memory
+        :param args: list, program and its arguments
+        :param timeout: seconds to wait; the whole process group is killed when expired. No limit if None
+        :param output_dir: directory to write stdout and stderr files to; system temporary directory if None.
+            Files are left for caller to remove
+        :param max_output: max number of bytes saved from each of stdout and stderr, the rest is discarded
+        :param options: dict, additional Popen arguments
+        :param fail: raise subprocess.TimeoutExpired on timeout and subprocess.CalledProcessError on non-zero code
+        :param cancellation: optional CancellationToken; process group is killed once it is tripped
+        :return: CommandResult with wall-clock and CPU (user + system) time of the call
+        """
+        options = options.copy()
+        options['stdout'] = subprocess.PIPE
+        options['stderr'] = subprocess.PIPE
+        options.setdefault('stdin', subprocess.DEVNULL)
+        options['start_new_session'] = True
+        stdout_path = _make_output_file(output_dir, ".out")
+        stderr_path = _make_output_file(output_dir, ".err")
+
+        started = time.monotonic()
+        proc = self._execute(args, options)
+        copiers = [threading.Thread(target=_copy_bounded, args=(stream, path, max_output), daemon=True)
+                   for stream, path in [(proc.stdout, stdout_path), (proc.stderr, stderr_path)]]
+        for copier in copiers:
+            copier.start()
+        with cancellation.killing(proc, functools.partial(_kill_group, proc)) if cancellation else nullcontext():
+            returncode, cpu_time, timed_out = _wait_with_usage(proc, timeout)
+        for copier in copiers:
+            # grandchildren may still hold the pipes if the process was not killed
+            copier.join(None if not timed_out else 1)
+        wall_time = time.monotonic() - started
+
+        result = CommandResult(args, returncode, stdout_path, stderr_path, wall_time, cpu_time, timed_out)
+        (self.out, self.err, self.code) = (stdout_path, stderr_path, returncode)
+        logging.debug('Subprocess wrapper: %s finished with code %s in %.3fs (CPU %.3fs)%s',
+                      args[0], returncode, wall_time, cpu_time, ', timed out' if timed_out else '')
+        if cancellation:
+            cancellation.check()
+        if fail and timed_out: raise(subprocess.TimeoutExpired(' '.join(args), timeout))
+        if fail and returncode != 0: raise(subprocess.CalledProcessError(returncode, ' '.join(args)))
+        return result
+
+    async def execute_async(self, args, executor = None, **kwargs):
+        """
+        Same as execute_bounded, awaitable from asyncio event loop
+        :param executor: concurrent.futures executor to wait for the process in; default loop executor if None
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, functools.partial(self.execute_bounded, args, **kwargs))
+
+    async def execute_batch_async(self, commands, concurrency = 4, **kwargs):
+        """
+        Runs many commands with at most 'concurrency' of them at once
+        :param commands: list of args lists
+        :param kwargs: execute_bounded arguments common for all commands
+        :return: list of CommandResult in order of commands. With fail=True the first failure is raised
+            after all started commands are finished; commands not started yet are skipped
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+        failed = asyncio.Event()
+
+        async def _run(args):
+            async with semaphore:
+                if failed.is_set():
+                    return None
+                try:
+                    return await self.execute_async(args, executor = executor, **kwargs)
+                except Exception:
+                    failed.set()
+                    raise
+
+        with ThreadPoolExecutor(max_workers = max(1, concurrency), thread_name_prefix = "subprocess") as executor:
+            results = await asyncio.gather(*[_run(args) for args in commands], return_exceptions = True)
+        for result in results:
+            if isinstance(result, BaseException): raise result
+        return results
+
+    def execute_batch(self, commands, concurrency = 4, **kwargs):
+        """
+        Synchronous version of execute_batch_async, for callers without event loop
+        """
+        return asyncio.run(self.execute_batch_async(commands, concurrency, **kwargs))
+
+
+def _make_output_file(output_dir, suffix):
+    fd, path = tempfile.mkstemp(suffix = suffix, prefix = "subprocess_", dir = output_dir)
+    os.close(fd)
+    return path
+
+
+def _copy_bounded(stream, path, max_output, chunk_size = 64 * 1024):
+    """ Copies stream to file; data beyond max_output is read and discarded, so the process is never blocked """
+    written = 0
+    with stream, open(path, "wb") as output_file:
+        while True:
+            chunk = stream.read1(chunk_size) if hasattr(stream, "read1") else stream.read(chunk_size)
+            if not chunk: break
+            if written < max_output:
+                output_file.write(chunk[:max_output - written])
+            written += len(chunk)
+    if written > max_output:
+        logging.debug('Subprocess wrapper: %d bytes of output discarded', written - max_output)
+
+
+def _wait_with_usage(proc, timeout):
+    """ Reaps process collecting its resource usage; kills its process group on timeout
+    :return: (returncode, CPU time in seconds, whether timed out) """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    delay = 0.001
+    timed_out = False
+    while True:
+        try:
+            pid, status, usage = os.wait4(proc.pid, 0 if timed_out else os.WNOHANG)
+        except ChildProcessError:
+            # reaped elsewhere (e.g. by killed process cleanup); usage is unknown
+            return proc.wait(), 0.0, timed_out
+        if pid:
+            proc.returncode = os.waitstatus_to_exitcode(status)
+            return proc.returncode, usage.ru_utime + usage.ru_stime, timed_out
+        if deadline is not None and time.monotonic() >= deadline:
+            logging.warning('Subprocess wrapper: %s timed out after %ss, killing', proc.args, timeout)
+            _kill_group(proc)
+            timed_out = True
+            continue
+        time.sleep(delay)
+        delay = min(delay * 2, 0.05)
+
+
+def _kill_group(proc):
+    """ Kills process with all its children started in the same session """
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except OSError as err:
+        if err.errno != errno.ESRCH:
+            raise
@@ -0,0 +1,308 @@
+import fcntl
+import json
+import logging
+import os
+import re
+import shutil
+import time
+import uuid
+from contextlib import contextmanager
+
+import pysvn
+from fs.osfs import OSFS
+from oc_pyfs.SvnFS import _get_pysvn_url
+
+from .local_load import download_resource
+from .resources import DeliveryResource, FileBasedResourceData, FSLocation
+
+
+class SvnWorkingCopyCache(object):
+    """ Keeps working copies of client branches on local disk between builds.
+    Delivery tags of a client are mostly copies of a few long-lived branches, so switching a cached working copy
+    to the requested tag transfers only the files which differ. Each client gets a bounded number of working copies;
+    the least recently used ones are removed when the whole cache exceeds its size limit """
+
+    index_filename = "index.json"
+    lock_filename = "cache.lock"
+    locks_dirname = "locks"
+
+    def __init__(self, cache_dir, svn_client, max_size, copies_per_client=2):
+        """ :param cache_dir: local directory to keep working copies in. Is created if missing
+        :param svn_client: pysvn client
+        :param max_size: cache size limit in bytes; exceeded limit is checked after each build
+        :param copies_per_client: max number of working copies kept for the same client base URL """
+        self._cache_dir = cache_dir
+        self._svn_client = svn_client
+        self._max_size = max_size
+        self._copies_per_client = copies_per_client
+        os.makedirs(os.path.join(cache_dir, self.locks_dirname), exist_ok=True)
+
+    def load_resources(self, resources, svn_fs, branch_url, work_fs, memory_pool=None):
+        """ Caches SVN resources in work_fs reading them from working copy of branch instead of repository
+        :param resources: list of DeliveryResource resolved from svn_fs. Other resources are returned unchanged
+        :param svn_fs: SvnFS pointing to branch_url
+        :param branch_url: URL of branch resources belong to
+        :param work_fs: pyfilesystem2-like object to cache resources in
+        :param memory_pool: optional MemoryPool to keep small resources in memory instead of work_fs
+        :return: list of DeliveryResource in the same order; SVN ones are loaded to work_fs """
+        is_svn_resource = lambda resource: (resource.location_stub.location_type.code == "SVN"
+                                            and isinstance(resource.resource_data, FileBasedResourceData)
+                                            and resource.resource_data.fs_location.fs is svn_fs)
+        revisions = set(resource.location_stub.revision for resource in resources if is_svn_resource(resource))
+        if len(revisions) != 1:
+            logging.debug("No single SVN revision among resources, working copy is not used")
+            return resources
+
+        with self.working_copy(branch_url, revisions.pop()) as wc_path:
+            with OSFS(wc_path) as wc_fs:
+                read_from_wc = lambda resource: DeliveryResource(
+                    resource.location_stub,
+                    FileBasedResourceData(FSLocation(wc_fs, resource.resource_data.fs_location.location)))
+                # content is copied while working copy is locked: it may be switched by next build
+                loaded_resources = [download_resource(read_from_wc(resource), work_fs, memory_pool=memory_pool)
+                                    if is_svn_resource(resource) else resource
+                                    for resource in resources]
+        return loaded_resources
+
+    @contextmanager
+    def working_copy(self, branch_url, revision):
+        """ Provides working copy of branch at given revision. Working copy is locked while it is in use, so other
+        workers on the same host take another one or wait instead of switching it in the middle of reading.
+        Cache index is locked only while working copy is chosen and while its usage is recorded
+        :param branch_url: URL of branch or tag
+        :param revision: revision number to check out
+        :return: local path to the root of working copy """
+        revision = int(revision)
+        slot, is_ready, slot_lock, source = self._reserve_slot(branch_url)
+        try:
+            try:
+                self._prepare_slot(slot, branch_url, revision, is_ready, source)
+            except Exception:
+                with self._index_lock():
+                    index = self._read_index()
+                    self._remove_slot(index, slot)
+                    self._write_index(index)
+                raise
+            with self._index_lock():
+                index = self._read_index()
+                index[slot].update(revision=revision, ready=True)
+                self._write_index(index)
+            yield self._get_slot_path(slot)
+            size = _get_dir_size(self._get_slot_path(slot))
+            with self._index_lock():
+                index = self._read_index()
+                index[slot].update(last_used=time.time(), size=size)
+                self._evict(index, keep=slot)
+                self._write_index(index)
+        finally:
+            _unlock(slot_lock)
+
+    def _reserve_slot(self, branch_url):
+        """ Chooses working copy for branch and locks it: a free one of the same branch, the least recently used
+        free one of the client if it has as many as allowed, or a new one otherwise. New working copy is made from
+        a free one of the client if there is such, so only the difference is transferred
+        :return: slot name, whether it has content to be switched, its lock, and (slot, lock) of working copy
+        to copy new one from or None """
+        client_url = get_client_url(branch_url)
+        waited = None
+        while True:
+            with self._index_lock():
+                index = self._read_index()
+                client_slots = sorted((slot for slot, entry in index.items() if entry["client"] == client_url),
+                                      key=lambda slot: index[slot]["last_used"])
+                if waited:
+                    if waited[0] in index:
+                        return self._take_slot(index, waited[0], branch_url) + (waited[1], None)
+                    _unlock(waited[1])  # removed while we waited
+                    waited = None
+                    continue
+
+                candidates = [slot for slot in client_slots if index[slot]["url"] == branch_url]
+                if len(client_slots) >= self._copies_per_client:
+                    candidates.extend(slot for slot in client_slots if slot not in candidates)
+                for slot in candidates:
+                    slot_lock = self._lock_slot(slot, blocking=False)
+                    if slot_lock:
+                        return self._take_slot(index, slot, branch_url) + (slot_lock, None)
+
+                if len(client_slots) < self._copies_per_client:
+                    source = None
+                    for slot in reversed(client_slots):
+                        source_lock = self._lock_slot(slot, blocking=False) if index[slot].get("ready") else None
+                        if source_lock:
+                            source = (slot, source_lock)
+                            break
+                    slot = "wc_%s" % uuid.uuid4()
+                    slot_lock = self._lock_slot(slot, blocking=False)
+                    index[slot] = {"client": client_url, "url": branch_url, "revision": None, "ready": False,
+                                   "last_used": time.time(), "size": 0}
+                    self._write_index(index)
+                    return slot, False, slot_lock, source
+                waiting_slot = client_slots[0]
+
+            logging.info("All working copies of %s are in use, waiting for %s" % (client_url, waiting_slot))
+            waited = (waiting_slot, self._lock_slot(waiting_slot, blocking=True))
+
+    def _take_slot(self, index, slot, branch_url):
+        """ Marks locked working copy as being brought to another branch. Index lock is to be held
+        :return: slot name and whether it has content to be switched """
+        is_ready = index[slot].get("ready", False)
+        index[slot].update(url=branch_url, ready=False, last_used=time.time())
+        self._write_index(index)
+        return slot, is_ready
+
+    def _prepare_slot(self, slot, branch_url, revision, is_ready, source):
+        """ Brings locked working copy to requested state. Switch is tried first, checkout is the fallback
+        :param is_ready: True if working copy has content of some branch, False if it is new or left incomplete
+        :param source: optional (slot, lock) of working copy to copy from; its lock is released here """
+        path = self._get_slot_path(slot)
+        can_switch = is_ready and os.path.isdir(path)
+        if source:
+            try:
+                shutil.rmtree(path, ignore_errors=True)
+                shutil.copytree(self._get_slot_path(source[0]), path, symlinks=True)
+                can_switch = True
+            except OSError as err:
+                logging.warning("Unable to copy working copy %s: %s" % (source[0], err))
+            finally:
+                _unlock(source[1])
+
+        if can_switch and self._switch(path, branch_url, revision):
+            logging.info("Working copy %s switched to %s@%d" % (slot, branch_url, revision))
+            return
+        shutil.rmtree(path, ignore_errors=True)
+        self._checkout(path, branch_url, revision)
+        logging.info("Working copy %s checked out from %s@%d" % (slot, branch_url, revision))
+
+    def _switch(self, path, branch_url, revision):
+        """ Switches existing working copy. Local modifications (there should be none) are reverted first
+        :return: True if switch succeeded, False if working copy should be checked out from scratch """
+        svn_revision = pysvn.Revision(pysvn.opt_revision_kind.number, revision)
+        try:
+            self._svn_client.cleanup(path)
+            self._svn_client.revert(path, recurse=True)
+            self._svn_client.switch(path, _get_pysvn_url(branch_url), revision=svn_revision,
+                                    peg_revision=svn_revision, ignore_externals=True, ignore_ancestry=True)
+        except pysvn.ClientError as err:
+            logging.warning("Unable to switch %s to %s@%d: %s" % (path, branch_url, revision, err))
+            return False
+        return True
+
+    def _checkout(self, path, branch_url, revision):
+        svn_revision = pysvn.Revision(pysvn.opt_revision_kind.number, revision)
+        try:
+            self._svn_client.checkout(_get_pysvn_url(branch_url), path, recurse=True, revision=svn_revision,
+                                      peg_revision=svn_revision, ignore_externals=True)
+        except Exception:
+            shutil.rmtree(path, ignore_errors=True)
+            raise
+
+    def _evict(self, index, keep):
+        """ Removes least recently used working copies until cache fits max_size. Current one and ones in use
+        by other workers are never removed. Index lock is to be held """
+        total_size = sum(entry["size"] for entry in index.values())
+        for slot in sorted(index.keys(), key=lambda slot: index[slot]["last_used"]):
+            if total_size <= self._max_size:
+                break
+            if slot == keep:
+                continue
+            slot_lock = self._lock_slot(slot, blocking=False)
+            if not slot_lock:
+                continue
+            try:
+                total_size -= index[slot]["size"]
+                logging.info("Evicting working copy %s of %s (%d bytes)"
+                             % (slot, index[slot]["url"], index[slot]["size"]))
+                self._remove_slot(index, slot)
+            finally:
+                _unlock(slot_lock)
+
+    def _remove_slot(self, index, slot):
+        """ Removes working copy which is either locked by caller or not used by anyone """
+        shutil.rmtree(self._get_slot_path(slot), ignore_errors=True)
+        index.pop(slot, None)
+        try:
+            os.remove(self._get_lock_path(slot))
+        except FileNotFoundError:
+            pass
+
+    def _get_slot_path(self, slot):
+        return os.path.join(self._cache_dir, slot)
+
+    def _get_lock_path(self, slot):
+        return os.path.join(self._cache_dir, self.locks_dirname, slot + ".lock")
+
+    def _lock_slot(self, slot, blocking):
+        """ :return: open lock file of working copy, None if it is locked by someone else and blocking is False """
+        lock_file = open(self._get_lock_path(slot), "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return None
+        return lock_file
+
+    def _is_slot_busy(self, slot):
+        slot_lock = self._lock_slot(slot, blocking=False)
+        _unlock(slot_lock)
+        return slot_lock is None
+
+    @contextmanager
+    def _index_lock(self):
+        with open(os.path.join(self._cache_dir, self.lock_filename), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read_index(self):
+        index_path = os.path.join(self._cache_dir, self.index_filename)
+        if not os.path.exists(index_path):
+            return dict()
+        try:
+            with open(index_path) as index_file:
+                index = json.load(index_file)
+        except ValueError:
+            logging.warning("Working copies index is broken, cache is reset")
+            index = dict()
+        # working copies removed by someone else are forgotten, unless they are being checked out right now
+        for slot in list(index.keys()):
+            if not os.path.isdir(self._get_slot_path(slot)) and not self._is_slot_busy(slot):
+                self._remove_slot(index, slot)
+        # and ones left by interrupted builds are removed
+        for slot in os.listdir(self._cache_dir):
+            if slot.startswith("wc_") and slot not in index:
+                logging.debug("Removing orphaned working copy %s" % slot)
+                shutil.rmtree(self._get_slot_path(slot), ignore_errors=True)
+        return index
+
+    def _write_index(self, index):
+        index_path = os.path.join(self._cache_dir, self.index_filename)
+        with open(index_path + ".tmp", "w") as index_file:
+            json.dump(index, index_file)
+        os.replace(index_path + ".tmp", index_path)
+
+
+def get_client_url(branch_url):
+    """ Cuts tag or branch part of URL, e.g. svn://repo/country/client/tags/tag-1 -> svn://repo/country/client """
+    match = re.match(r"^(.+?)/(tags|branches|trunk)(/|$)", branch_url.rstrip("/"))
+    if match:
+        return match.group(1)
+    return os.path.dirname(branch_url.rstrip("/"))
+
+
+def _unlock(lock_file):
+    if lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+        lock_file.close()
+
+
+def _get_dir_size(path):
+    size = 0
+    for dir_path, _, filenames in os.walk(path):
+        for filename in filenames:
+            file_path = os.path.join(dir_path, filename)
+            if not os.path.islink(file_path):
+                size += os.path.getsize(file_path)
+    return size
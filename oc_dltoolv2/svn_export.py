@@ -0,0 +1,132 @@
+import logging
+import os
+import posixpath
+import uuid
+from collections import defaultdict
+
+import pysvn
+from oc_pyfs.SvnFS import _get_pysvn_url
+
+from .local_load import LocallyCachedResourceData
+from .resources import DeliveryResource, FileBasedResourceData
+
+
+class SvnBulkExporter(object):
+    """ Loads SVN resources of a delivery with a few 'svn export' calls instead of one 'svn cat' per file.
+    Requested directories are exported recursively; requested files are exported along with the other files of their folder """
+
+    def __init__(self, svn_fs, svn_client, work_fs):
+        """ :param svn_fs: SvnFS pointing to root of branch which resources were resolved from
+        :param svn_client: pysvn client used by svn_fs
+        :param work_fs: pyfilesystem2-like object backed by OS directory (e.g. TempFS). Exported trees are placed there """
+        self._svn_fs = svn_fs
+        self._svn_client = svn_client
+        self._work_fs = work_fs
+
+    def export_resources(self, resources, svn_paths):
+        """ Exports SVN resources to work_fs and binds them to local copies.
+        Resources which could not be exported are kept unchanged, so they are loaded one by one later
+        :param resources: list of DeliveryResource resolved from svn_fs. Non-SVN resources are kept unchanged
+        :param svn_paths: SVN part of delivery list as it was requested (files and directories relative to branch)
+        :return: list of DeliveryResource in the same order; exported ones carry LocallyCachedResourceData """
+        svn_resources = list(filter(self._is_exportable, resources))
+        if not svn_resources:
+            logging.debug("No SVN resources to export")
+            return resources
+
+        revisions = set(resource.location_stub.revision for resource in svn_resources)
+        if len(revisions) != 1:
+            logging.warning("SVN resources belong to different revisions (%s), bulk export skipped"
+                            % ", ".join(map(str, revisions)))
+            return resources
+        revision = revisions.pop()
+
+        relative_paths = [_get_relative_path(resource) for resource in svn_resources]
+        export_dir = "svn_export_%s" % uuid.uuid4()
+        self._work_fs.makedir(export_dir)
+        exported_paths = set()
+        for folder, recurse in get_export_roots(relative_paths, svn_paths):
+            if self._export_folder(folder, recurse, revision, export_dir):
+                exported_paths.update(path for path in relative_paths
+                                      if _is_covered(path, folder, recurse))
+
+        bind_resource = lambda resource: (self._bind_resource(resource, export_dir)
+                                          if self._is_exportable(resource)
+                                          and _get_relative_path(resource) in exported_paths
+                                          else resource)
+        exported_resources = list(map(bind_resource, resources))
+        logging.info("Exported %d of %d SVN resources" % (len(exported_paths), len(svn_resources)))
+        return exported_resources
+
+    def _is_exportable(self, resource):
+        if resource.location_stub.location_type.code != "SVN":
+            return False
+        resource_data = resource.resource_data
+        return isinstance(resource_data, FileBasedResourceData) and resource_data.fs_location.fs is self._svn_fs
+
+    def _export_folder(self, folder, recurse, revision, export_dir):
+        """ Exports single folder of branch at given revision. Errors are not fatal: files are loaded one by one then
+        :return: True if export succeeded """
+        url = self._svn_fs.getsyspath(folder)
+        target_path = self._work_fs.getsyspath(posixpath.join(export_dir, folder))
+        logging.debug("Exporting %s@%s to %s (recursive: %s)" % (url, revision, target_path, recurse))
+        parent_path = os.path.dirname(target_path.rstrip(os.sep))
+        if not os.path.isdir(parent_path):
+            os.makedirs(parent_path)
+        svn_revision = pysvn.Revision(pysvn.opt_revision_kind.number, int(revision))
+        try:
+            self._svn_client.export(_get_pysvn_url(url), target_path, force=True,
+                                    revision=svn_revision, peg_revision=svn_revision, ignore_externals=True,
+                                    depth=pysvn.depth.infinity if recurse else pysvn.depth.files)
+        except pysvn.ClientError as err:
+            logging.warning("Unable to export %s, its files will be loaded one by one: %s" % (url, err))
+            return False
+        return True
+
+    def _bind_resource(self, resource, export_dir):
+        cache_filename = posixpath.join(export_dir, _get_relative_path(resource))
+        if not self._work_fs.isfile(cache_filename):
+            logging.warning("%s is missing in export, it will be loaded separately" % resource.location_stub.path)
+            return resource
+        cached_data = LocallyCachedResourceData(None, self._work_fs, cache_filename=cache_filename)
+        return DeliveryResource(resource.location_stub, cached_data)
+
+
+def get_export_roots(relative_paths, svn_paths):
+    """ Selects folders to export so that each requested path is fetched with as few round-trips as possible.
+    Requested directories are exported recursively. Requested files are grouped by their folders;
+    folder is exported non-recursively if it contains several requested files, single files are left for 'svn cat'
+    :param relative_paths: paths of resolved SVN files relative to branch
+    :param svn_paths: SVN paths as they were requested in delivery list
+    :return: list of (folder, recurse) tuples """
+    files = set(relative_paths)
+    requested = sorted(set(path.strip("/") for path in svn_paths))
+    requested_dirs = [path for path in requested
+                      if path not in files and any(_is_covered(file_path, path, True) for file_path in files)]
+    # nested directories are exported along with their parents
+    top_dirs = [path for path in requested_dirs
+                if not any(_is_covered(path, other, True) for other in requested_dirs if other != path)]
+
+    folders_files = defaultdict(list)
+    for path in relative_paths:
+        if not any(_is_covered(path, folder, True) for folder in top_dirs):
+            folders_files[posixpath.dirname(path)].append(path)
+    shared_folders = sorted(folder for folder, folder_files in folders_files.items()
+                            if len(folder_files) > 1)
+
+    export_roots = [(folder, True) for folder in top_dirs] + [(folder, False) for folder in shared_folders]
+    logging.debug("Export roots: %s" % export_roots)
+    return export_roots
+
+
+def _is_covered(path, folder, recurse):
+    """ Checks if file at given path gets into export of folder """
+    if not folder:
+        return recurse or "/" not in path
+    if recurse:
+        return path.startswith(folder + "/")
+    return posixpath.dirname(path) == folder
+
+
+def _get_relative_path(resource):
+    return resource.resource_data.fs_location.location.strip("/")
@@ -4,14 +4,30 @@ from . import django_settings
 from oc_delivery_apps.checksums.models import LocTypes, CiRegExp, CiTypes
 from django import test
 from fs.memoryfs import MemoryFS
+from fs.tempfs import TempFS
 from fs.zipfs import ZipFS
 
+from ..archive_formats import _BaseArchive, _ZipStream, ArchiveFormatError
 from ..archiver import DeliveryArchiver, ArchivationError
+from ..disk_usage import CachedResourceTracker
+from ..local_load import download_resource
 from ..resources import ResourceData, DeliveryResource, LocationStub
 
 from ..test.mocks import mocked_requests
 from unittest import mock
+from collections import Counter, namedtuple
+from oc_cdtapi.NexusAPI import parse_gav, gav_to_filename
+import hashlib
+import logging
 import os
+import re
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import time
+import unittest
+import zipfile
 import django
 
 
@@ -21,6 +37,16 @@ class TestResourceData(ResourceData):
         return BytesIO("clean".encode("utf8"))
 
 
+class BytesResourceData(ResourceData):
+
+    def __init__(self, content, md5=None):
+        self._content = content
+        self.md5 = md5
+
+    def get_content(self):
+        return BytesIO(self._content)
+
+
 _branch_url = u"svn://repo/client/branch/"
 _environ = {
     'CLIENT_PROVIDER_URL': 'http://test-client-provider',
@@ -121,6 +147,181 @@ class ArchivationTestSuite(django.test.TransactionTestCase):
         self.assert_archived([_get_nexus_resource("com.ow:load_sql:v123:ssp"), ],
                                  [("/", ["load_sql.ssp", "delivery_info.json"])])
 
+    @mock.patch('requests.get', side_effect=mocked_requests)
+    def test_archived_resources_released(self, mocked_requests):
+        with TempFS() as work_fs:
+            resources = [download_resource(resource, work_fs)
+                         for resource in [_get_svn_resource("a.txt"), _get_svn_resource("b/c.txt"),
+                                          _get_nexus_resource("g:a:v:zip")]]
+            tracker = CachedResourceTracker()
+            tracker.track(resources, ["archive", "other"])
+            tracker.release(resources[0], "other")
+            archiver = DeliveryArchiver(work_fs, self._delivery_params(), tracker)
+            archive_path = archiver.build_archive(resources, _branch_url)
+            self.assert_archive_contains(archive_path, archiver, ("/", ["a.txt", "a-v.zip", "b", "delivery_info.json"]),
+                                         ("b", ["c.txt"]))
+            with work_fs.open(archive_path, mode="rb") as zip_file:
+                with ZipFS(zip_file) as zip_fs:
+                    self.assertEqual("clean", zip_fs.readtext("b/c.txt"))
+            cached_files = [resource.resource_data.cache_filename for resource in resources]
+            self.assertEqual([False, True, True], [work_fs.exists(path) for path in cached_files])
+
+    @mock.patch('requests.get', side_effect=mocked_requests)
+    def test_streamed_to_unseekable_file(self, mocked_requests):
+        target_file = UnseekableWriter()
+        layout = self._archiver.check_plan([_get_svn_resource("b/c.txt"), _get_nexus_resource("g:a:v:zip")],
+                                           _branch_url)
+        self._archiver.write_archive(layout, target_file)
+        with zipfile.ZipFile(BytesIO(target_file.getvalue())) as archive:
+            self.assertEqual(["b/", "b/c.txt", "a-v.zip", "delivery_info.json"], archive.namelist())
+            # sizes of streamed files follow their data
+            self.assertTrue(all(info.flag_bits & 0x08 for info in archive.infolist() if not info.is_dir()))
+            self.assertEqual(b"clean", archive.read("b/c.txt"))
+
+    @mock.patch('requests.get', side_effect=mocked_requests)
+    def test_digests_computed_while_written(self, mocked_requests):
+        target_file = UnseekableWriter()
+        contents = self._archiver.write_archive(
+            self._archiver.check_plan([_get_svn_resource("b/c.txt"), _get_nexus_resource("g:a:v:zip")], _branch_url),
+            target_file)
+        self.assertEqual(hashlib.md5(target_file.getvalue()).hexdigest(), contents.md5)
+        self.assertEqual(len(target_file.getvalue()), contents.size)
+        with zipfile.ZipFile(BytesIO(target_file.getvalue())) as archive:
+            expected = [(info.filename, info.file_size, hashlib.md5(archive.read(info)).hexdigest())
+                        for info in archive.infolist() if not info.is_dir()]
+        self.assertEqual(expected, [(item.path, item.size, item.md5) for item in contents.files])
+        self.assertEqual([None, "FILE", None], [item.citype for item in contents.files])
+
+    def test_limits_checked_without_content(self):
+        resources = [_get_svn_resource("a.txt"), _get_svn_resource("b/c.txt")]
+        get_size = lambda resource: 6
+        # a.txt, b/, b/c.txt, delivery_info.json
+        DeliveryArchiver(None, self._delivery_params(), max_entries=4).check_plan(resources, _branch_url)
+        with self.assertRaises(ArchivationError):
+            DeliveryArchiver(None, self._delivery_params(), max_entries=3).check_plan(resources, _branch_url)
+        DeliveryArchiver(None, self._delivery_params(), max_size=12).check_plan(resources, _branch_url, get_size)
+        with self.assertRaises(ArchivationError):
+            DeliveryArchiver(None, self._delivery_params(), max_size=11).check_plan(resources, _branch_url, get_size)
+
+    @mock.patch('requests.get', side_effect=mocked_requests)
+    def test_reproducible_archive(self, mocked_requests):
+        resources = [_get_svn_resource("b/c.txt"), _get_svn_resource("a.txt"), _get_nexus_resource("g:a:v:zip")]
+        archives = []
+        for ordered_resources in [resources, list(reversed(resources))]:
+            archiver = DeliveryArchiver(MemoryFS(), self._delivery_params(), reproducible=True, timestamp=1500000000)
+            target_file = BytesIO()
+            archiver.write_archive(archiver.check_plan(ordered_resources, _branch_url), target_file)
+            archives.append(target_file.getvalue())
+        self.assertEqual(archives[0], archives[1])
+        with zipfile.ZipFile(BytesIO(archives[0])) as archive:
+            self.assertEqual(["a-v.zip", "a.txt", "b/", "b/c.txt", "delivery_info.json"], archive.namelist())
+            self.assertEqual({(2017, 7, 14, 2, 40, 0)}, set(info.date_time for info in archive.infolist()))
+
+    @mock.patch('requests.get', side_effect=mocked_requests)
+    def test_unchanged_files_copied_from_base(self, mocked_requests):
+        get_resource = lambda path, content, md5=None: DeliveryResource(_get_svn_resource(path).location_stub,
+                                                                       BytesResourceData(content, md5))
+        with tempfile.TemporaryDirectory() as temp_dir:
+            base_path = os.path.join(temp_dir, "base.zip")
+            with open(base_path, "wb") as base_file:
+                self._archiver.write_archive(
+                    self._archiver.check_plan([get_resource("same.txt", b"same" * 1000),
+                                               get_resource("known.txt", b"known"),
+                                               get_resource("changed.txt", b"before"),
+                                               get_resource("resized.txt", b"before")], _branch_url), base_file)
+
+            archiver = DeliveryArchiver(MemoryFS(), self._delivery_params(), base_archive=base_path)
+            target_file = BytesIO()
+            with mock.patch.object(_BaseArchive, "iter_compressed", autospec=True,
+                                   side_effect=_BaseArchive.iter_compressed) as iter_compressed:
+                archiver.write_archive(archiver.check_plan([get_resource("same.txt", b"same" * 1000),
+                                                            get_resource("known.txt", b"known",
+                                                                         hashlib.md5(b"known").hexdigest()),
+                                                            get_resource("changed.txt", b"after!"),
+                                                            get_resource("resized.txt", b"resized"),
+                                                            get_resource("new.txt", b"new")], _branch_url),
+                                       target_file)
+
+        copied = [call[0][1].filename for call in iter_compressed.call_args_list]
+        self.assertTrue({"same.txt", "known.txt"} <= set(copied))
+        self.assertFalse({"changed.txt", "resized.txt", "new.txt"} & set(copied))
+        with zipfile.ZipFile(BytesIO(target_file.getvalue())) as archive:
+            self.assertIsNone(archive.testzip())
+            self.assertEqual(b"same" * 1000, archive.read("same.txt"))
+            self.assertEqual(b"known", archive.read("known.txt"))
+            self.assertEqual(b"after!", archive.read("changed.txt"))
+            self.assertEqual(b"resized", archive.read("resized.txt"))
+        digests = dict((item.path, (item.size, item.md5)) for item in archiver.contents.files)
+        self.assertEqual((4000, hashlib.md5(b"same" * 1000).hexdigest()), digests["same.txt"])
+        self.assertEqual((5, hashlib.md5(b"known").hexdigest()), digests["known.txt"])
+
+    @mock.patch('requests.get', side_effect=mocked_requests)
+    def test_incremental_archive_same_as_fresh(self, mocked_requests):
+        get_resource = lambda path, content: DeliveryResource(_get_svn_resource(path).location_stub,
+                                                             BytesResourceData(content))
+        get_archiver = lambda base_path=None: DeliveryArchiver(MemoryFS(), self._delivery_params(), reproducible=True,
+                                                               timestamp=1500000000, base_archive=base_path)
+        get_resources = lambda: [get_resource("same.txt", b"same" * 1000), get_resource("changed.txt", b"after!"),
+                                 get_resource("b/new.txt", b"new"), _get_nexus_resource("g:a:v:zip")]
+        with tempfile.TemporaryDirectory() as temp_dir:
+            base_path = os.path.join(temp_dir, "base.zip")
+            with open(base_path, "wb") as base_file:
+                archiver = get_archiver()
+                archiver.write_archive(archiver.check_plan([get_resource("same.txt", b"same" * 1000),
+                                                            get_resource("changed.txt", b"before"),
+                                                            _get_nexus_resource("g:a:v:zip")], _branch_url),
+                                       base_file)
+            archives = []
+            with mock.patch.object(_BaseArchive, "iter_compressed", autospec=True,
+                                   side_effect=_BaseArchive.iter_compressed) as iter_compressed:
+                for archiver in [get_archiver(), get_archiver(base_path)]:
+                    target_file = UnseekableWriter()
+                    archiver.write_archive(archiver.check_plan(get_resources(), _branch_url), target_file)
+                    archives.append(target_file.getvalue())
+
+        self.assertIn("same.txt", [call[0][1].filename for call in iter_compressed.call_args_list])
+        self.assertEqual(hashlib.sha1(archives[0]).hexdigest(), hashlib.sha1(archives[1]).hexdigest())
+        with zipfile.ZipFile(BytesIO(archives[1])) as archive:
+            self.assertIsNone(archive.testzip())
+
+    @unittest.skipUnless(shutil.which("zstd"), "zstd is not installed")
+    @mock.patch('requests.get', side_effect=mocked_requests)
+    def test_tar_zst_archive(self, mocked_requests):
+        resources = [_get_svn_resource("b/c.txt"), _get_svn_resource("a.txt"), _get_nexus_resource("g:a:v:zip")]
+        archives = []
+        for ordered_resources in [resources, list(reversed(resources))]:
+            archiver = DeliveryArchiver(MemoryFS(), self._delivery_params(), reproducible=True, timestamp=1500000000,
+                                        archive_format="tar.zst", format_options=dict(threads=2))
+            target_file = UnseekableWriter()
+            archiver.write_archive(archiver.check_plan(ordered_resources, _branch_url), target_file)
+            archives.append(target_file.getvalue())
+        self.assertEqual(archives[0], archives[1])
+
+        tar_data = subprocess.run(["zstd", "-d", "-c"], input=archives[0], stdout=subprocess.PIPE, check=True).stdout
+        with tarfile.open(fileobj=BytesIO(tar_data)) as archive:
+            self.assertEqual(["a-v.zip", "a.txt", "b", "b/c.txt", "delivery_info.json"], archive.getnames())
+            self.assertEqual({1500000000}, set(member.mtime for member in archive.getmembers()))
+            self.assertEqual(b"clean", archive.extractfile("b/c.txt").read())
+
+        with TempFS() as work_fs:
+            archiver = DeliveryArchiver(work_fs, self._delivery_params(), archive_format="tar.zst")
+            self.assertTrue(archiver.build_archive(resources, _branch_url).endswith(".tar.zst"))
+
+    @unittest.skipUnless(shutil.which("zstd"), "zstd is not installed")
+    def test_tar_zst_write_failure(self):
+        archiver = DeliveryArchiver(MemoryFS(), self._delivery_params(), archive_format="tar.zst")
+        # incompressible content larger than pipe buffers, so zstd output is written while input is still fed
+        resource = DeliveryResource(_get_svn_resource("random.bin").location_stub,
+                                    BytesResourceData(os.urandom(8 * 1024 * 1024)))
+        layout = archiver.check_plan([resource], _branch_url)
+        with self.assertRaises(ArchiveFormatError) as context:
+            archiver.write_archive(layout, FailingWriter())
+        self.assertIsInstance(context.exception.__cause__, OSError)
+
+    def test_unknown_format_failure(self):
+        with self.assertRaises(ArchivationError):
+            DeliveryArchiver(MemoryFS(), self._delivery_params(), archive_format="rar")
+
     def test_missing_rule_failure(self):
         LocTypes(code="TEST", name="TEST").save()
         with self.assertRaises(ArchivationError):
@@ -152,3 +353,131 @@ class ArchivationTestSuite(django.test.TransactionTestCase):
         self._archiver = DeliveryArchiver(MemoryFS(), _delivery_params)
         self.assert_archived([_get_nexus_resource("com.ow:load_sql:v123:ssp"), ],
                              [("/", ["load_sql.ssp", "delivery_info.json", "Copyright"])])
+
+
+def _split_by_conditions(iterable, *conditions):
+    remaining = iterable
+    chunks = []
+    for condition in conditions:
+        chunk = list(filter(condition, remaining))
+        remaining = list(filter(lambda item: not condition(item), remaining))
+        chunks.append(chunk)
+    chunks.append(remaining)
+    return chunks
+
+
+def _get_reference_layout(archiver, resources, svn_prefix):
+    """ Layout rules as they were implemented with repeated filtering, to compare new implementation with """
+    check_loc_type = lambda code: lambda resource: resource.location_stub.location_type.code == code
+    from_svn, from_nexus, remaining = _split_by_conditions(resources, check_loc_type("SVN"), check_loc_type("NXS"))
+    svn_mapping = [(resource, archiver._get_svn_file_layout_path(resource, svn_prefix)) for resource in from_svn]
+    get_gav = lambda resource: resource.location_stub.path
+    make_basename = lambda resource: gav_to_filename(get_gav(resource))
+    make_separated_name = lambda resource: "/".join([parse_gav(get_gav(resource))["g"], make_basename(resource)])
+    make_unversioned_name = lambda resource: "%(a)s.%(p)s" % parse_gav(get_gav(resource))
+    make_releasenotes_name = lambda resource: "Release Notes/Release notes %(a)s-%(v)s.%(p)s" % parse_gav(get_gav(resource))
+    conflicting_names = [value for value, count in Counter(map(make_basename, from_nexus)).items() if count > 1]
+    is_conflicts = lambda resource: make_basename(resource) in conflicting_names
+    is_installer = lambda resource: re.match(r"^.+?:load_sql:.+?:ssp$", get_gav(resource))
+    chunks = _split_by_conditions(from_nexus, archiver._is_releasenotes, is_conflicts, is_installer)
+    mappers = [make_releasenotes_name, make_separated_name, make_unversioned_name, make_basename]
+    nexus_mapping = [(resource, mapper(resource)) for mapper, chunk in zip(mappers, chunks) for resource in chunk]
+    return svn_mapping + nexus_mapping
+
+
+_StubType = namedtuple("_StubType", ["code"])
+
+
+class UnseekableWriter(object):
+    """ Output stream like a pipe: can't seek or tell position """
+
+    def __init__(self):
+        self._buffer = BytesIO()
+
+    def write(self, data):
+        return self._buffer.write(data)
+
+    def flush(self):
+        pass
+
+    def getvalue(self):
+        return self._buffer.getvalue()
+
+
+class FailingWriter(object):
+    """ Output stream of a full disk """
+
+    def write(self, data):
+        raise OSError("No space left on device")
+
+    def flush(self):
+        pass
+
+
+class ZipStreamTestSuite(unittest.TestCase):
+
+    def test_zip64_archive_readable(self):
+        target_file = UnseekableWriter()
+        stream = _ZipStream(target_file)
+        for index in range(70000):
+            stream.add_dir("d%d/" % index, (2020, 1, 1, 0, 0, 0), 0o755)
+        stream.add_file(u"unknown size \u0444.txt", (2020, 1, 1, 0, 0, 0), 0o644, BytesIO(b"data" * 1000), None)
+        stream.add_file("known size.txt", (2020, 1, 1, 0, 0, 0), 0o644, BytesIO(b"data"), 4)
+        stream.close()
+        with zipfile.ZipFile(BytesIO(target_file.getvalue())) as archive:
+            self.assertEqual(70002, len(archive.infolist()))
+            self.assertIsNone(archive.testzip())
+            self.assertEqual(b"data" * 1000, archive.read(u"unknown size \u0444.txt"))
+            self.assertEqual(0o644, archive.getinfo("known size.txt").external_attr >> 16)
+
+
+class LayoutBenchmarkTestSuite(unittest.TestCase):
+
+    def _get_resources(self, count):
+        svn, nxs = _StubType("SVN"), _StubType("NXS")
+        file_citype, releasenotes_citype = _StubType("FILE"), _StubType("RELEASENOTES")
+        resources = []
+        for index in range(count):
+            kind = index % 5
+            if kind == 0:
+                location = LocationStub(svn, None, "%sdir%d/file%d.sql" % (_branch_url, index % 50, index), "rev")
+            elif kind == 1:
+                location = LocationStub(nxs, file_citype, "g%d:a%d:v:zip" % (index, index % 500), None)
+            elif kind == 2:
+                location = LocationStub(nxs, file_citype, "g:load_sql:v%d:ssp" % index, None)
+            elif kind == 3:
+                location = LocationStub(nxs, releasenotes_citype, "RELEASENOTES:a%d:v:txt" % index, None)
+            else:
+                location = LocationStub(nxs, file_citype, "g:unique%d:v" % index, None)
+            resources.append(DeliveryResource(location, TestResourceData()))
+        return resources
+
+    def _measure(self, function, *args):
+        started = time.perf_counter()
+        result = function(*args)
+        return result, time.perf_counter() - started
+
+    def test_same_layout(self):
+        archiver = DeliveryArchiver(MemoryFS(), {})
+        resources = self._get_resources(10000)
+        expected, reference_time = self._measure(_get_reference_layout, archiver, resources, _branch_url)
+        actual, layout_time = self._measure(archiver._get_resources_layout, resources, _branch_url)
+        # timings depend on load of the host, so they are reported only; test_gav_parsed_once checks the work done
+        logging.info("Layout of %d resources: %.3fs, was %.3fs" % (len(resources), layout_time, reference_time))
+        self.assertEqual(expected, actual)
+
+    def test_gav_parsed_once(self):
+        archiver = DeliveryArchiver(MemoryFS(), {})
+        resources = self._get_resources(1000)
+        with mock.patch("oc_dltoolv2.archiver.parse_gav", wraps=parse_gav) as parse_mock:
+            archiver._get_resources_layout(resources, _branch_url)
+        self.assertEqual(800, parse_mock.call_count)
+
+    def test_short_gav_failure_unchanged(self):
+        archiver = DeliveryArchiver(MemoryFS(), {})
+        resources = [DeliveryResource(LocationStub(_StubType("NXS"), _StubType("FILE"), "g:a", None),
+                                      TestResourceData())]
+        with self.assertRaisesRegex(ValueError, "Artifactid and version"):
+            _get_reference_layout(archiver, resources, _branch_url)
+        with self.assertRaisesRegex(ValueError, "Artifactid and version"):
+            archiver._get_resources_layout(resources, _branch_url)
@@ -0,0 +1,48 @@
+import os
+import tempfile
+import unittest
+
+from ..base_archive_cache import BaseArchiveCache
+
+
+class BaseArchiveCacheTestSuite(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.cache = BaseArchiveCache(os.path.join(self.temp_dir.name, "cache"))
+        self.downloads = []
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def _download(self, content):
+        def _write(target_path):
+            self.downloads.append(target_path)
+            if content is None:
+                return False
+            with open(target_path, "wb") as target_file:
+                target_file.write(content)
+            return True
+        return _write
+
+    def _read(self, path):
+        with open(path, "rb") as archive_file:
+            return archive_file.read()
+
+    def test_downloaded_once(self):
+        self.assertIsNone(self.cache.get("g", "a"))
+        self.assertEqual(b"previous", self._read(self.cache.get("g", "a", self._download(b"previous"))))
+        self.assertEqual(b"previous", self._read(self.cache.get("g", "a", self._download(b"other"))))
+        self.assertEqual(1, len(self.downloads))
+
+    def test_no_previous_delivery(self):
+        self.assertIsNone(self.cache.get("g", "a", self._download(None)))
+        self.assertEqual([], os.listdir(os.path.join(self.temp_dir.name, "cache", "g")))
+
+    def test_replaced_by_built_archive(self):
+        self.cache.get("g", "a", self._download(b"previous"))
+        built_path = os.path.join(self.temp_dir.name, "built.zip")
+        with open(built_path, "wb") as built_file:
+            built_file.write(b"built")
+        self.cache.put("g", "a", built_path)
+        self.assertEqual(b"built", self._read(self.cache.get("g", "a")))
@@ -3,11 +3,16 @@ import django
 from django import test
 from unittest.mock import patch
 from io import BytesIO
+from fs.memoryfs import MemoryFS
+import hashlib
+import unittest
 from oc_delivery_apps.checksums.models import CiTypes, CsTypes, LocTypes, CiRegExp
-from ..build_steps import calculate_and_check_checksums
+from ..build_steps import BuildContext, calculate_and_check_checksums, ChecksumPipeline, upload_delivery
+from ..cancellation import CancellationToken
 from ..distributives_api_client import DistributivesAPIClient
 from ..resources import DeliveryResource, LocationStub, ResourceData
 from .mocks import mocked_requests
+from .test_nexus_download import MockNexusClient, MockSession
 from ..delivery_exceptions import DeliveryDeniedException
 
 
@@ -107,3 +112,78 @@ class BuildStepsTestSuite(django.test.TransactionTestCase):
         resources=[self.allowed_resource_with_forbidden_parent]
         with self.assertRaises(DeliveryDeniedException):
             checksums_list=calculate_and_check_checksums(resources, self.api)
+
+    @patch('requests.get', side_effect = mocked_requests)
+    def test_checksum_pipeline_success(self, mocked_requests):
+        resources = [self.svn_path_resource, self.allowed_resource, self.not_found_resource]
+        with ChecksumPipeline(self.api, workers=2) as pipeline:
+            for resource in resources:
+                pipeline.submit(resource)
+            checksums_list = pipeline.get_checksums()
+        self.assertEqual(calculate_and_check_checksums(resources, self.api), checksums_list)
+
+    @patch('requests.get', side_effect = mocked_requests)
+    def test_checksum_pipeline_denied_failure(self, mocked_requests):
+        with ChecksumPipeline(self.api, workers=1) as pipeline:
+            pipeline.submit(self.not_allowed_resource)
+            with self.assertRaises(DeliveryDeniedException):
+                pipeline.get_checksums()
+            # further loading is stopped by submit
+            with self.assertRaises(DeliveryDeniedException):
+                pipeline.submit(self.allowed_resource)
+
+    @patch('requests.get', side_effect = mocked_requests)
+    def test_checksum_pipeline_denied_cancels_build(self, mocked_requests):
+        cancellation = CancellationToken()
+        with self.assertRaises(DeliveryDeniedException):
+            with ChecksumPipeline(self.api, workers=1, cancellation=cancellation) as pipeline:
+                pipeline.submit(self.not_allowed_resource)
+                # loading stage notices cancellation, but failed check is reported
+                cancellation.wait(10)
+                cancellation.check()
+        self.assertTrue(cancellation.cancelled)
+
+
+class UploadingNexusClient(MockNexusClient):
+
+    def __init__(self, session):
+        super(UploadingNexusClient, self).__init__(session)
+        self.uploaded = []
+
+    def upload(self, gav, data=None, repo=None):
+        self.uploaded.append((gav, data.read()))
+
+
+class MockConnectionManager(object):
+
+    def __init__(self, nexus_client):
+        self._nexus_client = nexus_client
+
+    def get_credential(self, name):
+        return "upload-repo"
+
+    def get_mvn_client(self, name, readonly=False):
+        return self._nexus_client
+
+
+class UploadDeliveryTestSuite(unittest.TestCase):
+
+    def _upload(self, published_sha1, archive_path="archive.zip"):
+        local_fs = MemoryFS()
+        local_fs.writebytes(archive_path, b"archive")
+        nexus_client = UploadingNexusClient(MockSession(b"", sha1sum=published_sha1))
+        upload_delivery(archive_path, {"g": "g", "a": "a", "v": "v"},
+                        BuildContext(local_fs, MockConnectionManager(nexus_client)))
+        return nexus_client.uploaded
+
+    @patch.dict("os.environ", {"REPRODUCIBLE_ARCHIVE_ENABLED": "true"})
+    def test_identical_upload_skipped(self):
+        self.assertEqual([], self._upload(hashlib.sha1(b"archive").hexdigest()))
+        self.assertEqual([("g:a:v:zip", b"archive")], self._upload(hashlib.sha1(b"other").hexdigest()))
+        self.assertEqual([("g:a:v:zip", b"archive")], self._upload(None))
+
+    def test_uploaded_without_reproducible_mode(self):
+        self.assertEqual([("g:a:v:zip", b"archive")], self._upload(hashlib.sha1(b"archive").hexdigest()))
+
+    def test_packaging_follows_format(self):
+        self.assertEqual([("g:a:v:tar.zst", b"archive")], self._upload(None, "archive.tar.zst"))
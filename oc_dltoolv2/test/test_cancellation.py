@@ -0,0 +1,43 @@
+import subprocess
+import sys
+import threading
+import unittest
+from io import BytesIO
+
+from ..cancellation import BuildCancelledError, CancellableReader, CancellationToken
+
+
+class CancellationTokenTestSuite(unittest.TestCase):
+
+    def test_callbacks_called_once(self):
+        cancellation = CancellationToken()
+        calls = []
+        cancellation.on_cancel(lambda: calls.append("first"))
+        handle = cancellation.on_cancel(lambda: calls.append("removed"))
+        cancellation.remove_callback(handle)
+        cancellation.check()
+
+        cancellation.cancel("failed")
+        cancellation.cancel("failed again")
+        self.assertEqual(["first"], calls)
+        self.assertEqual("failed", cancellation.reason)
+        with self.assertRaises(BuildCancelledError):
+            cancellation.check()
+        # callback registered after cancellation is called at once
+        cancellation.on_cancel(lambda: calls.append("late"))
+        self.assertEqual(["first", "late"], calls)
+
+    def test_child_process_killed(self):
+        cancellation = CancellationToken()
+        process = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(60)"])
+        with cancellation.killing(process):
+            threading.Timer(0.1, cancellation.cancel, ["test"]).start()
+            self.assertNotEqual(0, process.wait(timeout=10))
+
+    def test_reader_stopped(self):
+        cancellation = CancellationToken()
+        reader = CancellableReader(BytesIO(b"content"), cancellation)
+        self.assertEqual(b"con", reader.read(3))
+        cancellation.cancel("test")
+        with self.assertRaises(BuildCancelledError):
+            reader.read()
@@ -0,0 +1,51 @@
+import os
+import unittest
+
+from fs.tempfs import TempFS
+
+from ..disk_usage import CachedResourceTracker, DiskUsageMonitor, get_dir_size
+from ..resources import DeliveryResource, FileBasedResourceData, FSLocation, LocationStub
+
+
+class DiskUsageTestSuite(unittest.TestCase):
+
+    def setUp(self):
+        self.work_fs = TempFS()
+
+    def tearDown(self):
+        self.work_fs.close()
+
+    def _resource(self, path):
+        self.work_fs.writebytes(path, b"content")
+        location = LocationStub("NXS", None, path, None)
+        return DeliveryResource(location, FileBasedResourceData(FSLocation(self.work_fs, path)))
+
+    def test_removed_after_last_consumer(self):
+        first, second = self._resource("first"), self._resource("second")
+        tracker = CachedResourceTracker()
+        tracker.track([first, second], ["checksum", "archive"])
+
+        tracker.release(first, "checksum")
+        tracker.release(second.location_stub, "archive")
+        self.assertTrue(self.work_fs.exists("first"))
+        self.assertTrue(self.work_fs.exists("second"))
+
+        tracker.release(first, "archive")
+        self.assertFalse(self.work_fs.exists("first"))
+        tracker.release_all("checksum")
+        self.assertFalse(self.work_fs.exists("second"))
+
+    def test_hardlinks_counted_once(self):
+        self.work_fs.makedir("sub")
+        self.work_fs.writebytes("sub/file", b"x" * 100)
+        self.work_fs.writebytes("other", b"x" * 10)
+        os.link(self.work_fs.getsyspath("sub/file"), self.work_fs.getsyspath("link"))
+        self.assertEqual(110, get_dir_size(self.work_fs.getsyspath("/")))
+
+    def test_peak_remembered(self):
+        with DiskUsageMonitor(self.work_fs.getsyspath("/"), interval=60) as monitor:
+            self.work_fs.writebytes("file", b"x" * 100)
+            monitor.sample()
+            self.work_fs.remove("file")
+            self.assertEqual(0, monitor.sample())
+        self.assertEqual(100, monitor.peak)
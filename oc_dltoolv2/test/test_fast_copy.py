@@ -0,0 +1,66 @@
+import errno
+import os
+import unittest
+from unittest.mock import patch
+
+from fs.memoryfs import MemoryFS
+from fs.tempfs import TempFS
+
+from ..fast_copy import copy_file, copy_fs_file, upload_content
+from ..resources import FileBasedResourceData, FSLocation
+
+
+class FastCopyTestSuite(unittest.TestCase):
+
+    content = os.urandom(3 * 1024 * 1024 + 17)
+
+    def setUp(self):
+        self.temp_fs = TempFS()
+        self.temp_fs.writebytes("source", self.content)
+        self.source_path = self.temp_fs.getsyspath("source")
+        self.target_path = self.temp_fs.getsyspath("target")
+
+    def tearDown(self):
+        self.temp_fs.close()
+
+    def _unsupported(self, *args):
+        raise OSError(errno.EOPNOTSUPP, "not supported")
+
+    def test_link_when_allowed(self):
+        self.assertEqual("link", copy_file(self.source_path, self.target_path, allow_link=True))
+        self.assertEqual(os.stat(self.source_path).st_ino, os.stat(self.target_path).st_ino)
+
+    def test_no_link_by_default(self):
+        method = copy_file(self.source_path, self.target_path)
+        self.assertNotEqual("link", method)
+        self.assertNotEqual(os.stat(self.source_path).st_ino, os.stat(self.target_path).st_ino)
+        self.assertEqual(self.content, self.temp_fs.readbytes("target"))
+
+    def test_existing_target_overwritten(self):
+        self.temp_fs.writebytes("target", b"old content which is longer than nothing")
+        copy_file(self.source_path, self.target_path, allow_link=True)
+        self.assertEqual(self.content, self.temp_fs.readbytes("target"))
+
+    def test_fallbacks(self):
+        with patch("fcntl.ioctl", self._unsupported):
+            self.assertEqual("copy_file_range", copy_file(self.source_path, self.target_path))
+            self.assertEqual(self.content, self.temp_fs.readbytes("target"))
+            with patch("os.copy_file_range", self._unsupported):
+                self.assertEqual("sendfile", copy_file(self.source_path, self.target_path))
+                self.assertEqual(self.content, self.temp_fs.readbytes("target"))
+                with patch("os.sendfile", self._unsupported):
+                    self.assertEqual("buffered", copy_file(self.source_path, self.target_path))
+                    self.assertEqual(self.content, self.temp_fs.readbytes("target"))
+
+    def test_non_os_filesystem(self):
+        with MemoryFS() as memory_fs:
+            self.assertEqual("fs", copy_fs_file(self.temp_fs, "source", memory_fs, "target"))
+            self.assertEqual(self.content, memory_fs.readbytes("target"))
+            resource_data = FileBasedResourceData(FSLocation(memory_fs, "target"))
+            self.assertEqual("fs", upload_content(resource_data, self.temp_fs, "copy"))
+            self.assertEqual(self.content, self.temp_fs.readbytes("copy"))
+
+    def test_upload_local_resource(self):
+        resource_data = FileBasedResourceData(FSLocation(self.temp_fs, "source"))
+        self.assertNotIn(upload_content(resource_data, self.temp_fs, "target"), ["fs", "upload"])
+        self.assertEqual(self.content, self.temp_fs.readbytes("target"))
@@ -0,0 +1,78 @@
+from . import django_settings
+
+from io import BytesIO
+
+from oc_delivery_apps.checksums.models import CiTypes, CsTypes, LocTypes, Files, CheckSums, Locations
+from django import test
+import django
+
+from ..known_checksums import find_known_checksums, get_resource_checksum
+from ..resources import DeliveryResource, LocationStub, ResourceData
+
+
+class CountingResourceData(ResourceData):
+
+    def __init__(self, content=b"content"):
+        self.content = content
+        self.reads = 0
+
+    def get_content(self):
+        self.reads += 1
+        return BytesIO(self.content)
+
+
+class ChecksumsDBTestCase(test.TransactionTestCase):
+    """ Checksums DB with NXS and SVN location types; files are added by _register """
+
+    def setUp(self):
+        django.core.management.call_command('migrate', verbosity=0, interactive=False)
+        CsTypes.objects.create(code="MD5", name="MD5")
+        self.citype = CiTypes.objects.create(code="FILE", name="File", is_standard="N", is_deliverable=True)
+        self.nxs = LocTypes.objects.create(code="NXS", name="Nexus")
+        self.svn = LocTypes.objects.create(code="SVN", name="SVN")
+
+    def tearDown(self):
+        django.core.management.call_command('flush', verbosity=0, interactive=False)
+
+    def _register(self, checksum, loc_type, path, revision=None):
+        db_file = Files.objects.create(mime_type="application/octet-stream", ci_type=self.citype)
+        CheckSums.objects.create(file=db_file, cs_type_id="MD5", checksum=checksum)
+        Locations.objects.create(file=db_file, loc_type=loc_type, path=path, revision=revision)
+
+
+class KnownChecksumsTestSuite(ChecksumsDBTestCase):
+
+    def _resource(self, loc_type, path, revision=None):
+        return DeliveryResource(LocationStub(loc_type, self.citype, path, revision), CountingResourceData())
+
+    def test_known_checksums_found(self):
+        self._register("a" * 32, self.nxs, "g:a:v:zip")
+        self._register("b" * 32, self.svn, "svn://repo/file.sql", "10")
+        self._register("c" * 32, self.svn, "svn://repo/file.sql", "11")
+        resources = [self._resource(self.nxs, "g:a:v:zip"),
+                     self._resource(self.svn, "svn://repo/file.sql", "10"),
+                     self._resource(self.nxs, "g:unknown:v:zip")]
+
+        known_checksums = find_known_checksums(resources, batch_size=1)
+
+        self.assertEqual({("NXS", "g:a:v:zip", None): "a" * 32,
+                          ("SVN", "svn://repo/file.sql", "10"): "b" * 32}, known_checksums)
+
+    def test_svn_without_revision_ignored(self):
+        self._register("b" * 32, self.svn, "svn://repo/file.sql", "10")
+        self.assertEqual({}, find_known_checksums([self._resource(self.svn, "svn://repo/file.sql")]))
+
+    def test_ambiguous_location_ignored(self):
+        self._register("a" * 32, self.nxs, "g:a:v:zip")
+        self._register("b" * 32, self.nxs, "g:a:v:zip")
+        self.assertEqual({}, find_known_checksums([self._resource(self.nxs, "g:a:v:zip")]))
+
+    def test_known_checksum_not_calculated(self):
+        self._register("a" * 32, self.nxs, "g:a:v:zip")
+        known, unknown = self._resource(self.nxs, "g:a:v:zip"), self._resource(self.nxs, "g:b:v:zip")
+        known_checksums = find_known_checksums([known, unknown])
+
+        self.assertEqual("a" * 32, get_resource_checksum(known, known_checksums))
+        self.assertEqual(0, known.resource_data.reads)
+        self.assertEqual("9a0364b9e99bb480dd25e1f0284c8555", get_resource_checksum(unknown, known_checksums))
+        self.assertEqual(1, unknown.resource_data.reads)
@@ -8,8 +8,13 @@ import django
 from fs.errors import ResourceNotFound
 from fs.memoryfs import MemoryFS
 
-from ..local_load import download_resource
-from ..resources import ResourceData, DeliveryResource, LocationStub
+import gc
+
+from fs.tempfs import TempFS
+
+from ..local_load import download_resource, LocallyCachedResourceData, MemoryCachedResourceData, MemoryPool
+from ..resources import ResourceData, DeliveryResource, LocationStub, FileBasedResourceData, FSLocation
+from ..wrapper import WrappedResourceData
 
 
 class TestResourceData(ResourceData):
@@ -54,3 +59,79 @@ class LocalLoadTestSuite(test.TransactionTestCase):
             work_fs.remove(filename)
         with self.assertRaises(ResourceNotFound):
             loaded_resource.resource_data.get_content()
+
+
+class MockWrapClient(object):
+
+    def wrap_path(self, path, write_to=None):
+        with open(path, "rb") as source_file:
+            wrapped_content = b"wrapped " + source_file.read()
+        if not write_to:
+            return wrapped_content
+        with open(write_to, "wb") as target_file:
+            target_file.write(wrapped_content)
+
+
+class MemoryCacheTestSuite(test.TransactionTestCase):
+
+    def setUp(self):
+        django.core.management.call_command('migrate', verbosity=0, interactive=False)
+        test_loc_type = LocTypes(code="TEST", name="TEST")
+        test_loc_type.save()
+        self.test_location = LocationStub(test_loc_type, None, "unused", "rev")
+        self.work_fs = TempFS()
+        self.memory_pool = MemoryPool(max_size=10, threshold=6)
+
+    def tearDown(self):
+        self.work_fs.close()
+        django.core.management.call_command('flush', verbosity=0, interactive=False)
+
+    def _load(self, resource_data):
+        loaded = download_resource(DeliveryResource(self.test_location, resource_data), self.work_fs,
+                                   memory_pool=self.memory_pool)
+        return loaded.resource_data
+
+    def _read(self, resource_data):
+        with resource_data.get_content() as content_handle:
+            return content_handle.read().decode("utf8")
+
+    def test_small_resources_kept_in_memory(self):
+        self.work_fs.writetext("local.txt", "local")
+        loaded = [self._load(TestResourceData("small")),
+                  self._load(FileBasedResourceData(FSLocation(self.work_fs, "local.txt")))]
+        self.assertEqual([MemoryCachedResourceData, MemoryCachedResourceData], list(map(type, loaded)))
+        self.assertEqual(["small", "local"], list(map(self._read, loaded)))
+        self.assertEqual(["local.txt"], self.work_fs.listdir("/"))
+        self.assertEqual(10, self.memory_pool.used)
+
+    def test_large_resources_spilled(self):
+        loaded = self._load(TestResourceData("not small"))
+        self.assertIsInstance(loaded, LocallyCachedResourceData)
+        self.assertEqual("not small", self._read(loaded))
+        self.assertEqual(0, self.memory_pool.used)
+
+    def test_memory_cap_respected(self):
+        loaded = [self._load(TestResourceData("first")), self._load(TestResourceData("second"))]
+        self.assertEqual([MemoryCachedResourceData, LocallyCachedResourceData], list(map(type, loaded)))
+        self.assertEqual(["first", "second"], list(map(self._read, loaded)))
+        del loaded
+        gc.collect()
+        self.assertEqual(0, self.memory_pool.used)
+
+    def test_wrapped_content_spilled(self):
+        self.memory_pool = MemoryPool(max_size=10, threshold=10)
+        kept = WrappedResourceData(TestResourceData("a"), MockWrapClient(), self.memory_pool, self.work_fs)
+        spilled = WrappedResourceData(TestResourceData("b"), MockWrapClient(), self.memory_pool, self.work_fs)
+        self.assertIsNone(kept.get_fs_location())
+        self.assertIsNotNone(spilled.get_fs_location())
+        self.assertEqual(["wrapped a", "wrapped b"], [self._read(kept), self._read(spilled)])
+        self.assertEqual(9, self.memory_pool.used)
+
+    def test_wrapped_content_capped_for_non_local_work_fs(self):
+        self.memory_pool = MemoryPool(max_size=10, threshold=10)
+        with MemoryFS() as memory_fs:
+            wrapped = [WrappedResourceData(TestResourceData(str(index)), MockWrapClient(), self.memory_pool, memory_fs)
+                       for index in range(5)]
+            self.assertEqual(9, self.memory_pool.used)
+            self.assertEqual(4, len(memory_fs.listdir("/")))
+            self.assertEqual(["wrapped %d" % index for index in range(5)], list(map(self._read, wrapped)))
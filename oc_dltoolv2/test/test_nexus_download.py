@@ -0,0 +1,249 @@
+from hashlib import md5, sha1
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from fs.memoryfs import MemoryFS
+from fs.tempfs import TempFS
+
+from ..cancellation import BuildCancelledError, CancellationToken
+from ..content_cache import ContentCache
+from ..nexus_download import NexusDownloader, DownloadError, split_ranges
+
+
+class MockResponse(object):
+
+    def __init__(self, status_code, content=b"", headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+        self.text = content.decode("utf8", "replace")
+
+    def iter_content(self, chunk_size):
+        for start in range(0, len(self.content), chunk_size):
+            yield self.content[start:start + chunk_size]
+
+    def close(self):
+        pass
+
+
+class MockSession(object):
+
+    def __init__(self, content, ranges=True, sha1sum=None, md5sum=None):
+        self.content = content
+        self.ranges = ranges
+        self.sha1sum = sha1sum
+        self.md5sum = md5sum
+        self.range_requests = []
+
+    def head(self, url, **kwargs):
+        headers = {"Content-Length": str(len(self.content))}
+        if self.ranges:
+            headers["Accept-Ranges"] = "bytes"
+        return MockResponse(200, headers=headers)
+
+    def get(self, url, headers=None, stream=False):
+        if url.endswith(".sha1"):
+            if self.sha1sum is None:
+                return MockResponse(404)
+            return MockResponse(200, ("%s  artifact.zip" % self.sha1sum).encode("utf8"))
+        if url.endswith(".md5"):
+            if self.md5sum is None:
+                return MockResponse(404)
+            return MockResponse(200, self.md5sum.encode("utf8"))
+        start, end = map(int, headers["Range"].replace("bytes=", "").split("-"))
+        self.range_requests.append((start, end))
+        return MockResponse(206, self.content[start:end + 1])
+
+
+class NoMetadataMockSession(MockSession):
+
+    def get(self, url, headers=None, stream=False):
+        if url.endswith(".sha1"):
+            raise ConnectionError("metadata lookup failed")
+        return super(NoMetadataMockSession, self).get(url, headers, stream)
+
+
+class FailingMockSession(MockSession):
+    """ The first range fails at once, the others are served slowly """
+
+    def __init__(self, content, **kwargs):
+        super(FailingMockSession, self).__init__(content, **kwargs)
+        self.served_chunks = 0
+
+    def get(self, url, headers=None, stream=False):
+        response = super(FailingMockSession, self).get(url, headers, stream)
+        if url.endswith(".sha1"):
+            return response
+        if self.range_requests[-1][0] == 0:
+            return MockResponse(500)
+        session = self
+
+        class SlowResponse(MockResponse):
+
+            def iter_content(self, chunk_size):
+                for chunk in super(SlowResponse, self).iter_content(chunk_size):
+                    time.sleep(0.01)
+                    session.served_chunks += 1
+                    yield chunk
+
+        return SlowResponse(206, response.content)
+
+
+class MockNexusClient(object):
+
+    def __init__(self, session):
+        self.web = session
+        self.cat_calls = []
+
+    def gav_get_url(self, gav, repo=None):
+        return "http://nexus/" + gav.replace(":", "/")
+
+    def cat(self, gav, repo=None, stream=False, write_to=None):
+        self.cat_calls.append(gav)
+        write_to.write(self.web.content)
+
+
+class NexusDownloaderTestSuite(unittest.TestCase):
+
+    content = bytes(range(256)) * 41
+
+    def setUp(self):
+        self.work_fs = TempFS()
+
+    def tearDown(self):
+        self.work_fs.close()
+
+    def _download(self, session, work_fs=None, threshold=1024, content_cache=None):
+        client = MockNexusClient(session)
+        downloader = NexusDownloader(client, threshold=threshold, streams=3, content_cache=content_cache,
+                                     chunk_size=100)
+        resource_data = downloader.download("g:a:v:zip", work_fs or self.work_fs)
+        self.assertEqual(md5(self.content).hexdigest(), resource_data.md5)
+        with resource_data.get_content() as content_handle:
+            return content_handle.read(), client
+
+    def test_split_ranges(self):
+        self.assertEqual([(0, 3), (4, 6), (7, 9)], split_ranges(10, 3))
+        self.assertEqual([(0, 0), (1, 1)], split_ranges(2, 5))
+        self.assertEqual([], split_ranges(0, 3))
+
+    def test_ranged_download(self):
+        session = MockSession(self.content, sha1sum=sha1(self.content).hexdigest())
+        content, client = self._download(session)
+        self.assertEqual(self.content, content)
+        self.assertEqual(3, len(session.range_requests))
+        self.assertEqual([], client.cat_calls)
+
+    def test_checksum_mismatch_rejected(self):
+        session = MockSession(self.content, sha1sum=sha1(b"other").hexdigest())
+        with self.assertRaises(DownloadError):
+            self._download(session)
+
+    def test_failed_range_aborts_others(self):
+        session = FailingMockSession(self.content)
+        with self.assertRaisesRegex(DownloadError, "was not returned"):
+            self._download(session)
+        # two other ranges would take about 70 chunks
+        self.assertLess(session.served_chunks, 20)
+        self.assertEqual([], self.work_fs.listdir("/"))
+
+    def test_unavailable_sha1_not_verified(self):
+        session = NoMetadataMockSession(self.content)
+        content, client = self._download(session)
+        self.assertEqual(self.content, content)
+
+    def test_single_stream_without_ranges_support(self):
+        session = MockSession(self.content, ranges=False)
+        content, client = self._download(session)
+        self.assertEqual(self.content, content)
+        self.assertEqual([], session.range_requests)
+        self.assertEqual(["g:a:v:zip"], client.cat_calls)
+
+    def test_single_stream_for_small_artifacts(self):
+        session = MockSession(self.content)
+        content, client = self._download(session, threshold=len(self.content) + 1)
+        self.assertEqual(self.content, content)
+        self.assertEqual(["g:a:v:zip"], client.cat_calls)
+
+    def test_single_stream_for_empty_artifacts(self):
+        session = MockSession(b"")
+        client = MockNexusClient(session)
+        resource_data = NexusDownloader(client, threshold=0, streams=3).download("g:a:v:zip", self.work_fs)
+        self.assertEqual(md5(b"").hexdigest(), resource_data.md5)
+        self.assertEqual([], session.range_requests)
+        self.assertEqual(["g:a:v:zip"], client.cat_calls)
+
+    def test_cancelled_download_removed(self):
+        cancellation = CancellationToken()
+        cancellation.cancel("test")
+        for threshold in [1024, None]:
+            downloader = NexusDownloader(MockNexusClient(MockSession(self.content)), threshold=threshold,
+                                         chunk_size=100, cancellation=cancellation)
+            with self.assertRaises(BuildCancelledError):
+                downloader.download("g:a:v:zip", self.work_fs)
+            self.assertEqual([], self.work_fs.listdir("/"))
+
+    def test_single_stream_for_non_os_filesystem(self):
+        session = MockSession(self.content)
+        content, client = self._download(session, work_fs=MemoryFS())
+        self.assertEqual(self.content, content)
+        self.assertEqual(["g:a:v:zip"], client.cat_calls)
+
+
+class ContentCacheLookaheadTestSuite(unittest.TestCase):
+
+    content = b"artifact content"
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache = ContentCache(self.cache_dir, max_size=1024)
+        self.work_fs = TempFS()
+        self.md5sum = md5(self.content).hexdigest()
+
+    def tearDown(self):
+        self.work_fs.close()
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def _download(self, session, gav="g:a:v:zip"):
+        client = MockNexusClient(session)
+        downloader = NexusDownloader(client, content_cache=self.cache)
+        resource_data = downloader.download(gav, self.work_fs)
+        with resource_data.get_content() as content_handle:
+            return content_handle.read(), client
+
+    def test_downloaded_content_cached(self):
+        content, client = self._download(MockSession(self.content, md5sum=self.md5sum))
+        self.assertEqual(self.content, content)
+        self.assertEqual(1, len(client.cat_calls))
+        self.assertIsNotNone(self.cache.get(self.md5sum))
+
+    def test_download_skipped_on_cache_hit(self):
+        self._download(MockSession(self.content, md5sum=self.md5sum))
+        content, client = self._download(MockSession(self.content, md5sum=self.md5sum), gav="g:other:v:zip")
+        self.assertEqual(self.content, content)
+        self.assertEqual([], client.cat_calls)
+
+    def test_download_without_published_md5(self):
+        self._download(MockSession(self.content))
+        content, client = self._download(MockSession(self.content))
+        self.assertEqual(self.content, content)
+        self.assertEqual(1, len(client.cat_calls))
+
+    def test_published_md5_mismatch_rejected(self):
+        with self.assertRaises(DownloadError):
+            self._download(MockSession(self.content, md5sum=md5(b"other").hexdigest()))
+        self.assertIsNone(self.cache.get(md5(b"other").hexdigest()))
+
+    def test_cache_evicts_least_recently_used(self):
+        cache = ContentCache(self.cache_dir, max_size=10)
+        for index, data in enumerate([b"123456", b"abcdef"]):
+            source_path = self.work_fs.getsyspath("source")
+            with open(source_path, "wb") as source_file:
+                source_file.write(data)
+            cache.put(md5(data).hexdigest(), source_path)
+            os.remove(source_path)
+        self.assertIsNone(cache.get(md5(b"123456").hexdigest()))
+        self.assertIsNotNone(cache.get(md5(b"abcdef").hexdigest()))
@@ -0,0 +1,71 @@
+from . import django_settings
+
+from unittest import mock
+
+from ..archiver import ArchivationError
+from ..delivery_exceptions import DeliveryDeniedException
+from ..pre_download_checks import PreDownloadValidator
+from ..resources import DeliveryResource, LocationStub, ResourceData
+from .test_known_checksums import ChecksumsDBTestCase
+from .test_nexus_download import MockNexusClient, MockSession
+
+
+class NotLoadedResourceData(ResourceData):
+
+    def get_content(self):
+        raise AssertionError("Content should not be read before download")
+
+
+class MockAPIClient(object):
+
+    def __init__(self, denied=()):
+        self.denied = set(denied)
+        self.checked = []
+
+    def check_distributive_allowance(self, checksum):
+        self.checked.append(checksum)
+        return checksum not in self.denied
+
+
+class PreDownloadValidatorTestSuite(ChecksumsDBTestCase):
+
+    def setUp(self):
+        super(PreDownloadValidatorTestSuite, self).setUp()
+        self.nexus_client = MockNexusClient(MockSession(b"content", md5sum="c" * 32))
+
+    def _resource(self, loc_type, path, revision=None):
+        return DeliveryResource(LocationStub(loc_type, self.citype, path, revision), NotLoadedResourceData())
+
+    def test_remote_checksums_checked(self):
+        self._register("a" * 32, self.svn, "svn://repo/file.sql", "10")
+        resources = [self._resource(self.svn, "svn://repo/file.sql", "10"),
+                     self._resource(self.svn, "svn://repo/other.sql", "10"),
+                     self._resource(self.nxs, "g:a:v:zip")]
+        api_client = MockAPIClient()
+
+        validator = PreDownloadValidator({}, api_client, lookup_known_checksums=True)
+        validator.validate(resources, self.nexus_client)
+
+        # unknown SVN file is left to the check after download
+        self.assertEqual(["a" * 32, "c" * 32], api_client.checked)
+        self.assertEqual({("SVN", "svn://repo/file.sql", "10"): "a" * 32}, validator.known_checksums)
+
+    def test_denied_by_published_checksum(self):
+        with self.assertRaises(DeliveryDeniedException):
+            PreDownloadValidator({}, MockAPIClient(denied=["c" * 32])).validate(
+                [self._resource(self.nxs, "g:a:v:zip")], self.nexus_client)
+
+    def test_artifacts_lineup_checked(self):
+        resources = [self._resource(self.nxs, "g:a:v:zip")]
+        with mock.patch("oc_dltoolv2.pre_download_checks.DeliveryArtifactsChecker") as checker:
+            checker.return_value.check_artifacts_included.side_effect = DeliveryDeniedException("denied")
+            with self.assertRaises(DeliveryDeniedException):
+                PreDownloadValidator({"any": "any"}, check_artifacts=True).validate(resources, self.nexus_client)
+        checker.assert_called_once_with({"any": "any"})
+        checker.return_value.check_artifacts_included.assert_called_once_with(resources)
+
+    def test_oversized_delivery_failed(self):
+        resources = [self._resource(self.nxs, "g:a:v:zip"), self._resource(self.svn, "svn://repo/file.sql", "10")]
+        with self.assertRaises(ArchivationError):
+            PreDownloadValidator({}, max_size=len(b"content") - 1).validate(resources, self.nexus_client, "svn://repo")
+        PreDownloadValidator({}, max_size=len(b"content")).validate(resources, self.nexus_client, "svn://repo")
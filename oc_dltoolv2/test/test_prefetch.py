@@ -0,0 +1,123 @@
+from . import django_settings
+
+from hashlib import md5
+import shutil
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from ..content_cache import ContentCache
+from ..dlbuild_worker import DLBuildWorker
+from ..prefetch import CacheWarmer, PgQPrefetchPublisher, compose_prefetch_hint
+from .test_nexus_download import MockNexusClient, MockSession
+
+
+class MockPgQ(object):
+
+    def __init__(self, messages=[]):
+        self.messages = list(messages)
+        self.enqueued = []
+        self.finished = []
+
+    def compose_any_message(self, method, *args, **kvargs):
+        return [method, [*args], {**kvargs}]
+
+    def enqueue_message(self, queue_code=None, msg_text=None):
+        self.enqueued.append((queue_code, msg_text))
+
+    def new_msg_from_queue(self, queue_code):
+        return self.messages.pop(0) if self.messages else None
+
+    def msg_proc_end(self, message_id):
+        self.finished.append((message_id, "OK"))
+
+    def msg_proc_fail(self, message_id, error_message=None):
+        self.finished.append((message_id, "FAILED"))
+
+
+class MockConnectionManager(object):
+
+    def __init__(self, nexus_client, svn_client=None):
+        self.nexus_client = nexus_client
+        self.svn_client = svn_client
+
+    def get_mvn_client(self, resource, readonly=False):
+        return self.nexus_client
+
+    def get_svn_client(self, resource):
+        if not self.svn_client:
+            raise AssertionError("SVN is not expected to be used")
+        return self.svn_client
+
+
+class PrefetchTestSuite(unittest.TestCase):
+
+    delivery_params = {"mf_tag_svn": "svn://repo/client/tags/tag-1",
+                       "mf_delivery_files_specified": "g:a:v:zip\ndir/file.sql\ng:b:v:jar"}
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def test_hint_composed(self):
+        self.assertEqual({"tag": "svn://repo/client/tags/tag-1", "gavs": ["g:a:v:zip", "g:b:v:jar"],
+                          "svn_paths": ["dir/file.sql"]}, compose_prefetch_hint(self.delivery_params))
+
+    def test_hint_published(self):
+        pgq = MockPgQ()
+        PgQPrefetchPublisher(pgq).publish(self.delivery_params)
+        queue_code, message = pgq.enqueued[0]
+        self.assertEqual("cdt.dlbuild.prefetch", queue_code)
+        self.assertEqual("prefetch", message[0])
+        self.assertEqual(compose_prefetch_hint(self.delivery_params), message[1][0])
+
+    def test_publishing_failure_ignored(self):
+        pgq = MockPgQ()
+        pgq.enqueue_message = mock.Mock(side_effect=Exception("queue is down"))
+        PgQPrefetchPublisher(pgq).publish(self.delivery_params)
+
+    def test_artifacts_warmed(self):
+        content = b"artifact"
+        nexus_client = MockNexusClient(MockSession(content, md5sum=md5(content).hexdigest()))
+        hint = compose_prefetch_hint(self.delivery_params)
+        pgq = MockPgQ([(["prefetch", [hint], {}], 1)])
+        warmer = CacheWarmer(pgq, MockConnectionManager(nexus_client), sleep=0)
+        warmer._stopped.wait = mock.Mock(side_effect=lambda timeout: warmer.stop())
+
+        with mock.patch.dict("os.environ", {"MVN_CONTENT_CACHE_DIR": self.cache_dir}):
+            warmer.run()
+
+        self.assertEqual([(1, "OK")], pgq.finished)
+        # both mocked artifacts have the same content, so the second one is taken from cache
+        self.assertEqual(["g:a:v:zip"], nexus_client.cat_calls)
+        self.assertIsNotNone(ContentCache(self.cache_dir, 1024).get(md5(content).hexdigest()))
+
+    def test_tag_url_escaped(self):
+        svn_client = mock.Mock()
+        svn_client.info2.return_value = [("tag", mock.Mock(rev=mock.Mock(number=10)))]
+        warmer = CacheWarmer(MockPgQ(), MockConnectionManager(None, svn_client))
+        hint = {"tag": "svn://repo/client/tags/tag 1", "gavs": [], "svn_paths": ["dir/file.sql"]}
+
+        with mock.patch.dict("os.environ", {"SVN_WC_CACHE_DIR": self.cache_dir}), \
+                mock.patch("oc_dltoolv2.build_steps.get_svn_wc_cache") as get_svn_wc_cache:
+            warmer.warm(hint)
+
+        svn_client.info2.assert_called_once_with("svn://repo/client/tags/tag%201", recurse=False)
+        get_svn_wc_cache.return_value.working_copy.assert_called_once_with(hint["tag"], 10)
+
+    def test_single_warmer_on_reconnects(self):
+        worker = SimpleNamespace(_kwargs={"conn_mgr": MockConnectionManager(None)}, sleep=1)
+        with mock.patch("oc_dltoolv2.prefetch.CacheWarmer") as warmer_class, \
+                mock.patch("oc_dltoolv2.dlbuild_worker.PgQAPI.PgQAPI"):
+            warmer_class.return_value.is_alive.return_value = True
+            for _ in range(3):
+                DLBuildWorker.start_cache_warmer(worker)
+            warmer_class.return_value.start.assert_called_once_with()
+
+            # warmer stopped by failure is replaced
+            warmer_class.return_value.is_alive.return_value = False
+            DLBuildWorker.start_cache_warmer(worker)
+            self.assertEqual(2, warmer_class.return_value.start.call_count)
@@ -4,13 +4,16 @@ from io import BytesIO
 
 from oc_cdtapi import NexusAPI
 from oc_delivery_apps.checksums.models import CiTypes, CsTypes, LocTypes, CiRegExp
-from oc_checksumsq.checksums_interface import FileLocation
+from oc_checksumsq.checksums_interface import ChecksumsQueueClient, FileLocation
+from oc_cdt_queue2.queue_client import QueueClient
 from django import test
 from fs.memoryfs import MemoryFS
 from fs.zipfs import ZipFS
 
+from ..archiver import ArchiveContents, ArchivedFile
 from ..register import register_delivery_content, register_delivery_resource, RegisterError
 from ..resources import DeliveryResource, LocationStub, ResourceData
+from unittest import mock
 
 import django
 
@@ -74,6 +77,27 @@ class ContentRegistrationTestSuite(RegisterTestCase):
         expected_params = [(("g:a:v:zip", "NXS", None), "DELIVERY", 1), ]
         self.assertCountEqual(expected_params, registration_client.calls)
 
+    def test_archive_contents_registered(self):
+        mock_fs = self._get_archive_fs()
+        registration_client = ChecksumsQueueClient()
+        registration_client.connection = mock.Mock(is_open=True)
+        registration_client.channel = mock.Mock()
+        contents = ArchiveContents("f" * 32, 100, [ArchivedFile("a", 1, "a" * 32, None),
+                                                   ArchivedFile("b/c", 1, "c" * 32, "RELEASENOTES")])
+        with mock.patch.object(QueueClient, "send", autospec=True) as send:
+            register_delivery_content(mock_fs, "foo.zip", NexusAPI.parse_gav("g:a:v"), registration_client, contents)
+
+        # archive is not to be downloaded and unpacked by registration service; its checksum goes first
+        expected_messages = [
+            ["register_checksum", (FileLocation("g:a:v:zip", "NXS", None), "f" * 32), {"citype": "DELIVERY"}],
+            ["register_checksum", (FileLocation("a", "ARCH", None), "a" * 32),
+             {"citype": "FILE", "parent": "f" * 32}],
+            ["register_checksum", (FileLocation("b/c", "ARCH", None), "c" * 32),
+             {"citype": "RELEASENOTES", "parent": "f" * 32}]]
+        # every message goes to both artifacts and contents queues
+        self.assertEqual([message for message in expected_messages for _ in range(2)],
+                         [call[0][1] for call in send.call_args_list])
+
 
 class SourceRegisterTestSuite(RegisterTestCase):
 
@@ -0,0 +1,78 @@
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+from ..subprocess_wrapper import SubprocessWrapper
+
+
+def python_command(code):
+    return [sys.executable, "-c", code]
+
+
+class SubprocessWrapperTestSuite(unittest.TestCase):
+
+    def setUp(self):
+        self.output_dir = tempfile.TemporaryDirectory()
+        self.wrapper = SubprocessWrapper()
+
+    def tearDown(self):
+        self.output_dir.cleanup()
+
+    def _read(self, path):
+        with open(path, "rb") as output_file:
+            return output_file.read()
+
+    def _is_running(self, pid):
+        # killed process may stay a zombie if nobody reaps orphans
+        try:
+            with open("/proc/%d/stat" % pid) as stat_file:
+                return stat_file.read().rsplit(")", 1)[1].split()[0] != "Z"
+        except FileNotFoundError:
+            return False
+
+    def test_output_bounded(self):
+        result = self.wrapper.execute_bounded(
+            python_command("import sys; sys.stdout.write('x' * 100000); sys.stderr.write('error')"),
+            output_dir=self.output_dir.name, max_output=10)
+        self.assertEqual(0, result.returncode)
+        self.assertFalse(result.timed_out)
+        self.assertEqual(b"x" * 10, self._read(result.stdout_path))
+        self.assertEqual(b"error", self._read(result.stderr_path))
+
+    def test_time_accounted(self):
+        result = self.wrapper.execute_bounded(
+            python_command("import time\nstarted = time.process_time()\nwhile time.process_time() - started < 0.2: pass"),
+            output_dir=self.output_dir.name)
+        self.assertGreaterEqual(result.cpu_time, 0.2)
+        self.assertGreaterEqual(result.wall_time, result.cpu_time * 0.5)
+
+    def test_process_group_killed_on_timeout(self):
+        # child starts a grandchild which would outlive it if only the child was killed
+        code = ("import subprocess, sys; "
+                "proc = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(60)']); "
+                "print(proc.pid, flush=True); proc.wait()")
+        started = time.monotonic()
+        result = self.wrapper.execute_bounded(python_command(code), timeout=1, output_dir=self.output_dir.name)
+        self.assertLess(time.monotonic() - started, 10)
+        self.assertTrue(result.timed_out)
+        grandchild_pid = int(self._read(result.stdout_path))
+        time.sleep(0.2)
+        self.assertFalse(self._is_running(grandchild_pid))
+
+        with self.assertRaises(subprocess.TimeoutExpired):
+            self.wrapper.execute_bounded(python_command("import time; time.sleep(60)"), timeout=0.2,
+                                         output_dir=self.output_dir.name, fail=True)
+
+    def test_batch(self):
+        commands = [python_command("import time; time.sleep(0.3); print(%d)" % index) for index in range(4)]
+        started = time.monotonic()
+        results = self.wrapper.execute_batch(commands, concurrency=2, output_dir=self.output_dir.name)
+        self.assertGreaterEqual(time.monotonic() - started, 0.6)
+        self.assertEqual([b"%d\n" % index for index in range(4)],
+                         [self._read(result.stdout_path) for result in results])
+
+        with self.assertRaises(subprocess.CalledProcessError):
+            self.wrapper.execute_batch([python_command("import sys; sys.exit(3)")] + commands, concurrency=1,
+                                       output_dir=self.output_dir.name, fail=True)
@@ -0,0 +1,183 @@
+from . import django_settings
+
+import fcntl
+import os
+import threading
+
+import pysvn
+from oc_delivery_apps.checksums.models import LocTypes
+from django import test
+import django
+from fs.memoryfs import MemoryFS
+from fs.tempfs import TempFS
+
+from ..local_load import LocallyCachedResourceData
+from ..resources import DeliveryResource, LocationStub, FSLocation, FileBasedResourceData
+from ..svn_cache import SvnWorkingCopyCache, get_client_url
+
+
+class MockSvnClient(object):
+    """ Emulates checkout/switch of branches given as dict: url -> {path: content} """
+
+    def __init__(self, branches):
+        self.branches = branches
+        self.calls = []
+
+    def _materialize(self, url, path):
+        for filename in os.listdir(path):
+            if filename != ".svn":
+                os.remove(os.path.join(path, filename))
+        for filename, content in self.branches[url].items():
+            with open(os.path.join(path, filename), "w") as target:
+                target.write(content)
+
+    def checkout(self, url, path, recurse=True, revision=None, peg_revision=None, ignore_externals=False):
+        self.calls.append(("checkout", url))
+        os.makedirs(os.path.join(path, ".svn"))
+        self._materialize(url, path)
+
+    def switch(self, path, url, revision=None, peg_revision=None, ignore_externals=False, ignore_ancestry=False):
+        self.calls.append(("switch", url))
+        if url not in self.branches:
+            raise pysvn.ClientError("no such branch")
+        self._materialize(url, path)
+
+    def cleanup(self, path):
+        pass
+
+    def revert(self, path, recurse=False):
+        pass
+
+
+class SvnWorkingCopyCacheTestSuite(test.TransactionTestCase):
+
+    tag_1 = "svn://repo/Country/CLIENT/tags/tag-1"
+    tag_2 = "svn://repo/Country/CLIENT/tags/tag-2"
+    other_tag = "svn://repo/Country/OTHER/tags/tag-1"
+
+    def setUp(self):
+        django.core.management.call_command('migrate', verbosity=0, interactive=False)
+        self.svn_loc_type = LocTypes.objects.create(code="SVN", name="SVN")
+        self.cache_fs = TempFS()
+        self.work_fs = TempFS()
+        self.svn_client = MockSvnClient({self.tag_1: {"a.sql": "a1", "b.sql": "b1"},
+                                         self.tag_2: {"a.sql": "a2", "b.sql": "b1"},
+                                         self.other_tag: {"c.sql": "c1"}})
+
+    def tearDown(self):
+        self.cache_fs.close()
+        self.work_fs.close()
+        django.core.management.call_command('flush', verbosity=0, interactive=False)
+
+    def _get_cache(self, max_size=1024 * 1024, **kwargs):
+        kwargs.setdefault("copies_per_client", 1)
+        return SvnWorkingCopyCache(self.cache_fs.getsyspath("/"), self.svn_client, max_size, **kwargs)
+
+    def _get_default_cache(self):
+        return SvnWorkingCopyCache(self.cache_fs.getsyspath("/"), self.svn_client, 1024 * 1024)
+
+    def _get_working_copies(self):
+        return [name for name in self.cache_fs.listdir("/") if name.startswith("wc_")]
+
+    def _load(self, cache, branch_url, paths):
+        svn_fs = MemoryFS()
+        resources = [DeliveryResource(LocationStub(self.svn_loc_type, None, branch_url + "/" + path, "10"),
+                                      FileBasedResourceData(FSLocation(svn_fs, path)))
+                     for path in paths]
+        return cache.load_resources(resources, svn_fs, branch_url, self.work_fs)
+
+    def _read(self, resource):
+        with resource.resource_data.get_content() as content_handle:
+            return content_handle.read().decode("utf8")
+
+    def test_client_url(self):
+        self.assertEqual("svn://repo/Country/CLIENT", get_client_url(self.tag_1))
+        self.assertEqual("svn://repo/Country/CLIENT", get_client_url("svn://repo/Country/CLIENT/branches/b/"))
+        self.assertEqual("svn://repo/Country/CLIENT", get_client_url("svn://repo/Country/CLIENT/trunk"))
+
+    def test_resources_loaded_from_working_copy(self):
+        resources = self._load(self._get_cache(), self.tag_1, ["a.sql", "b.sql"])
+        self.assertEqual(["a1", "b1"], list(map(self._read, resources)))
+        self.assertTrue(all(isinstance(resource.resource_data, LocallyCachedResourceData)
+                            for resource in resources))
+        self.assertEqual([("checkout", self.tag_1)], self.svn_client.calls)
+
+    def test_working_copy_switched_for_same_client(self):
+        cache = self._get_cache()
+        self._load(cache, self.tag_1, ["a.sql"])
+        resources = self._load(cache, self.tag_2, ["a.sql", "b.sql"])
+        self.assertEqual(["a2", "b1"], list(map(self._read, resources)))
+        self.assertEqual([("checkout", self.tag_1), ("switch", self.tag_2)], self.svn_client.calls)
+
+    def test_separate_working_copies_for_clients(self):
+        cache = self._get_cache()
+        self._load(cache, self.tag_1, ["a.sql"])
+        self._load(cache, self.other_tag, ["c.sql"])
+        self._load(cache, self.tag_1, ["a.sql"])
+        self.assertEqual([("checkout", self.tag_1), ("checkout", self.other_tag), ("switch", self.tag_1)],
+                         self.svn_client.calls)
+
+    def test_least_recently_used_evicted(self):
+        cache = self._get_cache(max_size=1)
+        self._load(cache, self.tag_1, ["a.sql"])
+        self._load(cache, self.other_tag, ["c.sql"])
+        working_copies = self._get_working_copies()
+        self.assertEqual(1, len(working_copies))
+        self.assertTrue(self.cache_fs.exists(working_copies[0] + "/c.sql"))
+
+    def test_failed_switch_checks_out_again(self):
+        cache = self._get_cache()
+        self._load(cache, self.tag_1, ["a.sql"])
+        broken_tag = "svn://repo/Country/CLIENT/tags/broken"
+        self.svn_client.branches[broken_tag] = {"a.sql": "a3"}
+
+        def failing_switch(path, url, **kwargs):
+            self.svn_client.calls.append(("switch", url))
+            raise pysvn.ClientError("switch failed")
+
+        self.svn_client.switch = failing_switch
+        resources = self._load(cache, broken_tag, ["a.sql"])
+        self.assertEqual(["a3"], list(map(self._read, resources)))
+        self.assertEqual(("checkout", broken_tag), self.svn_client.calls[-1])
+        self.assertEqual(1, len(self._get_working_copies()))
+
+    def test_new_working_copy_made_from_existing_one(self):
+        cache = self._get_default_cache()
+        self._load(cache, self.tag_1, ["a.sql"])
+        resources = self._load(cache, self.tag_2, ["a.sql", "b.sql"])
+        self.assertEqual(["a2", "b1"], list(map(self._read, resources)))
+        resources = self._load(cache, self.tag_1, ["a.sql"])
+        self.assertEqual(["a1"], list(map(self._read, resources)))
+        # second tag is a copy of the first one switched, the first one is kept
+        self.assertEqual([("checkout", self.tag_1), ("switch", self.tag_2), ("switch", self.tag_1)],
+                         self.svn_client.calls)
+        self.assertEqual(2, len(self._get_working_copies()))
+
+    def test_working_copies_used_concurrently(self):
+        cache = self._get_default_cache()
+        with cache.working_copy(self.tag_1, 10) as tag_1_path:
+            with cache.working_copy(self.other_tag, 10) as other_path:
+                # index is not locked while working copies are in use
+                with open(os.path.join(self.cache_fs.getsyspath("/"), cache.lock_filename)) as lock_file:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+                with cache.working_copy(self.tag_2, 10) as tag_2_path:
+                    self.assertEqual(3, len({tag_1_path, other_path, tag_2_path}))
+                    with open(os.path.join(tag_2_path, "a.sql")) as content:
+                        self.assertEqual("a2", content.read())
+        # working copy in use is not copied
+        self.assertEqual([("checkout", self.tag_1), ("checkout", self.other_tag), ("checkout", self.tag_2)],
+                         self.svn_client.calls)
+
+    def test_busy_working_copy_waited_for(self):
+        cache = self._get_cache()
+        loaded = []
+        worker = threading.Thread(target=lambda: loaded.extend(self._load(cache, self.tag_2, ["a.sql"])))
+        with cache.working_copy(self.tag_1, 10):
+            worker.start()
+            worker.join(0.5)
+            # the only working copy allowed for client is in use
+            self.assertTrue(worker.is_alive())
+        worker.join(10)
+        self.assertEqual(["a2"], list(map(self._read, loaded)))
+        self.assertEqual([("checkout", self.tag_1), ("switch", self.tag_2)], self.svn_client.calls)
@@ -0,0 +1,106 @@
+from . import django_settings
+
+import os
+import posixpath
+
+import pysvn
+from oc_delivery_apps.checksums.models import LocTypes
+from django import test
+import django
+from fs.memoryfs import MemoryFS
+from fs.tempfs import TempFS
+
+from ..local_load import LocallyCachedResourceData, download_resource
+from ..resources import DeliveryResource, LocationStub, FSLocation, FileBasedResourceData
+from ..svn_export import SvnBulkExporter, get_export_roots
+
+
+class TestSvnFS(MemoryFS):
+
+    def getsyspath(self, path):
+        return "svn://repo/branch/" + path.strip("/")
+
+
+class MockSvnClient(object):
+    """ Exports files from TestSvnFS the way 'svn export' does """
+
+    def __init__(self, svn_fs, failing_urls=[]):
+        self.svn_fs = svn_fs
+        self.failing_urls = failing_urls
+        self.calls = []
+
+    def export(self, url, dest_path, force=False, revision=None, peg_revision=None,
+               ignore_externals=False, depth=None):
+        self.calls.append((url, depth))
+        if url in self.failing_urls:
+            raise pysvn.ClientError("export failed")
+        folder = url.replace("svn://repo/branch", "", 1).strip("/")
+        walker = self.svn_fs.opendir(folder or "/").walk
+        files = walker.files() if depth == pysvn.depth.infinity else walker.files(max_depth=1)
+        for path in files:
+            target = os.path.join(dest_path, path.strip("/"))
+            if not os.path.isdir(os.path.dirname(target)):
+                os.makedirs(os.path.dirname(target))
+            with open(target, "wb") as target_file:
+                target_file.write(self.svn_fs.readbytes(posixpath.join(folder, path.strip("/"))))
+
+
+class SvnExportTestSuite(test.TransactionTestCase):
+
+    def setUp(self):
+        django.core.management.call_command('migrate', verbosity=0, interactive=False)
+        self.svn_loc_type = LocTypes.objects.create(code="SVN", name="SVN")
+        self.nxs_loc_type = LocTypes.objects.create(code="NXS", name="NXS")
+        self.svn_fs = TestSvnFS()
+        for path in ["a/1.sql", "a/2.sql", "a/b/3.sql", "c/4.sql", "c/5.sql", "c/6.sql", "d/7.sql"]:
+            self.svn_fs.makedirs(posixpath.dirname(path), recreate=True)
+            self.svn_fs.writetext(path, path)
+        self.work_fs = TempFS()
+
+    def tearDown(self):
+        self.work_fs.close()
+        django.core.management.call_command('flush', verbosity=0, interactive=False)
+
+    def _svn_resource(self, path):
+        location = LocationStub(self.svn_loc_type, None, self.svn_fs.getsyspath(path), "10")
+        return DeliveryResource(location, FileBasedResourceData(FSLocation(self.svn_fs, path)))
+
+    def _export(self, paths, requested, svn_client=None):
+        svn_client = svn_client or MockSvnClient(self.svn_fs)
+        resources = [self._svn_resource(path) for path in paths]
+        exporter = SvnBulkExporter(self.svn_fs, svn_client, self.work_fs)
+        return exporter.export_resources(resources, requested), svn_client
+
+    def test_export_roots(self):
+        roots = get_export_roots(["a/1.sql", "a/2.sql", "a/b/3.sql", "c/4.sql", "c/5.sql", "d/7.sql"],
+                                 ["a", "a/b", "c/4.sql", "c/5.sql", "d/7.sql"])
+        self.assertEqual([("a", True), ("c", False)], roots)
+
+    def test_resources_exported(self):
+        paths = ["a/1.sql", "a/2.sql", "a/b/3.sql", "c/4.sql", "c/5.sql", "d/7.sql"]
+        resources, svn_client = self._export(paths, ["a", "c/4.sql", "c/5.sql", "d/7.sql"])
+        self.assertEqual(2, len(svn_client.calls))
+        self.assertEqual([self.svn_fs.getsyspath(path) for path in paths],
+                         [resource.location_stub.path for resource in resources])
+        for path, resource in zip(paths, resources):
+            if path == "d/7.sql":
+                self.assertIsInstance(resource.resource_data, FileBasedResourceData)
+            else:
+                self.assertIsInstance(resource.resource_data, LocallyCachedResourceData)
+            with resource.resource_data.get_content() as content_handle:
+                self.assertEqual(path, content_handle.read().decode("utf8"))
+
+    def test_unrequested_siblings_not_bound(self):
+        resources, _ = self._export(["c/4.sql", "c/5.sql"], ["c/4.sql", "c/5.sql"])
+        self.assertEqual(2, len(resources))
+        self.assertEqual(1, self.work_fs.glob("**/6.sql").count().files)
+
+    def test_failed_export_falls_back(self):
+        svn_client = MockSvnClient(self.svn_fs, failing_urls=[self.svn_fs.getsyspath("a")])
+        resources, _ = self._export(["a/1.sql", "a/2.sql"], ["a"], svn_client=svn_client)
+        self.assertTrue(all(isinstance(resource.resource_data, FileBasedResourceData) for resource in resources))
+
+    def test_exported_resource_not_downloaded_again(self):
+        resources, _ = self._export(["c/4.sql", "c/5.sql"], ["c/4.sql", "c/5.sql"])
+        downloaded = download_resource(resources[0], self.work_fs)
+        self.assertIs(resources[0], downloaded)
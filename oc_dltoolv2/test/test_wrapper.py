@@ -1,6 +1,14 @@
 import os
 import django
 import posixpath
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from io import BytesIO
+from unittest import mock
 
 from . import django_settings
 
@@ -9,10 +17,13 @@ from django import test
 from oc_delivery_apps.dlmanager.DLModels import DeliveryList
 from fs.errors import DirectoryExists
 from fs.memoryfs import MemoryFS
+from fs.tempfs import TempFS
 
 from ..resolver import BuildRequestResolver
-from ..resources import RequestContext, LocationStub, DeliveryResource
-from ..wrapper import Wrapper
+from ..resources import RequestContext, LocationStub, DeliveryResource, ResourceData, FileBasedResourceData, FSLocation
+from ..wrap_cache import WrappedContentCache, get_wrap_tool_identity
+from ..cancellation import BuildCancelledError, CancellationToken
+from ..wrapper import Wrapper, WrapError, WrapListIndex, WrappedResourceData, BoundedWrapClient
 
 
 
@@ -334,7 +345,234 @@ class WrappingTestSuite(django.test.TransactionTestCase):
                                                         ])
 
 
+    def test_wrap_list_read_without_listing(self):
+        context = get_request_context(svn_files=[self._c_cust("c_cust1.sql"),
+                                                 self._c_cust("c_cust2.sql"),
+                                                 self._c_owner("script_b.sql"),
+                                                 self._d_owner_home("script_b.sql"), ])
+        context.svn_fs.writetext(posixpath.join(self.c_label, "wrap.txt"), "c_cust1.sql")
+        context.svn_fs.writetext(posixpath.join(self.d_label, "wrap.txt"), "d_cust1.sql")
+        clean_resources = get_resolver().resolve_request(DeliveryList([posixpath.join(self.c_label, self.wdir),
+                                                                       posixpath.join(self.d_label, self.hdir)]),
+                                                         context)
+
+        with mock.patch.object(context.svn_fs, "listdir", wraps=context.svn_fs.listdir) as listdir, \
+                mock.patch.object(context.svn_fs, "open", wraps=context.svn_fs.open) as open_file:
+            resources = get_wrapper().get_wrapped_resources(clean_resources, context.svn_fs)
+
+        # no custs in dwh - its wrap file is not needed
+        listdir.assert_not_called()
+        open_file.assert_called_once_with(posixpath.join(self.c_label, "wrap.txt"))
+        self.assert_resources_resolved(resources, context,
+                                       wrapped_svn_files=[self._c_cust("c_cust1.sql"),
+                                                          self._c_owner("script_b.sql"),
+                                                          self._d_owner_home("script_b.sql"), ],
+                                       clean_svn_files=[self._c_cust("c_cust2.sql")])
+
+
 class MockWrapper(object):
 
-    def wrap_path(self, path):
-        return b"wrapped"
+    def wrap_path(self, path, write_to=None):
+        if not write_to:
+            return b"wrapped"
+        with open(write_to, "wb") as target_file:
+            target_file.write(b"wrapped")
+
+
+class SlowMockWrapper(object):
+    """ Takes some time to wrap, remembers how many files were wrapped at once """
+
+    def __init__(self, failing=None):
+        self.failing = failing
+        self.active = 0
+        self.max_active = 0
+        self.wrapped = []
+        self.paths = []
+        self._lock = threading.Lock()
+
+    def wrap_path(self, path, write_to=None):
+        self.paths.append(path)
+        with open(path, "rb") as source_file:
+            content = source_file.read()
+        with self._lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        time.sleep(0.05)
+        with self._lock:
+            self.active -= 1
+            self.wrapped.append(content)
+        if content == self.failing:
+            raise ValueError("wrap failed")
+        if not write_to:
+            return b"wrapped " + content
+        with open(write_to, "wb") as target_file:
+            target_file.write(b"wrapped " + content)
+
+
+class BytesResourceData(ResourceData):
+
+    def __init__(self, content):
+        self.content = content
+
+    def get_content(self):
+        return BytesIO(self.content)
+
+
+class ParallelWrappingTestSuite(unittest.TestCase):
+
+    def _resources(self, count):
+        return [DeliveryResource(LocationStub("SVN", "FILE", "svn://branch/file%d_b.sql" % index, "1"),
+                                 BytesResourceData(b"%d" % index)) for index in range(count)]
+
+    def test_order_kept(self):
+        wrap_client = SlowMockWrapper()
+        resources = self._resources(12)
+        wrapped = Wrapper(wrap_client, workers=4)._wrap_resources(resources)
+        self.assertEqual([resource.location_stub for resource in resources],
+                         [resource.location_stub for resource in wrapped])
+        for index, resource in enumerate(wrapped):
+            with resource.resource_data.get_content() as content_handle:
+                self.assertEqual(b"wrapped %d" % index, content_handle.read())
+        self.assertEqual(4, wrap_client.max_active)
+
+    def test_failure_stops_wrapping(self):
+        wrap_client = SlowMockWrapper(failing=b"0")
+        with self.assertRaises(WrapError) as context:
+            Wrapper(wrap_client, workers=2)._wrap_resources(self._resources(20))
+        self.assertIn("file0_b.sql", str(context.exception))
+        self.assertLess(len(wrap_client.wrapped), 20)
+
+    def test_wrapped_content_cached(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            wrap_client = SlowMockWrapper()
+            wrap_cache = WrappedContentCache(cache_dir, 1024 * 1024, "wrap:1")
+            Wrapper(wrap_client, workers=2, wrap_cache=wrap_cache)._wrap_resources(self._resources(3))
+            wrapped = Wrapper(wrap_client, workers=2, wrap_cache=wrap_cache)._wrap_resources(self._resources(4))
+            # only the new file is wrapped again
+            self.assertEqual(4, len(wrap_client.wrapped))
+            with wrapped[1].resource_data.get_content() as content_handle:
+                self.assertEqual(b"wrapped 1", content_handle.read())
+
+            other_tool_cache = WrappedContentCache(cache_dir, 1024 * 1024, "wrap:2")
+            Wrapper(wrap_client, wrap_cache=other_tool_cache)._wrap_resources(self._resources(1))
+            self.assertEqual(5, len(wrap_client.wrapped))
+
+    def test_wrap_tool_identity(self):
+        with tempfile.TemporaryDirectory() as oracle_home:
+            with mock.patch.dict("os.environ", {"ORACLE_HOME": oracle_home}):
+                self.assertIsNone(get_wrap_tool_identity())
+                os.makedirs(os.path.join(oracle_home, "bin"))
+                with open(os.path.join(oracle_home, "bin", "wrap"), "wb") as wrap_file:
+                    wrap_file.write(b"binary")
+                self.assertIn("9d7183f16acce70658f686ae7f1a4d20", get_wrap_tool_identity())
+
+
+_WRAP_TOOL = """#!%s
+import sys, time
+args = dict(arg.split("=", 1) for arg in sys.argv[1:])
+source = open(args["iname"], "rb").read()
+if source.startswith(b"hang"):
+    time.sleep(60)
+output = b"" if source.startswith(b"wrong") else b"CREATE OR REPLACE PACKAGE BODY pkg wrapped\\na000000\\n1\\nabcd\\n/\\n"
+open(args["oname"], "wb").write(output)
+"""
+
+
+class BoundedWrapClientTestSuite(unittest.TestCase):
+
+    def setUp(self):
+        self.oracle_home = tempfile.TemporaryDirectory()
+        os.makedirs(os.path.join(self.oracle_home.name, "bin"))
+        wrap_tool = os.path.join(self.oracle_home.name, "bin", "wrap")
+        with open(wrap_tool, "w") as wrap_file:
+            wrap_file.write(_WRAP_TOOL % sys.executable)
+        os.chmod(wrap_tool, 0o755)
+        self.environ = mock.patch.dict("os.environ", {"ORACLE_HOME": self.oracle_home.name})
+        self.environ.start()
+
+    def tearDown(self):
+        self.environ.stop()
+        self.oracle_home.cleanup()
+
+    def _source(self, content, name="script.sql"):
+        path = os.path.join(self.oracle_home.name, name)
+        with open(path, "wb") as source_file:
+            source_file.write(content)
+        return path
+
+    def test_wrapped(self):
+        wrapped = BoundedWrapClient().wrap_path(self._source(b"create package body pkg", "script"))
+        self.assertTrue(wrapped.startswith(b"CREATE OR REPLACE PACKAGE BODY pkg wrapped"))
+
+        target_path = os.path.join(self.oracle_home.name, "wrapped.plb")
+        self.assertIsNone(BoundedWrapClient().wrap_path(self._source(b"create package body pkg"), target_path))
+        with open(target_path, "rb") as wrapped_file:
+            self.assertEqual(wrapped, wrapped_file.read())
+
+    def test_not_wrapped_output_rejected(self):
+        with self.assertRaisesRegex(WrapError, "zero length"):
+            BoundedWrapClient().wrap_path(self._source(b"wrong sql"))
+
+    def test_hung_tool_killed(self):
+        started = time.monotonic()
+        with self.assertRaises(subprocess.TimeoutExpired):
+            BoundedWrapClient(timeout=0.5).wrap_path(self._source(b"hang"))
+
+        cancellation = CancellationToken()
+        threading.Timer(0.2, cancellation.cancel, ["test"]).start()
+        with self.assertRaises(BuildCancelledError):
+            BoundedWrapClient(cancellation=cancellation).wrap_path(self._source(b"hang"))
+        self.assertLess(time.monotonic() - started, 10)
+
+
+class WrapListIndexTestSuite(unittest.TestCase):
+
+    def test_matches_same_as_endswith(self):
+        wrap_list = ["Owner/cust/Cust 1.sql", "owner/pkg_b.sql", "other/pkg_b.sql", "x_b.sql"]
+        paths = ["svn://branch/owner/cust/cust 1.sql", "svn://branch/OWNER/PKG_B.SQL", "svn://branch/owner/x_b.sql",
+                 "svn://branch/owner/pkg_b.sql/", "svn://branch/new_owner/pkg_b.sql", "svn://branch/owner/cust.sql",
+                 "svn://branch/owner/pkg_b.sql.bak", "svn://branch/private_b.sql"]
+        wrap_index = WrapListIndex(wrap_list)
+        for path in paths:
+            self.assertEqual(any(path.lower().endswith(entry.lower()) for entry in wrap_list),
+                             wrap_index.matches(path), path)
+
+
+class WrapToFileTestSuite(unittest.TestCase):
+
+    def setUp(self):
+        self.work_fs = TempFS()
+
+    def tearDown(self):
+        self.work_fs.close()
+
+    def _read(self, resource_data):
+        with resource_data.get_content() as content_handle:
+            return content_handle.read()
+
+    def test_local_source_wrapped_in_place(self):
+        self.work_fs.writebytes("cache_source", b"local")
+        wrap_client = SlowMockWrapper()
+        wrapped = WrappedResourceData(FileBasedResourceData(FSLocation(self.work_fs, "cache_source")), wrap_client,
+                                      work_fs=self.work_fs)
+        self.assertEqual([self.work_fs.getsyspath("cache_source")], wrap_client.paths)
+        self.assertEqual(b"wrapped local", self._read(wrapped))
+        self.assertCountEqual(["cache_source", wrapped.get_fs_location().location], self.work_fs.listdir("/"))
+
+    def test_remote_source_wrapped_via_work_fs(self):
+        wrapped = WrappedResourceData(BytesResourceData(b"remote"), SlowMockWrapper(), work_fs=self.work_fs)
+        self.assertEqual(b"wrapped remote", self._read(wrapped))
+        # scratch copy of source is removed
+        self.assertEqual([wrapped.get_fs_location().location], self.work_fs.listdir("/"))
+
+    def test_cached_content_linked(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            wrap_client = SlowMockWrapper()
+            wrap_cache = WrappedContentCache(cache_dir, 1024 * 1024, "wrap:1")
+            first = WrappedResourceData(BytesResourceData(b"1"), wrap_client, work_fs=self.work_fs,
+                                        wrap_cache=wrap_cache)
+            second = WrappedResourceData(BytesResourceData(b"1"), wrap_client, work_fs=self.work_fs,
+                                         wrap_cache=wrap_cache)
+            self.assertEqual(1, len(wrap_client.wrapped))
+            self.assertEqual(b"wrapped 1", self._read(second))
+            self.assertNotEqual(first.get_fs_location(), second.get_fs_location())
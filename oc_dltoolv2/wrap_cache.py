@@ -0,0 +1,64 @@
+import logging
+import os
+from hashlib import md5
+
+from .content_cache import ContentCache
+
+
+class WrappedContentCache(object):
+    """ Persistent cache of wrapped SQL scripts. Wrapping output depends on source content and wrap tool only,
+    so it is addressed by their combination: repeated deliveries of the same scripts skip wrap subprocess.
+    Least recently used entries are removed when cache exceeds its size limit """
+
+    def __init__(self, cache_dir, max_size, tool_identity):
+        """ :param cache_dir: local directory to keep wrapped content in. Is created if missing
+        :param max_size: cache size limit in bytes
+        :param tool_identity: string identifying wrap tool and its version, e.g. checksum of its binary """
+        self._content_cache = ContentCache(cache_dir, max_size)
+        self._tool_identity = tool_identity
+
+    def get_path(self, source_md5):
+        """ :param source_md5: checksum of content before wrapping
+        :return: local path to wrapped content, None if it is not cached """
+        return self._content_cache.get(self._get_key(source_md5))
+
+    def get(self, source_md5):
+        """ :param source_md5: checksum of content before wrapping
+        :return: wrapped content, None if it is not cached """
+        cached_path = self.get_path(source_md5)
+        if not cached_path:
+            return None
+        try:
+            with open(cached_path, "rb") as cached_file:
+                return cached_file.read()
+        except OSError as err:
+            logging.debug("Unable to read %s: %s" % (cached_path, err))  # evicted by other worker
+            return None
+
+    def put(self, source_md5, wrapped_content):
+        """ :param source_md5: checksum of content before wrapping
+        :param wrapped_content: bytes """
+        self._content_cache.put_content(self._get_key(source_md5), wrapped_content)
+
+    def put_file(self, source_md5, wrapped_path):
+        """ :param source_md5: checksum of content before wrapping
+        :param wrapped_path: local path of wrapped content. It is linked to cache, so should not be modified later """
+        self._content_cache.put(self._get_key(source_md5), wrapped_path)
+
+    def _get_key(self, source_md5):
+        return md5(("%s\n%s" % (self._tool_identity, source_md5)).encode("utf8")).hexdigest()
+
+
+def get_wrap_tool_identity():
+    """ :return: identity of Oracle wrap binary used by BoundedWrapClient (checksum of its content),
+    None if it is not installed """
+    wrap_path = os.path.join(os.getenv("ORACLE_HOME", ""), "bin", "wrap")
+    if not os.getenv("ORACLE_HOME") or not os.path.isfile(wrap_path):
+        return None
+    hmd5 = md5()
+    with open(wrap_path, "rb") as wrap_file:
+        while True:
+            chunk = wrap_file.read(1 * 1024 * 1024)
+            if not chunk: break
+            hmd5.update(chunk)
+    return "oracle-wrap:%s" % hmd5.hexdigest()
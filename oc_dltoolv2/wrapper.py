@@ -1,22 +1,40 @@
 import logging
 import os, posixpath
+import uuid
+import weakref
+from hashlib import md5
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_EXCEPTION
 from io import BytesIO
-#from itertools import ifilter, ifilterfalse
-from itertools import filterfalse as ifilterfalse
+
+import tempfile
 
 from fs.errors import ResourceNotFound
 from fs.tempfs import TempFS
+from oc_sql_helpers.normalizer import PLSQLNormalizer
 
-from .resources import ResourceData, DeliveryResource
+from .fast_copy import copy_file, get_local_path, upload_content
+from .resources import ResourceData, DeliveryResource, FSLocation
+from .subprocess_wrapper import SubprocessWrapper
 
 
 
 class Wrapper(object):
     """ Performs obfuscation of given resources (currently only SQL scripts wrapping) """
 
-    def __init__(self, wrap_client):
-        """  :param wrap_client: object with SqlWrapper interface """
+    def __init__(self, wrap_client, memory_pool=None, work_fs=None, cancellation=None, workers=None,
+                 wrap_cache=None):
+        """  :param wrap_client: object with SqlWrapper interface
+        :param memory_pool: optional MemoryPool to account wrapped content kept in memory
+        :param work_fs: pyfilesystem2-like object to place wrapped content not fitting memory_pool into
+        :param cancellation: optional CancellationToken checked before each file is wrapped
+        :param workers: max number of files wrapped simultaneously; number of available cores if omitted
+        :param wrap_cache: optional WrappedContentCache to take wrapped content from instead of wrapping """
         self._wrap_client = wrap_client
+        self._memory_pool = memory_pool
+        self._work_fs = work_fs
+        self._cancellation = cancellation
+        self._workers = workers or get_available_cores()
+        self._wrap_cache = wrap_cache
         self.WRAPPER_C_OWNER_LOC = '\x63\x61\x72ds/o\x77s_\x77ork/db/scripts/inst\x61ll/o\x77so\x77ner'
         self.WRAPPER_D_OWNER_LOC = 'd\x77h/o\x77s_\x77ork/db/scripts/inst\x61ll/o\x77so\x77ner'
         self.WRAPPER_C_OWNER_LOC_HOME = '\x63\x61\x72ds/o\x77s_home/db/scripts/inst\x61ll/o\x77so\x77ner'
@@ -31,119 +49,310 @@ class Wrapper(object):
         2) package bodies in owner folders 
         Rules are case-insensitive.
         :param resources: list of DeliveryResource. Non-SVN resources are kept unchanged
-        :param svn_fs: SvnFS pointing to root of branch. Used to determine wrap list 
+        :param svn_fs: SvnFS pointing to root of branch. wrap.txt files are read from it 
         :return: list of DeliveryResource where files to wrap are replaced with its wrapped versions """
         logging.info("get_wrapped_resources started")
         selected, skipped = self._split_resources(resources, svn_fs)
         logging.info("To be wrapped: [%s]" % ";".join([resource.location_stub.path
                                                    for resource in selected]))
-        wrapped_resources = list(map(self._wrap_resource, selected))
+        wrapped_resources = self._wrap_resources(selected)
         resulting_resources = wrapped_resources + skipped
         logging.info("get_wrapped_resources completed")
         return resulting_resources
 
     def _split_resources(self, resources, svn_fs):
         logging.debug("Splitting resources into selected and skipped")
-        is_svn_resource = lambda resource: resource.location_stub.location_type.code == "SVN"
-        wrap_list = self._get_files_to_wrap(svn_fs)
-        # endswith because path starts with client branch url
-        should_wrap = lambda resource: any(resource.location_stub.path.lower().endswith(path.lower())
-                                           for path in wrap_list)
-        is_selected = lambda resource: is_svn_resource(resource) and should_wrap(resource)
-        skipped = list(ifilterfalse(is_selected, resources))
-        selected = list(filter(is_selected, resources))
+        wrap_index = WrapListIndex(self._get_files_to_wrap(svn_fs, resources))
+        selected, skipped = [], []
+        for resource in resources:
+            is_selected = (resource.location_stub.location_type.code == "SVN"
+                           and wrap_index.matches(resource.location_stub.path))
+            (selected if is_selected else skipped).append(resource)
         logging.debug("Resources split into selected: %d, skipped: %d" % (len(selected), len(skipped)))
         return selected, skipped
 
+    def _wrap_resources(self, resources):
+        """ Wraps resources by pool of threads, each waiting for its own wrap subprocess.
+        Result keeps order of resources; the first failure cancels wrapping of files not started yet """
+        if self._workers <= 1 or len(resources) <= 1:
+            return list(map(self._wrap_resource, resources))
+
+        logging.debug("Wrapping %d resources in %d threads" % (len(resources), self._workers))
+        with ThreadPoolExecutor(max_workers=min(self._workers, len(resources)), thread_name_prefix="wrap") as executor:
+            futures = [executor.submit(self._wrap_resource, resource) for resource in resources]
+            wait(futures, return_when=FIRST_EXCEPTION)
+            for future in futures:
+                future.cancel()
+            # files already being wrapped are waited for on exit, their exceptions are logged by _wrap_resource
+            failed = [future for future in futures if future.done() and not future.cancelled() and future.exception()]
+        if failed:
+            raise failed[0].exception()
+        return [future.result() for future in futures]
+
     def _wrap_resource(self, resource):
+        if self._cancellation:
+            self._cancellation.check()
         logging.info("Wrapping resource: %s" % resource.location_stub.path)
-        # there may be an exception - raise it then
-        wrapped_data = WrappedResourceData(resource.resource_data, self._wrap_client)
+        try:
+            wrapped_data = WrappedResourceData(resource.resource_data, self._wrap_client,
+                                               memory_pool=self._memory_pool, work_fs=self._work_fs,
+                                               wrap_cache=self._wrap_cache)
+        except Exception as err:
+            logging.error("Wrapping failed for %s: %s" % (resource.location_stub.path, err))
+            raise WrapError("Unable to wrap %s: %s" % (resource.location_stub.path, err)) from err
         # wrapping is transparent - location_stub still points to svn
         wrapped_resource = DeliveryResource(resource.location_stub, wrapped_data)
         logging.info("Wrapping completed for %s" % resource.location_stub.path)
         return wrapped_resource
 
-    def _get_files_to_wrap(self, svn_fs):
+    def _get_files_to_wrap(self, svn_fs, resources):
+        """ Owner scripts and custs are taken from resolved resources, which are listed at the tag revision already,
+        so only wrap.txt files are read from SVN, and only for prefixes having custs among resources
+        :param resources: list of DeliveryResource being delivered
+        :return: paths relative to branch root """
         logging.info("Getting files to wrap from SVN")
         c_owner_loc = self.WRAPPER_C_OWNER_LOC
         d_owner_loc = self.WRAPPER_D_OWNER_LOC
         c_custs_loc = posixpath.join(c_owner_loc, 'cust')
         d_custs_loc = posixpath.join(d_owner_loc, 'cust')
-        c_owner_loc_home = self.WRAPPER_C_OWNER_LOC_HOME
-        d_owner_loc_home = self.WRAPPER_D_OWNER_LOC_HOME
-        c_prefix = self.WRAPPER_C_PREFIX
-        d_prefix = self.WRAPPER_D_PREFIX
-
-        place_in_folder = lambda files, folder: [_join_path(folder, path)
-                                                 for path in files]
-
-        c_custs = self._read_wrap_file(_join_path(c_prefix, "wrap.txt"), c_custs_loc, svn_fs)
-        d_custs = self._read_wrap_file(_join_path(d_prefix, "wrap.txt"), d_custs_loc, svn_fs)
-
-        c_scripts = self._list_private_scripts(_join_path(c_owner_loc), svn_fs)
-        d_scripts = self._list_private_scripts(_join_path(d_owner_loc), svn_fs)
-        c_scripts_from_home = self._list_private_scripts(_join_path(c_owner_loc_home), svn_fs)
-        d_scripts_from_home = self._list_private_scripts(_join_path(d_owner_loc_home), svn_fs)
-
-        files_to_wrap = (place_in_folder(c_custs, c_custs_loc) +
-                         place_in_folder(d_custs, d_custs_loc) +
-                         place_in_folder(c_scripts, c_owner_loc) +
-                         place_in_folder(d_scripts, d_owner_loc) +
-                         place_in_folder(c_scripts_from_home, c_owner_loc_home) +
-                         place_in_folder(d_scripts_from_home, d_owner_loc_home))
+        owner_locs = [c_owner_loc, d_owner_loc, self.WRAPPER_C_OWNER_LOC_HOME, self.WRAPPER_D_OWNER_LOC_HOME]
+        wrap_files = {c_custs_loc: _join_path(self.WRAPPER_C_PREFIX, "wrap.txt"),
+                      d_custs_loc: _join_path(self.WRAPPER_D_PREFIX, "wrap.txt")}
+        is_in_folder = lambda folder, loc: ("/" + folder).endswith("/" + loc.lower())
+
+        files_to_wrap = []
+        existing_custs = dict((custs_loc, []) for custs_loc in wrap_files)
+        for resource in resources:
+            if resource.location_stub.location_type.code != "SVN":
+                continue
+            folder, filename = posixpath.split(resource.location_stub.path)
+            folder = folder.lower()
+            files_to_wrap.extend(_join_path(owner_loc, filename) for owner_loc in owner_locs
+                                 if is_in_folder(folder, owner_loc) and filename.lower().endswith("_b.sql"))
+            for custs_loc, custs in existing_custs.items():
+                if is_in_folder(folder, custs_loc):
+                    custs.append(filename)
+
+        for custs_loc, custs in existing_custs.items():
+            if not custs:
+                continue  # no need to read wrap file
+            logging.debug("Existing custs: [%s]" % ';'.join(custs))
+            requested_custs = self._read_wrap_file(wrap_files[custs_loc], svn_fs)
+            files_to_wrap.extend(_join_path(custs_loc, cust) for cust in custs
+                                 if cust.lower() in requested_custs)
         logging.info("Files to wrap retrieved: %d" % len(files_to_wrap))
         return files_to_wrap
 
-    def _read_wrap_file(self, file_url, folder_url, svn_fs):
+    def _read_wrap_file(self, file_url, svn_fs):
+        """ :return: lowercased cust names listed in wrap file """
         logging.debug("Reading wrap file: %s" % file_url)
         try:
             with svn_fs.open(file_url) as wrap_file:
                 requested_custs = list(filter(lambda y: bool(y), list(map(lambda x: x.strip().lower(), wrap_file.readlines()))))
-            existing_custs = svn_fs.listdir(folder_url)
-            logging.debug("Existing custs: [%s]" % (';'.join(existing_custs) if existing_custs else ""))
             logging.debug("Requested custs: [%s]" % (';'.join(requested_custs) if requested_custs else ""))
-            resulting_custs = [cust for cust in existing_custs
-                               if cust.lower() in requested_custs]
-            logging.debug("Wrap file read successfully. Found %d custs to wrap" % len(resulting_custs))
-            return resulting_custs
+            return requested_custs
         except ResourceNotFound as err:
             logging.warning("Wrap file not found: %s" % file_url)
             return []  # no wrap file - no custs to wrap
 
-    def _list_private_scripts(self, folder_url, svn_fs):
-        logging.debug("Listing private scripts in folder: %s" % folder_url)
-        is_private = lambda filename: filename.lower().endswith("_b.sql")
-        try:
-            all_scripts = svn_fs.listdir(folder_url)
-            privates = list (filter(is_private, all_scripts) )
-            logging.debug("Found %d private scripts" % len(privates))
-            return privates
-        except ResourceNotFound:
-            logging.warning("No scripts found in folder: %s" % folder_url)
-            return []  # no owner dir - no files to wrap
+
+class WrapListIndex(object):
+    """ Case-insensitive lookup of paths ending with any of wrap list entries.
+    Entries are indexed by file name, so only entries with the same name as the path are compared with it """
+
+    def __init__(self, wrap_list):
+        """ :param wrap_list: paths relative to branch root """
+        self._by_name = dict()
+        self._nameless = []  # entries without folder may match a part of file name only
+        for entry in wrap_list:
+            entry = entry.lower()
+            if "/" in entry:
+                self._by_name.setdefault(posixpath.basename(entry), []).append(entry)
+            else:
+                self._nameless.append(entry)
+
+    def matches(self, path):
+        """ :param path: full path, e.g. URL starting with client branch URL
+        :return: True if path ends with any of wrap list entries """
+        path = path.lower()
+        candidates = self._by_name.get(posixpath.basename(path), [])
+        return any(path.endswith(entry) for entry in candidates + self._nameless)
 
 
 class WrappedResourceData(ResourceData):
 
-    def __init__(self, data, wrap_client):
+    def __init__(self, data, wrap_client, memory_pool=None, work_fs=None, wrap_cache=None):
+        """ :param memory_pool: optional MemoryPool. If given, wrapped content is kept in memory only if it fits the pool
+        :param work_fs: pyfilesystem2-like object to keep wrapped content in. Content is kept in memory if omitted
+        :param wrap_cache: optional WrappedContentCache to look wrapped content up in before wrapping """
         super(ResourceData, self).__init__()
-        # assume file is quite small, so wrapped content can be stored in memory
+        self._cache_location = None
+        self._wrapped_content = None
+        source_md5 = self._get_source_md5(data) if wrap_cache else None
+        if not work_fs:
+            self._wrapped_content = self._wrap_data(data, wrap_client, wrap_cache, source_md5)
+            return
+
+        cache_filename = "wrapped_%s.plb" % uuid.uuid4()
+        target_path = get_local_path(work_fs, cache_filename, exists=False)
+        if target_path:
+            self._wrap_to_cached_file(data, wrap_client, work_fs, target_path, wrap_cache, source_md5)
+        else:
+            # work_fs is not on local disk: wrap tool needs one, so wrapped content is uploaded from temporary file
+            with TempFS() as temp_fs:
+                self._wrap_to_cached_file(data, wrap_client, temp_fs, temp_fs.getsyspath("_f.plb"),
+                                          wrap_cache, source_md5)
+                with temp_fs.openbin("_f.plb") as wrapped_file:
+                    work_fs.upload(cache_filename, wrapped_file)
+        self._store(work_fs, cache_filename, memory_pool)
+
+    def _wrap_to_cached_file(self, data, wrap_client, local_fs, target_path, wrap_cache, source_md5):
+        cached_path = wrap_cache.get_path(source_md5) if wrap_cache else None
+        if cached_path:
+            logging.debug("Wrapped content of %s is taken from cache" % source_md5)
+            copy_file(cached_path, target_path, allow_link=True)
+            return
         logging.info("Wrapping data using wrap_client")
-        self._wrapped_content = self._wrap_data(data, wrap_client)
+        self._wrap_to_file(data, wrap_client, local_fs, target_path)
+        if wrap_cache:
+            wrap_cache.put_file(source_md5, target_path)
+
+    def _store(self, work_fs, cache_filename, memory_pool):
+        """ Keeps wrapped content in work_fs; only small scripts fitting memory_pool are moved to memory,
+        which saves a file per each of them while memory used by build stays capped """
+        size = work_fs.getsize(cache_filename)
+        if memory_pool and memory_pool.reserve(size):
+            self._wrapped_content = work_fs.readbytes(cache_filename)
+            work_fs.remove(cache_filename)
+            weakref.finalize(self, memory_pool.release, size)
+            return
+        self._cache_location = FSLocation(work_fs, cache_filename)
+        logging.debug("Wrapped content placed to %s" % cache_filename)
+
+    def _wrap_to_file(self, data, wrap_client, local_fs, target_path):
+        """ Wraps content to local file. Content already on local disk (e.g. downloaded) is wrapped in place,
+        other one is copied to local_fs first """
+        fs_location = data.get_fs_location()
+        source_path = get_local_path(fs_location.fs, fs_location.location) if fs_location else None
+        if source_path:
+            wrap_client.wrap_path(source_path, target_path)
+            logging.debug("File wrapped successfully")
+            return
+
+        source_filename = "wrap_source_%s.sql" % uuid.uuid4()
+        upload_content(data, local_fs, source_filename)
+        try:
+            wrap_client.wrap_path(local_fs.getsyspath(source_filename), target_path)
+        finally:
+            local_fs.remove(source_filename)
+        logging.debug("File wrapped successfully")
 
-    def _wrap_data(self, data, wrap_client):
+    def _wrap_data(self, data, wrap_client, wrap_cache=None, source_md5=None):
+        wrapped_content = wrap_cache.get(source_md5) if wrap_cache else None
+        if wrapped_content is not None:
+            logging.debug("Wrapped content of %s is taken from cache" % source_md5)
+            return wrapped_content
+        logging.info("Wrapping data using wrap_client")
         with TempFS() as temp_fs:
-            with data.get_content() as content_handle:
-                temp_fs.upload("_f.sql", content_handle)
-                wrapped_content = wrap_client.wrap_path(temp_fs.getsyspath("_f.sql"))
+            upload_content(data, temp_fs, "_f.sql")
+            wrapped_content = wrap_client.wrap_path(temp_fs.getsyspath("_f.sql"))
         logging.debug("File wrapped successfully")
+        if wrap_cache:
+            wrap_cache.put(source_md5, wrapped_content)
         return wrapped_content
 
+    def _get_source_md5(self, data):
+        source_md5 = getattr(data, "md5", None)
+        if source_md5:
+            return source_md5
+        hmd5 = md5()
+        with data.get_content() as content_handle:
+            while True:
+                chunk = content_handle.read(1 * 1024 * 1024)
+                if not chunk: break
+                hmd5.update(chunk)
+        return hmd5.hexdigest()
+
     def get_content(self):
         logging.debug("Getting wrapped content")
+        if self._cache_location:
+            return self._cache_location.fs.openbin(self._cache_location.location)
         return BytesIO(self._wrapped_content)
 
+    def get_fs_location(self):
+        return self._cache_location
+
+
+class BoundedWrapClient(object):
+    """ Runs Oracle wrap tool the same way PLSQLWrapper.wrap_path does, but in its own process group with timeout.
+    The tool is killed once timeout expires or build is cancelled, so a hung wrap does not stall the worker """
+
+    def __init__(self, timeout=None, cancellation=None, subprocess_wrapper=None):
+        """ :param timeout: seconds to wait for single file to be wrapped; no limit if None
+        :param cancellation: optional CancellationToken; wrap tool is killed once it is tripped
+        :param subprocess_wrapper: SubprocessWrapper to run the tool with """
+        self._timeout = timeout
+        self._cancellation = cancellation
+        self._subprocess_wrapper = subprocess_wrapper or SubprocessWrapper()
+
+    def wrap_path(self, path_in, write_to=None):
+        """ :param path_in: path to SQL file to wrap
+        :param write_to: path to write wrapped script to
+        :return: wrapped content if write_to is None, None otherwise """
+        oracle_home = os.getenv("ORACLE_HOME")
+        if not oracle_home:
+            raise ValueError("ORACLE_HOME environment variable is not set")
+        wrap_tool = os.path.join(oracle_home, "bin", "wrap")
+        if not os.path.exists(wrap_tool):
+            raise FileNotFoundError(wrap_tool)
+
+        with tempfile.TemporaryDirectory(suffix="wrap") as temp_dir:
+            if not os.path.splitext(path_in)[1]:
+                # wrap tool is unable to open file without extension
+                linked_path = os.path.join(temp_dir, os.path.basename(path_in) + ".sql")
+                os.symlink(path_in, linked_path)
+                path_in = linked_path
+            target_path = write_to or os.path.join(temp_dir, "wrapped.plb")
+            if not os.path.splitext(target_path)[1]:
+                raise WrapError("Wrap to file without extension is not supported ('%s')" % target_path)
+
+            result = self._subprocess_wrapper.execute_bounded(
+                [wrap_tool, "iname=%s" % path_in, "oname=%s" % target_path], timeout=self._timeout,
+                output_dir=temp_dir, options={"env": _get_wrap_environment(oracle_home)}, fail=True,
+                cancellation=self._cancellation)
+            logging.debug("Wrap tool finished in %.3fs" % result.wall_time)
+            # wrap tool may silently leave output empty or not wrapped in case of wrong SQL
+            if not os.path.exists(target_path) or not os.path.getsize(target_path):
+                raise WrapError("Output file '%s' was not created or has zero length" % target_path)
+            with open(target_path, "rb") as wrapped_file:
+                if not PLSQLNormalizer().is_wrapped(wrapped_file):
+                    raise WrapError("Output file '%s' is not actually wrapped" % target_path)
+                if not write_to:
+                    wrapped_file.seek(0)
+                    return wrapped_file.read()
+        return None
+
+
+class WrapError(Exception):
+    pass
+
+
+def _get_wrap_environment(oracle_home):
+    """ :return: environment for wrap tool, with Oracle binaries and libraries paths added """
+    environment = dict(os.environ)
+    lib_path, bin_path = os.path.join(oracle_home, "lib"), os.path.join(oracle_home, "bin")
+    environment["PATH"] = ":".join(filter(None, [bin_path, lib_path, environment.get("PATH")]))
+    environment["LD_LIBRARY_PATH"] = ":".join(filter(None, [lib_path, environment.get("LD_LIBRARY_PATH")]))
+    return environment
+
+
+def get_available_cores():
+    """ :return: number of CPU cores this process may run on """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
 
 def _join_path(*args):
     joined_path = os.path.join(*[token.strip("/")
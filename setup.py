@@ -9,7 +9,7 @@ spec = { "name": "oc-dltool",
          "description": "Includes tools for delivery build and release",
          "long_description": "",
          "long_description_content_type": "text/plain",
-         "python_requires": ">=3.6",
+         "python_requires": ">=3.9",
          "install_requires": [
            "oc-cdtapi>=3.18.3",
            "oc-checksumsq",
@@ -25,7 +25,7 @@ spec = { "name": "oc-dltool",
            "oc-logging"
          ],
          "packages": included_packages,
-         "python_requires": ">=3.6"
+         "python_requires": ">=3.9"
       }
 
 setup (**spec)